@@ -15,8 +15,8 @@ class RapidOCRDocLoader(UnstructuredFileLoader):
             from PIL import Image
             from io import BytesIO
             import numpy as np
-            from rapidocr_onnxruntime import RapidOCR
-            ocr = RapidOCR()
+            from document_loaders.ocr import get_ocr
+            ocr = get_ocr(use_cuda=False)
             doc = Document(filepath)
             resp = ""
 
@@ -10,8 +10,8 @@ class RapidOCRPPTLoader(UnstructuredFileLoader):
             from PIL import Image
             import numpy as np
             from io import BytesIO
-            from rapidocr_onnxruntime import RapidOCR
-            ocr = RapidOCR()
+            from document_loaders.ocr import get_ocr
+            ocr = get_ocr(use_cuda=False)
             prs = Presentation(filepath)
             resp = ""
 
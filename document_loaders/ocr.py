@@ -1,4 +1,5 @@
-from typing import TYPE_CHECKING
+import threading
+from typing import TYPE_CHECKING, Dict
 
 
 if TYPE_CHECKING:
@@ -8,11 +9,40 @@ if TYPE_CHECKING:
         from rapidocr_onnxruntime import RapidOCR
 
 
-def get_ocr(use_cuda: bool = True) -> "RapidOCR":
-    try:
-        from rapidocr_paddle import RapidOCR
-        ocr = RapidOCR(det_use_cuda=use_cuda, cls_use_cuda=use_cuda, rec_use_cuda=use_cuda)
-    except ImportError:
-        from rapidocr_onnxruntime import RapidOCR
-        ocr = RapidOCR()
-    return ocr
+class SharedOCR:
+    '''
+    进程内共享的 OCR 模型。RapidOCR 不保证线程安全，多个解析线程调用时加锁串行执行
+    '''
+
+    def __init__(self, ocr: "RapidOCR"):
+        self.ocr = ocr
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            return self.ocr(*args, **kwargs)
+
+
+_ocr_cache: Dict[bool, SharedOCR] = {}
+_ocr_lock = threading.Lock()
+
+
+def get_ocr(use_cuda: bool = True) -> SharedOCR:
+    '''
+    OCR 模型在每个进程内只加载一次（每种 use_cuda 一个实例），由所有解析线程共享，
+    线程池中不会常驻多份模型
+    '''
+    with _ocr_lock:
+        try:
+            from rapidocr_paddle import RapidOCR
+        except ImportError:
+            from rapidocr_onnxruntime import RapidOCR
+            # onnxruntime 版本不区分是否使用 CUDA，共用一个实例
+            use_cuda = False
+            if use_cuda not in _ocr_cache:
+                _ocr_cache[use_cuda] = SharedOCR(RapidOCR())
+        else:
+            if use_cuda not in _ocr_cache:
+                _ocr_cache[use_cuda] = SharedOCR(RapidOCR(det_use_cuda=use_cuda, cls_use_cuda=use_cuda,
+                                                          rec_use_cuda=use_cuda))
+        return _ocr_cache[use_cuda]
@@ -32,7 +32,7 @@ from server.llm_api import (list_running_models, list_config_models,
                             change_llm_model, stop_llm_model,
                             get_model_config, list_search_engines)
 from server.utils import (BaseResponse, FastAPI, MakeFastAPIOffline,
-                          get_server_configs, get_prompt_template, PageResponse)
+                          get_server_configs, get_cache_stats, get_prompt_template, PageResponse)
 from typing import List, Literal
 
 nltk.data.path = [NLTK_DATA_PATH] + nltk.data.path
@@ -190,6 +190,12 @@ def mount_app_routes(app: FastAPI, run_mode: str = None):
              summary="获取服务器原始配置信息",
              )(get_server_configs)
 
+    app.post("/server/cache_stats",
+             tags=["Server State"],
+             response_model=BaseResponse,
+             summary="获取缓存池统计信息",
+             )(get_cache_stats)
+
     app.post("/server/list_search_engines",
              tags=["Server State"],
              summary="获取服务器支持的搜索引擎",
@@ -284,7 +290,7 @@ def mount_knowledge_routes(app: FastAPI):
     from server.knowledge_base.kb_doc_api import (list_files, upload_docs, delete_docs,
                                                   update_docs, download_doc, recreate_vector_store,
                                                   search_docs, DocumentWithVSId, update_info,
-                                                  update_docs_by_id, )
+                                                  update_docs_by_id, search_docs_batch, )
 
     app.post("/chat/knowledge_base_chat",
              tags=["Chat"],
@@ -329,6 +335,12 @@ def mount_knowledge_routes(app: FastAPI):
              summary="搜索知识库"
              )(search_docs)
 
+    app.post("/knowledge_base/search_docs_batch",
+             tags=["Knowledge Base Management"],
+             response_model=List[List[DocumentWithVSId]],
+             summary="批量搜索知识库"
+             )(search_docs_batch)
+
     app.post("/knowledge_base/update_docs_by_id",
              tags=["Knowledge Base Management"],
              response_model=BaseResponse,
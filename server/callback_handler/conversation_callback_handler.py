@@ -3,18 +3,22 @@ from asyncio import CancelledError
 from typing import Any, Dict, List, Optional, Union
 from uuid import UUID
 
-from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.base import AsyncCallbackHandler
 from langchain.schema import LLMResult
 from langchain_core.agents import AgentFinish
 from langchain_core.outputs import GenerationChunk, ChatGenerationChunk
 
 from common.exceptions import ChatBusinessException
 from server.chat.utils import UN_FORMAT_ONLINE_LLM_MODELS
-from server.db.repository import update_message
+from server.db.repository import aupdate_message
 from server.memory.message_i18n import Message_I18N
 
 
-class ConversationCallbackHandler(BaseCallbackHandler):
+class ConversationCallbackHandler(AsyncCallbackHandler):
+    """
+    将模型输出写回消息记录。对话均通过 acall 异步执行，这里使用异步回调与异步数据库接口，
+    写库时不阻塞事件循环
+    """
     raise_error: bool = True
 
     def __init__(self, model_name: str, conversation_id: str, message_id: str, chat_type: str, query: str,
@@ -34,7 +38,7 @@ class ConversationCallbackHandler(BaseCallbackHandler):
         """Whether to call verbose callbacks even if verbose is False."""
         return True
 
-    def on_agent_finish(
+    async def on_agent_finish(
             self,
             finish: AgentFinish,
             *,
@@ -43,17 +47,17 @@ class ConversationCallbackHandler(BaseCallbackHandler):
             **kwargs: Any,
     ) -> Any:
         if self.agent and not self.updated:
-            self.update_message(finish.return_values.get('output'))
+            await self.update_message(finish.return_values.get('output'))
             self.generated_tokens = []
             self.updated = True
 
-    def on_llm_start(
+    async def on_llm_start(
             self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
     ) -> None:
         # 如果想存更多信息，则prompts 也需要持久化
         pass
 
-    def on_llm_new_token(
+    async def on_llm_new_token(
             self,
             token: str,
             *,
@@ -65,7 +69,7 @@ class ConversationCallbackHandler(BaseCallbackHandler):
         if not self.agent:
             self.generated_tokens.append(token)
 
-    def update_message(self, answer: str, error: str = None):
+    async def update_message(self, answer: str, error: str = None):
         mark = f'###[{self.model_name}]###'
         metadata = {}
         if self.model_name in UN_FORMAT_ONLINE_LLM_MODELS and answer.startswith(mark) and answer.endswith(mark):
@@ -88,16 +92,16 @@ class ConversationCallbackHandler(BaseCallbackHandler):
         else:
             if self.docs:
                 metadata["docs"] = self.docs
-        update_message(self.message_id, answer, metadata if len(metadata) > 0 else None)
+        await aupdate_message(self.message_id, answer, metadata if len(metadata) > 0 else None)
 
-    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         if not self.agent and not self.updated:
             answer = response.generations[0][0].text
-            self.update_message(answer)
+            await self.update_message(answer)
             self.generated_tokens = []
             self.updated = True
 
-    def on_chain_error(
+    async def on_chain_error(
             self,
             error: BaseException,
             *,
@@ -114,7 +118,7 @@ class ConversationCallbackHandler(BaseCallbackHandler):
                     msg = answer = Message_I18N.WORKER_CHAT_CANCELLED.value
                 else:
                     msg = answer = Message_I18N.WORKER_CHAT_ERROR.value
-            self.update_message(answer, error=error_info)
+            await self.update_message(answer, error=error_info)
             self.updated = True
             self.generated_tokens = []
             b_error = ChatBusinessException(msg)
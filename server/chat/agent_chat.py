@@ -21,7 +21,7 @@ from server.callback_handler.task_callback_handler import TaskCallbackHandler
 from server.chat.chat_type import ChatType
 from server.chat.task_manager import task_manager
 from server.chat.utils import History, UN_FORMAT_ONLINE_LLM_MODELS, wrap_event_response
-from server.db.repository import add_message_to_db, get_assistant_simple_from_db
+from server.db.repository import aadd_message_to_db, aget_assistant_simple_from_db
 from server.memory.message_i18n import Message_I18N
 from server.utils import wrap_done, get_ChatOpenAI, get_prompt_template, BaseResponse, get_tool_config
 
@@ -89,9 +89,9 @@ async def agent_chat(query: str = Body(..., description="用户输入", examples
             max_tokens = None
 
         callbacks = [callback]
-        message_id = add_message_to_db(chat_type=ChatType.AGENT_CHAT.value, query=query,
-                                       conversation_id=conversation_id,
-                                       store=store_message)
+        message_id = await aadd_message_to_db(chat_type=ChatType.AGENT_CHAT.value, query=query,
+                                              conversation_id=conversation_id,
+                                              store=store_message)
         conversation_callback = ConversationCallbackHandler(model_name=model_name, conversation_id=conversation_id,
                                                             message_id=message_id, chat_type=ChatType.AGENT_CHAT.value,
                                                             query=query, agent=True)
@@ -244,7 +244,7 @@ async def call_tool(
             return BaseResponse(code=500, msg=Message_I18N.API_TOOL_NOT_FOUND.value)
         model_container = create_model_container()
         if assistant_id >= 0:
-            assistant = get_assistant_simple_from_db(assistant_id=assistant_id)
+            assistant = await aget_assistant_simple_from_db(assistant_id=assistant_id)
             tool_config = assistant.get("tool_config")
             if tool_config and len(tool_config) > 0:
                 model_container.TOOL_CONFIG.update(tool_config)
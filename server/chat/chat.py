@@ -17,7 +17,7 @@ from server.callback_handler.task_callback_handler import TaskCallbackHandler
 from server.chat.chat_type import ChatType
 from server.chat.utils import History, UN_FORMAT_ONLINE_LLM_MODELS, EMPTY_LLM_CHAT_PROMPT, parse_llm_token_inner_json, \
     wrap_event_response
-from server.db.repository import add_message_to_db
+from server.db.repository import aadd_message_to_db
 from server.memory.conversation_db_buffer_memory import ConversationBufferDBMemory
 from server.utils import get_prompt_template
 from server.utils import wrap_done, get_ChatOpenAI
@@ -55,8 +55,8 @@ async def chat(query: str = Body(..., description="用户输入", examples=["恼
         memory = None
 
         # 负责保存llm response到message db
-        message_id = add_message_to_db(chat_type=ChatType.LLM_CHAT.value, query=origin_query,
-                                       conversation_id=conversation_id, store=store_message)
+        message_id = await aadd_message_to_db(chat_type=ChatType.LLM_CHAT.value, query=origin_query,
+                                              conversation_id=conversation_id, store=store_message)
         conversation_callback = ConversationCallbackHandler(model_name=model_name, conversation_id=conversation_id,
                                                             message_id=message_id, chat_type=ChatType.LLM_CHAT.value,
                                                             query=query)
@@ -106,11 +106,15 @@ async def chat(query: str = Body(..., description="用户输入", examples=["恼
         if model_name in UN_FORMAT_ONLINE_LLM_MODELS:
             chat_prompt = EMPTY_LLM_CHAT_PROMPT
 
-        chain = LLMChain(prompt=chat_prompt, llm=model, memory=memory)
+        inputs = {"input": query}
+        if memory is not None:
+            # Chain.acall 的 prep_inputs 只调用同步的 load_memory_variables，这里预先异步读取历史消息
+            inputs.update(await memory.aload_memory_variables(inputs))
+        chain = LLMChain(prompt=chat_prompt, llm=model)
 
         # Begin a task that runs in the background.
         task = asyncio.create_task(wrap_done(
-            chain.acall({"input": query}, callbacks=callbacks),
+            chain.acall(inputs, callbacks=callbacks),
             callback.done),
         )
 
@@ -15,7 +15,7 @@ from server.callback_handler.task_callback_handler import TaskCallbackHandler
 from server.chat.chat_type import ChatType
 from server.chat.task_manager import task_manager
 from server.chat.utils import History, UN_FORMAT_ONLINE_LLM_MODELS, wrap_event_response
-from server.db.repository import add_message_to_db
+from server.db.repository import aadd_message_to_db
 from server.knowledge_base.oss import default_oss, OssType, oss_factory
 from server.knowledge_base.utils import KnowledgeFile, get_file_path
 from server.memory.message_i18n import Message_I18N
@@ -127,8 +127,8 @@ async def file_chat(query: str = Body(..., description="用户输入", examples=
             max_tokens = None
 
         callbacks = [callback]
-        message_id = add_message_to_db(chat_type=ChatType.FILE_CHAT.value, query=query,
-                                       conversation_id=conversation_id, store=store_message)
+        message_id = await aadd_message_to_db(chat_type=ChatType.FILE_CHAT.value, query=query,
+                                              conversation_id=conversation_id, store=store_message)
         conversation_callback = ConversationCallbackHandler(model_name=model_name, conversation_id=conversation_id,
                                                             message_id=message_id, chat_type=ChatType.FILE_CHAT.value,
                                                             query=query)
@@ -22,8 +22,8 @@ from server.callback_handler.task_callback_handler import TaskCallbackHandler
 from server.chat.chat_type import ChatType
 from server.chat.task_manager import task_manager
 from server.chat.utils import History, UN_FORMAT_ONLINE_LLM_MODELS, wrap_event_response
-from server.db.repository import add_message_to_db
-from server.knowledge_base.kb_doc_api import search_docs
+from server.db.repository import aadd_message_to_db
+from server.knowledge_base.kb_doc_api import search_docs_multi
 from server.knowledge_base.kb_service.base import KBServiceFactory
 from server.memory.message_i18n import Message_I18N
 from server.reranker.reranker import LangchainReranker
@@ -68,7 +68,7 @@ async def knowledge_base_chat(query: str = Body(..., description="用户输入",
     if not knowledge_base_names:
         return BaseResponse(code=500, msg=Message_I18N.API_PARAM_NOT_PRESENT.value.format(name='knowledge_base_names'))
     for k in knowledge_base_names:
-        kb = KBServiceFactory.get_service_by_name(k)
+        kb = await KBServiceFactory.aget_service_by_name(k)
         if kb is None:
             return BaseResponse(code=500, msg=Message_I18N.API_KB_NOT_EXIST.value.format(kb_name=k))
 
@@ -90,8 +90,8 @@ async def knowledge_base_chat(query: str = Body(..., description="用户输入",
         nonlocal max_tokens
         callback = AsyncIteratorCallbackHandler()
         # 负责保存llm response到message db
-        message_id = add_message_to_db(chat_type=ChatType.KNOWLEDGE_BASE_CHAT.value, query=query,
-                                       conversation_id=conversation_id, store=store_message)
+        message_id = await aadd_message_to_db(chat_type=ChatType.KNOWLEDGE_BASE_CHAT.value, query=query,
+                                              conversation_id=conversation_id, store=store_message)
         conversation_callback = ConversationCallbackHandler(model_name=model_name, conversation_id=conversation_id,
                                                             message_id=message_id, query=query,
                                                             chat_type=ChatType.KNOWLEDGE_BASE_CHAT.value)
@@ -116,17 +116,10 @@ async def knowledge_base_chat(query: str = Body(..., description="用户输入",
             max_tokens=max_tokens,
             callbacks=[callback],
         )
-        docs = []
-        for knowledge_base_name in knowledge_base_names:
-            docs_part = await run_in_threadpool(search_docs,
-                                                query=query,
-                                                knowledge_base_name=knowledge_base_name,
-                                                top_k=top_k,
-                                                score_threshold=score_threshold)
-            for d in docs_part:
-                d.metadata['kb_name'] = knowledge_base_name
-                docs.append(d)
-        docs.sort(key=lambda x: x.score)
+        docs = await search_docs_multi(query=query,
+                                       knowledge_base_names=knowledge_base_names,
+                                       top_k=top_k,
+                                       score_threshold=score_threshold)
 
         # 加入reranker
         if USE_RERANKER:
@@ -136,8 +129,10 @@ async def knowledge_base_chat(query: str = Body(..., description="用户输入",
                                                max_length=RERANKER_MAX_LENGTH,
                                                model_name_or_path=reranker_model_path
                                                )
-            docs = reranker_model.compress_documents(documents=docs,
-                                                     query=query)
+            # 模型由 reranker_pool 共享，推理在后台线程中与其他请求合并批次，这里不阻塞事件循环
+            docs = await run_in_threadpool(reranker_model.compress_documents,
+                                           documents=docs,
+                                           query=query)
 
         if len(docs) > top_k:
             docs = docs[:top_k]
@@ -14,7 +14,6 @@ from langchain.utilities.bing_search import BingSearchAPIWrapper
 from langchain.utilities.duckduckgo_search import DuckDuckGoSearchAPIWrapper
 from markdownify import markdownify
 from sse_starlette import EventSourceResponse
-from strsimpy.normalized_levenshtein import NormalizedLevenshtein
 
 from configs import (BING_SEARCH_URL, BING_SUBSCRIPTION_KEY, METAPHOR_API_KEY,
                      LLM_MODELS, SEARCH_ENGINE_TOP_K, TEMPERATURE, OVERLAP_SIZE)
@@ -23,7 +22,8 @@ from server.callback_handler.task_callback_handler import TaskCallbackHandler
 from server.chat.chat_type import ChatType
 from server.chat.task_manager import task_manager
 from server.chat.utils import History, UN_FORMAT_ONLINE_LLM_MODELS, wrap_event_response
-from server.db.repository import add_message_to_db
+from server.knowledge_base.bm25_index import rerank_docs
+from server.db.repository import aadd_message_to_db
 from server.memory.message_i18n import Message_I18N
 from server.utils import BaseResponse, get_prompt_template
 from server.utils import wrap_done, get_ChatOpenAI
@@ -72,13 +72,9 @@ def metaphor_search(
                                                        chunk_overlap=chunk_overlap)
         splitted_docs = text_splitter.split_documents(docs)
 
-        # 将切分好的文档放入临时向量库，重新筛选出TOP_K个文档
+        # 将切分好的文档放入临时 BM25 索引，按关键词相关度重新筛选出TOP_K个文档
         if len(splitted_docs) > result_len:
-            normal = NormalizedLevenshtein()
-            for x in splitted_docs:
-                x.metadata["score"] = normal.similarity(text, x.page_content)
-            splitted_docs.sort(key=lambda x: x.metadata["score"], reverse=True)
-            splitted_docs = splitted_docs[:result_len]
+            splitted_docs = rerank_docs(text, splitted_docs, result_len)
 
         docs = [{"snippet": x.page_content,
                  "link": x.metadata["link"],
@@ -170,8 +166,8 @@ async def search_engine_chat(query: str = Body(..., description="用户输入",
             max_tokens = None
 
         callbacks = [callback]
-        message_id = add_message_to_db(chat_type=ChatType.SEARCH_ENGINE_CHAT.value, query=query,
-                                       conversation_id=conversation_id, store=store_message)
+        message_id = await aadd_message_to_db(chat_type=ChatType.SEARCH_ENGINE_CHAT.value, query=query,
+                                              conversation_id=conversation_id, store=store_message)
         conversation_callback = ConversationCallbackHandler(model_name=model_name, conversation_id=conversation_id,
                                                             message_id=message_id, query=query,
                                                             chat_type=ChatType.SEARCH_ENGINE_CHAT.value, )
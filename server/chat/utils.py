@@ -7,7 +7,7 @@ from pydantic import BaseModel, Field
 
 from common.exceptions import ChatBusinessException
 from configs import logger, log_verbose
-from server.db.repository import update_message
+from server.db.repository import aupdate_message
 from server.memory.message_i18n import Message_I18N
 
 
@@ -81,7 +81,7 @@ async def wrap_event_response(event_response: AsyncIterable[str]) -> AsyncIterab
     except MaxInputTokenException as e:
         d["answer"] = f"{e}"
         if d.get("message_id"):
-            update_message(message_id=d.get("message_id"), response=d["answer"])
+            await aupdate_message(message_id=d.get("message_id"), response=d["answer"])
         yield json.dumps(d, ensure_ascii=False)
     except BaseException as e:
         if isinstance(e, ChatBusinessException):
@@ -94,7 +94,8 @@ async def wrap_event_response(event_response: AsyncIterable[str]) -> AsyncIterab
             logger.error(msg, exc_info=e if log_verbose else None)
             d["answer"] = Message_I18N.WORKER_CHAT_ERROR.value
             if d.get("message_id"):
-                update_message(message_id=d.get("message_id"), response=d["answer"], metadata={"error_info": msg})
+                await aupdate_message(message_id=d.get("message_id"), response=d["answer"],
+                                      metadata={"error_info": msg})
             yield json.dumps(d, ensure_ascii=False)
 
 
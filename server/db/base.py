@@ -1,13 +1,20 @@
+from typing import Optional
+
 from sqlalchemy import create_engine, MetaData
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy.orm import sessionmaker
 
-from configs import SQLALCHEMY_DATABASE_URI, ECHO_SQL
+from configs import SQLALCHEMY_DATABASE_URI, ECHO_SQL, logger, log_verbose
 
 try:
     from configs import DATABASE_SCHEMA
 except ImportError:
     DATABASE_SCHEMA = None
+try:
+    from configs import SQLALCHEMY_ASYNC_DATABASE_URI
+except ImportError:
+    SQLALCHEMY_ASYNC_DATABASE_URI = None
 import json
 
 
@@ -22,10 +29,96 @@ def create_engine_wrapper(
     )
 
 
+# 同步驱动与对应的异步驱动
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+}
+
+
+# 同步驱动的连接参数在异步驱动中的名称，None 表示异步驱动不支持、直接丢弃
+ASYNC_QUERY_PARAMS = {
+    "postgresql+asyncpg": {
+        "client_encoding": None,  # asyncpg 固定使用 UTF8
+        "application_name": None,
+        "options": None,
+        "sslmode": "ssl",
+        "connect_timeout": "timeout",
+    },
+}
+
+
+def get_async_uri(uri: str = SQLALCHEMY_DATABASE_URI) -> Optional[str]:
+    """
+    根据同步连接串推断异步驱动的连接串，无法推断时返回 None。
+    连接串中异步驱动不支持的参数（如 psycopg2 的 client_encoding）按 ASYNC_QUERY_PARAMS 改名或丢弃
+    """
+    scheme = uri.partition("://")[0]
+    if scheme in ASYNC_DRIVERS.values():
+        driver = scheme
+    elif scheme in ASYNC_DRIVERS:
+        driver = ASYNC_DRIVERS[scheme]
+    else:
+        return None
+    url = make_url(uri)
+    params = ASYNC_QUERY_PARAMS.get(driver, {})
+    query = {}
+    for k, v in url.query.items():
+        name = params.get(k, k)
+        if name is not None:
+            query[name] = v
+    return url.set(drivername=driver, query=query).render_as_string(hide_password=False)
+
+
+def create_async_engine_wrapper(
+        uri=None,
+        json_serializer=lambda obj: json.dumps(obj, ensure_ascii=False),
+        pool_size=30, pool_recycle=1800, pool_pre_ping=True, pool_timeout=30, echo=ECHO_SQL
+):
+    """
+    创建异步引擎，供对话等请求链路上的数据库读写使用，避免阻塞事件循环。
+    未配置可用的异步连接串或未安装对应驱动（asyncpg/aiosqlite/aiomysql）时返回 None，
+    此时异步接口退化为在线程池中执行同步实现。
+    """
+    if uri is None:
+        uri = SQLALCHEMY_ASYNC_DATABASE_URI
+        if uri is None:
+            uri = get_async_uri()
+    if not uri:
+        return None
+    try:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        kwargs = {}
+        # aiosqlite 使用 NullPool/StaticPool，不接受连接池大小与等待时间参数
+        if make_url(uri).get_backend_name() != "sqlite":
+            kwargs.update(pool_size=pool_size, pool_timeout=pool_timeout)
+        return create_async_engine(
+            url=uri, json_serializer=json_serializer, pool_recycle=pool_recycle,
+            pool_pre_ping=pool_pre_ping, echo=echo, **kwargs
+        )
+    except Exception as e:
+        msg = f"创建异步数据库引擎失败，将在线程池中执行同步数据库操作：{e}"
+        logger.warning(f'{e.__class__.__name__}: {msg}', exc_info=e if log_verbose else None)
+        return None
+
+
 engine = create_engine_wrapper()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine_wrapper()
+
+if async_engine is not None:
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    AsyncSessionLocal = async_sessionmaker(autoflush=False, bind=async_engine)
+else:
+    AsyncSessionLocal = None
+
 metadata = MetaData(
     schema=DATABASE_SCHEMA
 )
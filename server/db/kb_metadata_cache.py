@@ -0,0 +1,153 @@
+import threading
+import time
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from configs import KB_METADATA_CACHE_TTL
+
+
+class KBMetadataCache:
+    '''
+    知识库与知识文件元数据（get_kb_detail / get_file_detail_by_kb_id 的结果）的进程内缓存。
+    - 新增/删除知识库、增删文件后由仓储层显式失效（见 invalidates_kb）；
+    - 失效时递增代数，失效前开始、失效后才完成的加载结果不会写入缓存，避免缓存旧数据；
+    - 每个知识库有独立的版本号，只在知识库本身新增/修改/删除时递增，
+      KBService 实例注册表据此判断实例是否需要重建；
+    - ttl 兜底其他进程对数据库的修改，为 0 时关闭缓存。
+    '''
+
+    def __init__(self, ttl: float = KB_METADATA_CACHE_TTL):
+        self.ttl = ttl
+        self._kbs: Dict[str, Tuple[float, Dict]] = {}
+        self._files: Dict[Tuple[int, str], Tuple[float, Dict]] = {}
+        self._kb_ids: Dict[str, int] = {}
+        self._versions: Dict[str, int] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _lookup(self, store: Dict, key: Hashable) -> Tuple[bool, Any, int]:
+        with self._lock:
+            item = store.get(key)
+            if item is not None and time.time() - item[0] < self.ttl:
+                self.hits += 1
+                return True, item[1], self._generation
+            self.misses += 1
+            return False, None, self._generation
+
+    def _store(self, store: Dict, key: Hashable, value: Dict, generation: int):
+        with self._lock:
+            if generation == self._generation:
+                store[key] = (time.time(), value)
+                if store is self._kbs and value:
+                    self._kb_ids[key] = value["id"]
+
+    def _cached(self, store: Dict, key: Hashable, loader: Callable[[], Dict]) -> Dict:
+        if self.ttl <= 0:
+            return loader()
+        hit, value, generation = self._lookup(store, key)
+        if hit:
+            return dict(value)
+        value = loader()
+        self._store(store, key, value, generation)
+        return dict(value)
+
+    async def _acached(self, store: Dict, key: Hashable, loader: Callable[[], Awaitable[Dict]]) -> Dict:
+        if self.ttl <= 0:
+            return await loader()
+        hit, value, generation = self._lookup(store, key)
+        if hit:
+            return dict(value)
+        value = await loader()
+        self._store(store, key, value, generation)
+        return dict(value)
+
+    def get_kb(self, kb_name: str, loader: Callable[[], Dict]) -> Dict:
+        return self._cached(self._kbs, kb_name, loader)
+
+    async def aget_kb(self, kb_name: str, loader: Callable[[], Awaitable[Dict]]) -> Dict:
+        return await self._acached(self._kbs, kb_name, loader)
+
+    def get_file(self, kb_id: int, file_name: str, loader: Callable[[], Dict]) -> Dict:
+        return self._cached(self._files, (kb_id, file_name), loader)
+
+    def kb_version(self, kb_name: str) -> int:
+        return self._versions.get(kb_name, 0)
+
+    def _drop(self, kb_name: str):
+        self._generation += 1
+        self.invalidations += 1
+        self._kbs.pop(kb_name, None)
+        kb_id = self._kb_ids.get(kb_name)
+        if kb_id is None:
+            # 不知道知识库 ID 时无法定位其文件，全部清除
+            self._files.clear()
+        else:
+            for key in [k for k in self._files if k[0] == kb_id]:
+                self._files.pop(key, None)
+
+    def invalidate_files(self, kb_name: str):
+        '''
+        知识库中的文件发生变化（文件信息、file_count）
+        '''
+        with self._lock:
+            self._drop(kb_name)
+
+    def invalidate_kb(self, kb_name: str):
+        '''
+        知识库本身被新增、修改或删除
+        '''
+        with self._lock:
+            self._drop(kb_name)
+            self._kb_ids.pop(kb_name, None)
+            self._versions[kb_name] = self._versions.get(kb_name, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._kbs.clear()
+            self._files.clear()
+            self._kb_ids.clear()
+            for kb_name in self._versions:
+                self._versions[kb_name] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "kbs": len(self._kbs),
+                "files": len(self._files),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "invalidations": self.invalidations,
+                "ttl": self.ttl,
+            }
+
+
+kb_metadata_cache = KBMetadataCache()
+
+
+def invalidates_kb(get_kb_name: Callable[..., str], files_only: bool = False):
+    '''
+    修改知识库或文件元数据的仓储函数使用，函数返回（事务已提交）后失效相应缓存。
+    get_kb_name 接收与被装饰函数相同的参数，返回知识库名称
+    '''
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            try:
+                return f(*args, **kwargs)
+            finally:
+                kb_name = get_kb_name(*args, **kwargs)
+                if files_only:
+                    kb_metadata_cache.invalidate_files(kb_name)
+                else:
+                    kb_metadata_cache.invalidate_kb(kb_name)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,248 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from configs import (MESSAGE_WRITE_BEHIND, MESSAGE_FLUSH_SIZE, MESSAGE_FLUSH_INTERVAL, MESSAGE_SPOOL_PATH,
+                     logger, log_verbose)
+from server.db.models.message_model import MessageModel
+from server.db.session import session_scope
+from starlette.concurrency import run_in_threadpool
+
+
+def _merge_meta(patch: Dict, current: Optional[Dict]) -> Dict:
+    # 与 update_message 的语义一致：已有的键优先
+    merged = dict(patch)
+    merged.update(current or {})
+    return merged
+
+
+def _merge(old: Dict, new: Dict) -> Dict:
+    '''
+    合并同一 message_id 的两条待写记录，new 晚于 old。
+    记录形如 {"id", "new": 是否为新增, "fields": 需要写入的字段, "meta": 待合并的 meta_data}
+    '''
+    if new["new"]:
+        return new
+    result = {"id": old["id"], "new": old["new"], "fields": dict(old["fields"]), "meta": old["meta"]}
+    result["fields"].update(new["fields"])
+    if new["meta"] is not None:
+        if result["new"]:
+            result["fields"]["meta_data"] = _merge_meta(new["meta"], result["fields"].get("meta_data"))
+        else:
+            result["meta"] = _merge_meta(new["meta"], result["meta"])
+    return result
+
+
+class MessageWriter:
+    '''
+    聊天记录的写回队列（write-behind）。
+    新增、更新、反馈只写入内存队列并按 message_id 合并（新增 + 更新合并为一次写入），
+    由后台线程在积累到 flush_size 条或每隔 flush_interval 秒时批量提交，大幅减少数据库连接的占用。
+    - 读取某个会话或消息前先写入其待写记录（读己之写）；
+    - 写入失败的记录保留在队列中，下次重试；
+    - 进程退出时写入剩余记录，仍失败则保存到 spool_path，下次启动时重新写入。
+    '''
+
+    def __init__(self,
+                 enabled: bool = MESSAGE_WRITE_BEHIND,
+                 flush_size: int = MESSAGE_FLUSH_SIZE,
+                 flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+                 spool_path: str = MESSAGE_SPOOL_PATH):
+        self.enabled = enabled
+        self.flush_size = max(flush_size, 1)
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self._pending: Dict[str, Dict] = OrderedDict()
+        # message_id -> conversation_id，用于判断某个会话是否有待写记录；只保留最近的映射
+        self._conversations: Dict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._load_spool()
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+            atexit.register(self.shutdown)
+
+    def _enqueue(self, record: Dict, conversation_id: str = None):
+        self._ensure_started()
+        with self._lock:
+            old = self._pending.get(record["id"])
+            self._pending[record["id"]] = _merge(old, record) if old else record
+            if conversation_id:
+                self._remember(record["id"], conversation_id)
+            full = len(self._pending) >= self.flush_size
+        if full:
+            self._wakeup.set()
+
+    def _remember(self, message_id: str, conversation_id: str):
+        self._conversations[message_id] = conversation_id
+        self._conversations.move_to_end(message_id)
+        while len(self._conversations) > self.flush_size * 100:
+            self._conversations.popitem(last=False)
+
+    def add(self, message_id: str, conversation_id: str, chat_type, query, response=None,
+            metadata: Dict = None, create_by: str = None):
+        fields = {"conversation_id": conversation_id, "chat_type": chat_type, "query": query,
+                  "response": response, "meta_data": metadata, "create_by": create_by,
+                  # 批量提交时同一事务内的 now() 相同，入队时记录时间以保持消息顺序
+                  "create_time": time.time()}
+        self._enqueue({"id": message_id, "new": True, "fields": fields, "meta": None}, conversation_id)
+
+    def update(self, message_id: str, response: str = None, metadata: Dict = None):
+        fields = {} if response is None else {"response": response}
+        meta = metadata if isinstance(metadata, dict) else None
+        self._enqueue({"id": message_id, "new": False, "fields": fields, "meta": meta})
+
+    def feedback(self, message_id: str, feedback_score, feedback_reason):
+        fields = {"feedback_score": feedback_score, "feedback_reason": feedback_reason}
+        self._enqueue({"id": message_id, "new": False, "fields": fields, "meta": None})
+
+    def has_pending(self, conversation_id: str = None, message_id: str = None) -> bool:
+        with self._lock:
+            if message_id is not None and message_id in self._pending:
+                return True
+            if conversation_id is not None:
+                # 无法确定所属会话的记录按相关处理
+                return any(self._conversations.get(k, conversation_id) == conversation_id for k in self._pending)
+            return False
+
+    def _related(self, conversation_id: str = None, message_id: str = None) -> List[str]:
+        # 调用方需持有 self._lock；无法确定所属会话的记录按相关处理
+        return [k for k in self._pending
+                if k == message_id
+                or (conversation_id is not None and self._conversations.get(k, conversation_id) == conversation_id)]
+
+    def _needs_flush(self, conversation_id: str = None, message_id: str = None) -> bool:
+        # 后台正在写入时，相关记录可能已经取出但尚未提交，同样需要等待
+        return self.enabled and (self._flush_lock.locked()
+                                 or self.has_pending(conversation_id=conversation_id, message_id=message_id))
+
+    def flush_pending(self, conversation_id: str = None, message_id: str = None):
+        '''
+        读取前调用：只写入该会话或消息的待写记录，其他会话的记录仍由后台批量提交
+        '''
+        if self._needs_flush(conversation_id=conversation_id, message_id=message_id):
+            self.flush(conversation_id=conversation_id, message_id=message_id)
+
+    async def aflush_pending(self, conversation_id: str = None, message_id: str = None):
+        if self._needs_flush(conversation_id=conversation_id, message_id=message_id):
+            await run_in_threadpool(self.flush, conversation_id=conversation_id, message_id=message_id)
+
+    def flush(self, conversation_id: str = None, message_id: str = None) -> bool:
+        '''
+        写入待写记录，返回是否全部成功。指定 conversation_id / message_id 时只写入相关的记录
+        '''
+        with self._flush_lock:
+            with self._lock:
+                if conversation_id is None and message_id is None:
+                    batch = self._pending
+                    self._pending = OrderedDict()
+                else:
+                    batch = OrderedDict((k, self._pending.pop(k))
+                                        for k in self._related(conversation_id, message_id))
+            records = list(batch.values())
+            for i in range(0, len(records), self.flush_size):
+                chunk = records[i: i + self.flush_size]
+                try:
+                    self._write(chunk)
+                except Exception as e:
+                    msg = f"批量写入聊天记录失败，{len(records) - i} 条记录将稍后重试：{e}"
+                    logger.error(f'{e.__class__.__name__}: {msg}',
+                                 exc_info=e if log_verbose else None)
+                    self._requeue(records[i:])
+                    return False
+            return True
+
+    def _requeue(self, records: List[Dict]):
+        # 写入失败的记录早于队列中的新记录，放在前面并与之合并
+        with self._lock:
+            pending = OrderedDict((r["id"], r) for r in records)
+            for k, r in self._pending.items():
+                pending[k] = _merge(pending[k], r) if k in pending else r
+            self._pending = pending
+
+    def _write(self, records: List[Dict]):
+        with session_scope() as session:
+            ids = [r["id"] for r in records]
+            existing = {m.id: m for m in session.query(MessageModel).filter(MessageModel.id.in_(ids))}
+            for r in records:
+                fields = dict(r["fields"])
+                if "create_time" in fields:
+                    fields["create_time"] = datetime.fromtimestamp(fields["create_time"])
+                m = existing.get(r["id"])
+                if m is None:
+                    if not r["new"]:
+                        # 与同步实现一致，更新不存在的记录时忽略
+                        continue
+                    m = MessageModel(id=r["id"], **fields)
+                    session.add(m)
+                    existing[m.id] = m
+                else:
+                    for k, v in fields.items():
+                        setattr(m, k, v)
+                if r["meta"] is not None:
+                    m.meta_data = _merge_meta(r["meta"], m.meta_data)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if not self.flush():
+                # 数据库不可用时退避，避免频繁重试
+                self._stop.wait(max(self.flush_interval, 1.0) * 5)
+
+    def _load_spool(self):
+        if not self.spool_path or not os.path.exists(self.spool_path):
+            return
+        try:
+            with open(self.spool_path, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            os.remove(self.spool_path)
+        except Exception as e:
+            msg = f"读取未写入的聊天记录 {self.spool_path} 失败：{e}"
+            logger.error(f'{e.__class__.__name__}: {msg}',
+                         exc_info=e if log_verbose else None)
+            return
+        for r in records:
+            old = self._pending.get(r["id"])
+            self._pending[r["id"]] = _merge(old, r) if old else r
+            if r["new"] and r["fields"].get("conversation_id"):
+                self._remember(r["id"], r["fields"]["conversation_id"])
+        logger.info(f"重新写入上次退出时未保存的 {len(records)} 条聊天记录")
+
+    def _save_spool(self):
+        with self._lock:
+            records = list(self._pending.values())
+            self._pending = OrderedDict()
+        if not records or not self.spool_path:
+            return
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            for r in records:
+                f.write(json.dumps(r, ensure_ascii=False, default=str) + "\n")
+        logger.warning(f"{len(records)} 条聊天记录未能写入数据库，已保存到 {self.spool_path}")
+
+    def shutdown(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join(timeout=10)
+        if not self.flush():
+            self._save_spool()
+
+
+message_writer = MessageWriter()
@@ -4,7 +4,7 @@ from sqlalchemy import func
 
 from server.db.models.assistant_model import AssistantModel
 from server.db.models.knowledge_base_model import KnowledgeBaseModel
-from server.db.session import with_session
+from server.db.session import with_session, with_async_session
 from server.memory.token_info_memory import get_token_info
 
 
@@ -103,3 +103,7 @@ def get_assistant_simple_from_db(session, assistant_id: int) -> dict:
         return {}
     data = assistant.dict()
     return data
+
+
+# 对话请求链路使用的异步版本，不阻塞事件循环
+aget_assistant_simple_from_db = with_async_session(get_assistant_simple_from_db)
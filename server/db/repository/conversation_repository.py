@@ -4,6 +4,7 @@ from sqlalchemy import func
 
 from server.db.models.conversation_model import ConversationModel
 from server.db.models.message_model import MessageModel
+from server.db.message_writer import message_writer
 from server.db.session import with_session
 from server.memory.token_info_memory import get_token_info
 
@@ -34,14 +35,26 @@ def update_conversation_to_db(session, name, conversation_id):
 
 
 @with_session
-def delete_conversation_from_db(session, conversation_id):
+def _delete_conversation_from_db(session, conversation_id):
     session.query(MessageModel).filter(MessageModel.conversation_id == conversation_id).delete()
     session.query(ConversationModel).filter(ConversationModel.id == conversation_id).delete()
     return conversation_id
 
 
+def delete_conversation_from_db(conversation_id):
+    # 先写入队列中的消息，避免删除后又被写入
+    message_writer.flush_pending(conversation_id=conversation_id)
+    return _delete_conversation_from_db(conversation_id)
+
+
+def delete_user_conversation_from_db(assistant_id: int):
+    if message_writer.enabled:
+        message_writer.flush()
+    return _delete_user_conversation_from_db(assistant_id)
+
+
 @with_session
-def delete_user_conversation_from_db(session, assistant_id: int):
+def _delete_user_conversation_from_db(session, assistant_id: int):
     userId = get_token_info().get("userId")
     if userId is None or userId == "":
         raise ValueError("You don't have permission to delete conversation")
@@ -1,12 +1,14 @@
 from sqlalchemy import func
 
 from server.db.models.knowledge_base_model import KnowledgeBaseModel
-from server.db.session import with_session
+from server.db.kb_metadata_cache import kb_metadata_cache, invalidates_kb
+from server.db.session import with_session, with_async_session
 from server.memory.message_i18n import Message_I18N
 from server.memory.token_info_memory import get_token_info
 from common.exceptions import ChatBusinessException
 
 
+@invalidates_kb(lambda kb_name, *args, **kwargs: kb_name)
 @with_session
 def add_kb_to_db(session, kb_name, kb_name_cn, kb_info, vs_type, embed_model):
     # 创建知识库实例
@@ -55,23 +57,31 @@ def list_kbs_from_db(session, page_size: int = 10, page_num: int = 1, keyword: s
     return kbs, total
 
 
-@with_session
-def kb_exists(session, kb_name):
-    kb = session.query(KnowledgeBaseModel).filter(KnowledgeBaseModel.kb_name == kb_name).first()
-    status = True if kb else False
+def kb_exists(kb_name):
+    status = True if get_kb_detail(kb_name) else False
     return status
 
 
-@with_session
-def load_kb_from_db(session, kb_name):
-    kb = session.query(KnowledgeBaseModel).filter(KnowledgeBaseModel.kb_name == kb_name).first()
+async def akb_exists(kb_name):
+    status = True if await aget_kb_detail(kb_name) else False
+    return status
+
+
+def _kb_tuple(kb: dict):
     if kb:
-        kb_name, vs_type, embed_model = kb.kb_name, kb.vs_type, kb.embed_model
-    else:
-        kb_name, vs_type, embed_model = None, None, None
-    return kb_name, vs_type, embed_model
+        return kb["kb_name"], kb["vs_type"], kb["embed_model"]
+    return None, None, None
+
+
+def load_kb_from_db(kb_name):
+    return _kb_tuple(get_kb_detail(kb_name))
+
+
+async def aload_kb_from_db(kb_name):
+    return _kb_tuple(await aget_kb_detail(kb_name))
 
 
+@invalidates_kb(lambda kb_name, *args, **kwargs: kb_name)
 @with_session
 def delete_kb_from_db(session, kb_name):
     kb = session.query(KnowledgeBaseModel).filter(KnowledgeBaseModel.kb_name == kb_name).first()
@@ -80,10 +90,31 @@ def delete_kb_from_db(session, kb_name):
     return True
 
 
+@invalidates_kb(lambda kb_name, *args, **kwargs: kb_name)
 @with_session
-def get_kb_detail(session, kb_name: str) -> dict:
+def update_kb_index_type(session, kb_name, index_type):
+    kb = session.query(KnowledgeBaseModel).filter(KnowledgeBaseModel.kb_name == kb_name).first()
+    if kb:
+        kb.index_type = index_type
+    return True
+
+
+@with_session
+def _get_kb_detail(session, kb_name: str) -> dict:
     kb: KnowledgeBaseModel = session.query(KnowledgeBaseModel).filter(KnowledgeBaseModel.kb_name == kb_name).first()
     if kb:
         return kb.dict()
     else:
         return {}
+
+
+_aget_kb_detail = with_async_session(_get_kb_detail)
+
+
+def get_kb_detail(kb_name: str) -> dict:
+    return kb_metadata_cache.get_kb(kb_name, lambda: _get_kb_detail(kb_name))
+
+
+async def aget_kb_detail(kb_name: str) -> dict:
+    # 命中缓存时不访问数据库
+    return await kb_metadata_cache.aget_kb(kb_name, lambda: _aget_kb_detail(kb_name))
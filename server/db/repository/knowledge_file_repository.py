@@ -8,6 +8,7 @@ from server.memory.token_info_memory import get_token_info
 from server.db.models.knowledge_base_model import KnowledgeBaseModel
 from server.db.models.knowledge_file_model import KnowledgeFileModel, FileDocModel
 from server.db.repository import get_kb_detail
+from server.db.kb_metadata_cache import kb_metadata_cache, invalidates_kb
 from server.db.session import with_session
 from server.knowledge_base.utils import KnowledgeFile
 
@@ -23,7 +24,7 @@ def list_file_doc_model_by_kb_name_and_file_name(session,
     列出某知识库某文件对应的所有Document
     '''
     kb = get_kb_detail(kb_name)
-    if kb is None:
+    if not kb:
         return None
     kb_id = kb["id"]
     filters = [FileDocModel.kb_id == kb_id]
@@ -59,10 +60,12 @@ def list_docs_from_db(session,
                       kb_name: str,
                       file_name: str = None,
                       metadata=None,
+                      with_chunk_hash: bool = False,
                       ) -> List[Dict]:
     '''
     列出某知识库某文件对应的所有Document。
     返回形式：[{"id": str, "metadata": dict}, ...]
+    文本块哈希 chunk_hash 只用于增量更新，with_chunk_hash=False 时不返回
     '''
     if metadata is None:
         metadata = {}
@@ -71,7 +74,10 @@ def list_docs_from_db(session,
                                                         metadata=metadata)
     if docs is None:
         return list()
-    return [{"id": x.doc_id, "metadata": x.meta_data} for x in docs.all()]
+    if with_chunk_hash:
+        return [{"id": x.doc_id, "metadata": x.meta_data} for x in docs.all()]
+    return [{"id": x.doc_id, "metadata": {k: v for k, v in (x.meta_data or {}).items() if k != "chunk_hash"}}
+            for x in docs.all()]
 
 
 @with_session
@@ -121,7 +127,7 @@ def add_docs_to_db(session,
 @with_session
 def count_files_from_db(session, kb_name: str) -> int:
     kb = get_kb_detail(kb_name)
-    if kb is None:
+    if not kb:
         return 0
     return session.query(func.count(KnowledgeFileModel.id)).filter(KnowledgeFileModel.kb_id == kb["id"]).scalar()
 
@@ -163,6 +169,7 @@ def list_files_from_db(session, kb_name,
         return docs, total
 
 
+@invalidates_kb(lambda kb_file, *args, **kwargs: kb_file.kb_name, files_only=True)
 @with_session
 def add_file_to_db(session,
                    kb_file: KnowledgeFile,
@@ -211,6 +218,57 @@ def add_file_to_db(session,
     return True
 
 
+@invalidates_kb(lambda kb_file, *args, **kwargs: kb_file.kb_name, files_only=True)
+@with_session
+def update_file_docs_in_db(session,
+                           kb_file: KnowledgeFile,
+                           docs_count: int,
+                           custom_docs: bool = False,
+                           deleted_ids: List[str] = [],
+                           doc_infos: List[Dict] = [],  # 形式：[{"id": str, "metadata": dict}, ...]
+                           updated_infos: List[Dict] = [],  # 形式：[{"id": str, "metadata": dict}, ...]
+                           ) -> bool:
+    '''
+    增量更新文件：只删除/添加变化的 Document 记录，文件信息原地更新。
+    updated_infos 中的 metadata 合并到已有记录（如保留的文本块的新位置）
+    '''
+    kb = session.query(KnowledgeBaseModel).filter_by(kb_name=kb_file.kb_name).first()
+    if kb is None:
+        return False
+    existing_file: KnowledgeFileModel = (session.query(KnowledgeFileModel)
+                                         .filter(KnowledgeFileModel.kb_id == kb.id,
+                                                 KnowledgeFileModel.file_name == kb_file.filename)
+                                         .first())
+    if existing_file is None:
+        return False
+
+    if deleted_ids:
+        (session.query(FileDocModel)
+         .filter(FileDocModel.kb_id == kb.id,
+                 FileDocModel.file_id == existing_file.id,
+                 FileDocModel.doc_id.in_(deleted_ids))
+         .delete(synchronize_session=False))
+    session.add_all([FileDocModel(kb_id=kb.id, file_id=existing_file.id, doc_id=d["id"], meta_data=d["metadata"])
+                     for d in doc_infos])
+    if updated_infos:
+        updates = {d["id"]: d["metadata"] for d in updated_infos}
+        for x in (session.query(FileDocModel)
+                  .filter(FileDocModel.kb_id == kb.id,
+                          FileDocModel.file_id == existing_file.id,
+                          FileDocModel.doc_id.in_(list(updates)))):
+            # JSON 列需要整体赋值才会被识别为修改
+            x.meta_data = {**(x.meta_data or {}), **updates[x.doc_id]}
+
+    existing_file.file_mtime = kb_file.get_mtime()
+    existing_file.file_size = kb_file.get_size()
+    existing_file.docs_count = docs_count
+    existing_file.custom_docs = custom_docs
+    existing_file.file_version += 1
+    session.commit()
+    return True
+
+
+@invalidates_kb(lambda kb_file, *args, **kwargs: kb_file.kb_name, files_only=True)
 @with_session
 def delete_file_from_db(session, kb_file: KnowledgeFile):
     kb = session.query(KnowledgeBaseModel).filter_by(kb_name=kb_file.kb_name).first()
@@ -229,6 +287,7 @@ def delete_file_from_db(session, kb_file: KnowledgeFile):
     return True
 
 
+@invalidates_kb(lambda knowledge_base_name, *args, **kwargs: knowledge_base_name, files_only=True)
 @with_session
 def delete_files_from_db(session, knowledge_base_name: str):
     kb = session.query(KnowledgeBaseModel).filter(KnowledgeBaseModel.kb_name == knowledge_base_name).first()
@@ -256,23 +315,19 @@ def file_exists_in_db(session, kb_file: KnowledgeFile):
     return True if existing_file else False
 
 
-@with_session
-def get_file_detail(session, kb_name: str, filename: str) -> dict:
-    kb = session.query(KnowledgeBaseModel).filter(KnowledgeBaseModel.kb_name == kb_name).first()
-    if kb is None:
-        return {}
-    file: KnowledgeFileModel = (session.query(KnowledgeFileModel)
-                                .filter(KnowledgeFileModel.file_name == filename,
-                                        KnowledgeFileModel.kb_id == kb.id)
-                                .first())
-    if file:
-        return file.dict()
-    else:
+def get_file_detail(kb_name: str, filename: str) -> dict:
+    kb = get_kb_detail(kb_name)
+    if not kb:
         return {}
+    return get_file_detail_by_kb_id(kb["id"], filename)
+
+
+def get_file_detail_by_kb_id(kb_id: int, filename: str) -> dict:
+    return kb_metadata_cache.get_file(kb_id, filename, lambda: _get_file_detail_by_kb_id(kb_id, filename))
 
 
 @with_session
-def get_file_detail_by_kb_id(session, kb_id: int, filename: str) -> dict:
+def _get_file_detail_by_kb_id(session, kb_id: int, filename: str) -> dict:
     file: KnowledgeFileModel = (session.query(KnowledgeFileModel)
                                 .filter(KnowledgeFileModel.file_name == filename,
                                         KnowledgeFileModel.kb_id == kb_id)
@@ -4,33 +4,56 @@ from typing import Dict
 from sqlalchemy import func
 
 from server.db.models.message_model import MessageModel
-from server.db.session import with_session
+from server.db.message_writer import message_writer
+from server.db.session import with_session, with_async_session
 from server.memory.token_info_memory import get_token_info
 
 
 @with_session
-def add_message_to_db(session, conversation_id: str, chat_type, query, response=None, message_id=None,
+def _insert_message(session, message_id: str, conversation_id: str, chat_type, query, response=None,
+                    metadata: Dict = {}, create_by: str = None):
+    m = MessageModel(id=message_id, chat_type=chat_type, query=query, response=response,
+                     conversation_id=conversation_id, create_by=create_by,
+                     meta_data=metadata)
+    session.add(m)
+    session.commit()
+    return m.id
+
+
+_ainsert_message = with_async_session(_insert_message)
+
+
+def add_message_to_db(conversation_id: str, chat_type, query, response=None, message_id=None,
                       metadata: Dict = {}, store: bool = True):
     """
-    新增聊天记录
+    新增聊天记录。开启 MESSAGE_WRITE_BEHIND 时只写入队列，由后台批量提交
     """
     if not message_id:
         message_id = uuid.uuid4().hex
     if not store:
         return message_id
-    m = MessageModel(id=message_id, chat_type=chat_type, query=query, response=response,
-                     conversation_id=conversation_id, create_by=get_token_info().get("userId"),
-                     meta_data=metadata)
-    session.add(m)
-    session.commit()
-    return m.id
+    create_by = get_token_info().get("userId")
+    if message_writer.enabled:
+        message_writer.add(message_id, conversation_id, chat_type, query, response, metadata, create_by)
+        return message_id
+    return _insert_message(message_id, conversation_id, chat_type, query, response, metadata, create_by)
+
+
+async def aadd_message_to_db(conversation_id: str, chat_type, query, response=None, message_id=None,
+                             metadata: Dict = {}, store: bool = True):
+    if not message_id:
+        message_id = uuid.uuid4().hex
+    if not store:
+        return message_id
+    create_by = get_token_info().get("userId")
+    if message_writer.enabled:
+        message_writer.add(message_id, conversation_id, chat_type, query, response, metadata, create_by)
+        return message_id
+    return await _ainsert_message(message_id, conversation_id, chat_type, query, response, metadata, create_by)
 
 
 @with_session
-def update_message(session, message_id, response: str = None, metadata: Dict = None):
-    """
-    更新已有的聊天记录
-    """
+def _update_message(session, message_id, response: str = None, metadata: Dict = None):
     m = session.query(MessageModel).filter_by(id=message_id).first()
     if m is not None:
         if response is not None:
@@ -44,22 +67,52 @@ def update_message(session, message_id, response: str = None, metadata: Dict = N
         return message_id
 
 
-@with_session
-def get_message_by_id(session, message_id) -> dict:
+_aupdate_message = with_async_session(_update_message)
+
+
+def update_message(message_id, response: str = None, metadata: Dict = None):
     """
-    查询聊天记录
+    更新已有的聊天记录
     """
+    if message_writer.enabled:
+        message_writer.update(message_id, response, metadata)
+        return message_id
+    return _update_message(message_id, response, metadata)
+
+
+async def aupdate_message(message_id, response: str = None, metadata: Dict = None):
+    if message_writer.enabled:
+        message_writer.update(message_id, response, metadata)
+        return message_id
+    return await _aupdate_message(message_id, response, metadata)
+
+
+@with_session
+def _get_message_by_id(session, message_id) -> dict:
     m = session.query(MessageModel).filter_by(id=message_id).first()
     if m is not None:
         return m.dict()
     return {}
 
 
-@with_session
-def feedback_message_to_db(session, message_id, feedback_score, feedback_reason):
+_aget_message_by_id = with_async_session(_get_message_by_id)
+
+
+def get_message_by_id(message_id) -> dict:
     """
-    反馈聊天记录
+    查询聊天记录
     """
+    message_writer.flush_pending(message_id=message_id)
+    return _get_message_by_id(message_id)
+
+
+async def aget_message_by_id(message_id) -> dict:
+    await message_writer.aflush_pending(message_id=message_id)
+    return await _aget_message_by_id(message_id)
+
+
+@with_session
+def _feedback_message_to_db(session, message_id, feedback_score, feedback_reason):
     m = session.query(MessageModel).filter_by(id=message_id).first()
     if m is not None:
         m.feedback_score = feedback_score
@@ -68,8 +121,18 @@ def feedback_message_to_db(session, message_id, feedback_score, feedback_reason)
         return m.id
 
 
+def feedback_message_to_db(message_id, feedback_score, feedback_reason):
+    """
+    反馈聊天记录
+    """
+    if message_writer.enabled:
+        message_writer.feedback(message_id, feedback_score, feedback_reason)
+        return message_id
+    return _feedback_message_to_db(message_id, feedback_score, feedback_reason)
+
+
 @with_session
-def filter_message(session, conversation_id: str, limit: int = 10):
+def _filter_message(session, conversation_id: str, limit: int = 10):
     # 用户最新的query 也会插入到db，忽略这个message record
     filters = [MessageModel.conversation_id == conversation_id, MessageModel.response.isnot(None)]
     messages = session.query(MessageModel).filter(*filters).order_by(MessageModel.create_time.desc()).limit(limit).all()
@@ -80,8 +143,22 @@ def filter_message(session, conversation_id: str, limit: int = 10):
     return data
 
 
+_afilter_message = with_async_session(_filter_message)
+
+
+def filter_message(conversation_id: str, limit: int = 10):
+    # 先写入该会话待写的记录，保证读到刚刚保存的消息
+    message_writer.flush_pending(conversation_id=conversation_id)
+    return _filter_message(conversation_id, limit)
+
+
+async def afilter_message(conversation_id: str, limit: int = 10):
+    await message_writer.aflush_pending(conversation_id=conversation_id)
+    return await _afilter_message(conversation_id, limit)
+
+
 @with_session
-def filter_message_page(session, conversation_id: str, page: int = 1, limit: int = 10):
+def _filter_message_page(session, conversation_id: str, page: int = 1, limit: int = 10):
     page_size = abs(limit)
     page_num = max(page, 1)
     offset = (page_num - 1) * page_size
@@ -97,7 +174,18 @@ def filter_message_page(session, conversation_id: str, page: int = 1, limit: int
     return data, total
 
 
+def filter_message_page(conversation_id: str, page: int = 1, limit: int = 10):
+    message_writer.flush_pending(conversation_id=conversation_id)
+    return _filter_message_page(conversation_id, page, limit)
+
+
 @with_session
-def delete_message_from_db(session, message_id):
+def _delete_message_from_db(session, message_id):
     session.query(MessageModel).filter(MessageModel.id == message_id).delete()
     return message_id
+
+
+def delete_message_from_db(message_id):
+    # 避免删除后队列中的记录又被写入
+    message_writer.flush_pending(message_id=message_id)
+    return _delete_message_from_db(message_id)
@@ -1,7 +1,9 @@
+import contextvars
 from functools import wraps
-from contextlib import contextmanager
-from server.db.base import SessionLocal
+from contextlib import contextmanager, asynccontextmanager
+from server.db.base import SessionLocal, AsyncSessionLocal
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 
 @contextmanager
@@ -33,6 +35,42 @@ def with_session(f):
     return wrapper
 
 
+@asynccontextmanager
+async def async_session_scope():
+    """session_scope 的异步版本，需要配置异步数据库引擎"""
+    session = AsyncSessionLocal()
+    try:
+        yield session
+        await session.commit()
+    except:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+def with_async_session(f):
+    """
+    将 with_session 装饰的同步数据库函数转换为异步函数，查询逻辑只需编写一份：
+    - 配置了异步引擎时，通过 AsyncSession.run_sync 在异步连接上执行原函数体，不阻塞事件循环；
+    - 否则在线程池中执行同步版本。
+    同步调用方（脚本、init_database.py 等）继续直接调用同步版本。
+    """
+    sync_f = getattr(f, "__wrapped__", f)
+    sync_wrapper = f if sync_f is not f else with_session(f)
+
+    @wraps(sync_f)
+    async def wrapper(*args, **kwargs):
+        if AsyncSessionLocal is None:
+            return await run_in_threadpool(sync_wrapper, *args, **kwargs)
+        # run_sync 在新的 greenlet 中执行，显式带上当前上下文（token 等 ContextVar）
+        ctx = contextvars.copy_context()
+        async with async_session_scope() as session:
+            return await session.run_sync(lambda s: ctx.run(sync_f, s, *args, **kwargs))
+
+    return wrapper
+
+
 def get_db() -> SessionLocal:
     db = SessionLocal()
     try:
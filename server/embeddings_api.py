@@ -2,28 +2,80 @@ from langchain.docstore.document import Document
 from configs import EMBEDDING_MODEL, logger
 from server.model_workers import QwenWorker
 from server.model_workers.base import ApiEmbeddingsParams
-from server.utils import BaseResponse, get_model_worker_config, list_embed_models, list_online_embed_models
+from server.utils import BaseResponse, embedding_device, get_model_worker_config, list_embed_models, list_online_embed_models
+from server.knowledge_base.kb_cache.embedding_cache import embedding_cache, chunk_embedding_store
 from fastapi import Body
 from fastapi.concurrency import run_in_threadpool
-from typing import Dict, List
+from functools import partial
+from typing import Dict, List, Optional
+import numpy as np
 
 online_embed_models = list_online_embed_models()
 
 
+def _as_array(embeddings) -> np.ndarray:
+    '''
+    向量统一为连续的 float32 二维数组。已经是该格式时不复制，由多个一维数组组成的列表合并为一个数组
+    '''
+    if isinstance(embeddings, np.ndarray) and embeddings.dtype == np.float32 and embeddings.flags.c_contiguous:
+        return embeddings
+    if len(embeddings) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+def _get_embed_cache(embed_model: str, to_query: bool, use_chunk_store: bool = False):
+    '''
+    知识库入库（use_chunk_store=True）的文档向量使用持久化的文本块向量存储（内容未变化的文本块复用向量）；
+    查询向量与在线API的向量化结果使用内存 LRU 缓存；
+    其他本地模型的文档向量（如 /other/embed_texts、文件对话）不缓存，避免挤占查询缓存
+    '''
+    if use_chunk_store and not to_query and chunk_embedding_store.enabled:
+        return chunk_embedding_store
+    if to_query or embed_model in list_online_embed_models():
+        return embedding_cache
+    return None
+
+
 def embed_texts(
         texts: List[str],
         embed_model: str = EMBEDDING_MODEL,
         to_query: bool = False,
+        use_chunk_store: bool = False,
 ) -> BaseResponse:
     '''
-    对文本进行向量化。返回数据格式：BaseResponse(data=List[List[float]])
+    对文本进行向量化。返回数据格式：BaseResponse(data=np.ndarray)，float32 二维数组，每行对应一条文本。
+    use_chunk_store 仅用于知识库入库，复用文本块向量存储中的向量
     '''
+    cache = _get_embed_cache(embed_model, to_query, use_chunk_store)
+    if cache is None:
+        return _embed_texts(texts=texts, embed_model=embed_model, to_query=to_query)
+
+    error = None
+
+    def embed_func(missing: List[str]) -> Optional[List[List[float]]]:
+        nonlocal error
+        resp = _embed_texts(texts=missing, embed_model=embed_model, to_query=to_query)
+        if resp.code != 200 or resp.data is None:
+            error = resp
+            return None
+        return resp.data
+
+    data = cache.embed(texts, embed_model, to_query, embed_func)
+    return error if data is None else BaseResponse(data=_as_array(data))
+
+
+def _embed_texts(
+        texts: List[str],
+        embed_model: str = EMBEDDING_MODEL,
+        to_query: bool = False,
+) -> BaseResponse:
     try:
         if embed_model in list_embed_models():  # 使用本地Embeddings模型
-            from server.utils import load_local_embeddings
+            from server.knowledge_base.kb_cache.embedding_batcher import get_embedding_batcher
 
-            embeddings = load_local_embeddings(model=embed_model)
-            return BaseResponse(data=embeddings.embed_documents(texts))
+            batcher = get_embedding_batcher(embed_model, embedding_device())
+            return BaseResponse(data=batcher.embed(texts, priority=to_query))
 
         if embed_model in list_online_embed_models():  # 使用在线API
             config = get_model_worker_config(embed_model)
@@ -32,8 +84,10 @@ def embed_texts(
             embed_model = config.get("embed_model")
             if worker.can_embedding():
                 params = ApiEmbeddingsParams(texts=texts, to_query=to_query, embed_model=embed_model)
-                resp = worker.do_embeddings(params)
-                return BaseResponse(**resp)
+                resp = BaseResponse(**worker.do_embeddings(params))
+                if resp.code == 200 and resp.data is not None:
+                    resp.data = _as_array(resp.data)
+                return resp
 
         return BaseResponse(code=500, msg=f"指定的模型 {embed_model} 不支持 Embeddings 功能。")
     except Exception as e:
@@ -45,22 +99,30 @@ async def aembed_texts(
     texts: List[str],
     embed_model: str = EMBEDDING_MODEL,
     to_query: bool = False,
+    use_chunk_store: bool = False,
 ) -> BaseResponse:
     '''
-    对文本进行向量化。返回数据格式：BaseResponse(data=List[List[float]])
+    对文本进行向量化。返回数据格式：BaseResponse(data=np.ndarray)
     '''
     try:
         if embed_model in list_embed_models(): # 使用本地Embeddings模型
-            from server.utils import load_local_embeddings
+            from server.knowledge_base.kb_cache.embedding_batcher import get_embedding_batcher
 
-            embeddings = load_local_embeddings(model=embed_model)
-            return BaseResponse(data=await embeddings.aembed_documents(texts))
+            # 与其他并发请求合并批量向量化，等待期间不占用线程
+            batcher = get_embedding_batcher(embed_model, embedding_device())
+            cache = _get_embed_cache(embed_model, to_query, use_chunk_store)
+            # 查询向量化优先于知识库入库
+            embed_func = partial(batcher.aembed, priority=to_query)
+            if cache is None:
+                return BaseResponse(data=await embed_func(texts))
+            return BaseResponse(data=_as_array(await cache.aembed(texts, embed_model, to_query, embed_func)))
 
         if embed_model in list_online_embed_models(): # 使用在线API
             return await run_in_threadpool(embed_texts,
                                            texts=texts,
                                            embed_model=embed_model,
-                                           to_query=to_query)
+                                           to_query=to_query,
+                                           use_chunk_store=use_chunk_store)
     except Exception as e:
         logger.error(e)
         return BaseResponse(code=500, msg=f"文本向量化过程中出现错误：{e}")
@@ -75,20 +137,25 @@ def embed_texts_endpoint(
     '''
     对文本进行向量化，返回 BaseResponse(data=List[List[float]])
     '''
-    return embed_texts(texts=texts, embed_model=embed_model, to_query=to_query)
+    resp = embed_texts(texts=texts, embed_model=embed_model, to_query=to_query)
+    if isinstance(resp.data, np.ndarray):
+        resp.data = resp.data.tolist()
+    return resp
 
 
 def embed_documents(
         docs: List[Document],
         embed_model: str = EMBEDDING_MODEL,
         to_query: bool = False,
+        use_chunk_store: bool = False,
 ) -> Dict:
     """
     将 List[Document] 向量化，转化为 VectorStore.add_embeddings 可以接受的参数
     """
     texts = [x.page_content for x in docs]
     metadatas = [x.metadata for x in docs]
-    embeddings = embed_texts(texts=texts, embed_model=embed_model, to_query=to_query).data
+    embeddings = embed_texts(texts=texts, embed_model=embed_model, to_query=to_query,
+                             use_chunk_store=use_chunk_store).data
     if embeddings is not None:
         return {
             "texts": texts,
@@ -0,0 +1,282 @@
+import hashlib
+import heapq
+import math
+import os
+import pickle
+import re
+import threading
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from langchain.docstore.document import Document
+
+from configs import BM25_K1, BM25_B, logger, log_verbose
+
+try:
+    import jieba
+    jieba.setLogLevel(60)
+except ImportError:
+    jieba = None
+
+
+# 产品型号、错误码等带连接符的编码整体作为一个词，如 err-1024、v1.2.3
+_CODE_RE = re.compile(r"[a-z0-9]+(?:[\-_./][a-z0-9]+)+")
+# 未安装 jieba 时的分词：连续的字母数字为一个词，汉字逐字切分
+_FALLBACK_RE = re.compile(r"[a-z0-9]+|[\u4e00-\u9fff]")
+_WORD_RE = re.compile(r"\w")
+
+
+def tokenize(text: str) -> List[str]:
+    '''
+    BM25 分词：jieba 搜索引擎模式分词，另外保留完整的编码类词语，去掉标点与空白
+    '''
+    text = text.lower()
+    if jieba is not None:
+        words = [w.strip() for w in jieba.lcut_for_search(text)]
+    else:
+        words = _FALLBACK_RE.findall(text)
+    tokens = [w for w in words if w and _WORD_RE.search(w)]
+    tokens.extend(_CODE_RE.findall(text))
+    return tokens
+
+
+def chunk_key(doc: Document) -> Tuple[str, str]:
+    '''
+    文本块的标识（来源文件 + 文本哈希），用于合并不同检索方式的结果。
+    部分向量库的 get_doc_by_ids 不按传入顺序返回，也据此将文档对应回 id
+    '''
+    source = str(doc.metadata.get("source", ""))
+    return source, hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+
+class BM25Index:
+    '''
+    知识库的 BM25 稀疏索引（倒排表），随文件增删增量更新，与向量库互为补充：
+    产品型号、错误码、专有名词等向量检索召回较差的查询可以通过关键词命中。
+    path 为 None 时仅在内存中使用（如对搜索引擎结果重新排序）。
+    complete 表示索引是否包含知识库的全部文本块，旧版本创建的知识库首次混合检索时重建。
+    '''
+
+    def __init__(self, path: str = None, k1: float = BM25_K1, b: float = BM25_B):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.complete = False
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._doc_len: Dict[str, int] = {}
+        self._doc_terms: Dict[str, List[str]] = {}
+        self._doc_keys: Dict[str, Tuple[str, str]] = {}
+        self._sources: Dict[str, Set[str]] = {}
+        self._total_len = 0
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._doc_len)
+
+    def add(self, ids: List[str], docs: List[Document]):
+        with self._lock:
+            for doc_id, doc in zip(ids, docs):
+                if doc_id in self._doc_len:
+                    self._remove(doc_id)
+                tf = Counter(tokenize(doc.page_content))
+                for term, n in tf.items():
+                    self._postings.setdefault(term, {})[doc_id] = n
+                length = sum(tf.values())
+                self._doc_len[doc_id] = length
+                self._doc_terms[doc_id] = list(tf)
+                self._doc_keys[doc_id] = chunk_key(doc)
+                self._sources.setdefault(self._doc_keys[doc_id][0], set()).add(doc_id)
+                self._total_len += length
+            self._dirty = True
+
+    def _remove(self, doc_id: str):
+        for term in self._doc_terms.pop(doc_id, []):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_len -= self._doc_len.pop(doc_id, 0)
+        source = self._doc_keys.pop(doc_id, ("", ""))[0]
+        ids = self._sources.get(source)
+        if ids is not None:
+            ids.discard(doc_id)
+            if not ids:
+                del self._sources[source]
+
+    def remove(self, ids: Iterable[str]):
+        with self._lock:
+            for doc_id in ids:
+                if doc_id in self._doc_len:
+                    self._remove(doc_id)
+                    self._dirty = True
+
+    def remove_source(self, source: str) -> List[str]:
+        '''
+        删除某个文件的全部文本块，与 FAISS 一致不区分大小写
+        '''
+        with self._lock:
+            source = source.lower()
+            ids = [x for s, v in self._sources.items() if s.lower() == source for x in v]
+            self.remove(ids)
+            return ids
+
+    def clear(self, complete: bool = True):
+        with self._lock:
+            self._postings.clear()
+            self._doc_len.clear()
+            self._doc_terms.clear()
+            self._doc_keys.clear()
+            self._sources.clear()
+            self._total_len = 0
+            self.complete = complete
+            self._dirty = True
+
+    def ensure_complete(self, load_docs: Callable[[], Tuple[List[str], List[Document]]]):
+        '''
+        索引不完整（旧版本创建的知识库）时，由 load_docs 读取知识库的全部文本块重建
+        '''
+        if self.complete:
+            return
+        with self._lock:
+            if self.complete:
+                return
+            ids, docs = load_docs()
+            self.clear(complete=True)
+            self.add(ids, docs)
+            self.save(force=True)
+            logger.info(f"已重建 BM25 索引 {self.path}，共 {len(ids)} 个文本块")
+
+    def key_of(self, doc_id: str) -> Optional[Tuple[str, str]]:
+        return self._doc_keys.get(doc_id)
+
+    def search(self, query: str, top_k: int) -> List[Tuple[str, float]]:
+        '''
+        返回 [(doc_id, BM25 分数), ...]，分数越大越相关
+        '''
+        with self._lock:
+            n = len(self._doc_len)
+            if not n:
+                return []
+            avg_len = self._total_len / n or 1
+            scores: Dict[str, float] = {}
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log((n - df + 0.5) / (df + 0.5) + 1)
+                for doc_id, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._doc_len[doc_id] / avg_len)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+            return heapq.nlargest(top_k, scores.items(), key=lambda x: x[1])
+
+    def save(self, force: bool = False):
+        if self.path is None or not (self._dirty or force):
+            return
+        with self._lock:
+            data = {"complete": self.complete, "postings": self._postings, "doc_len": self._doc_len,
+                    "doc_keys": self._doc_keys}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+    def load(self) -> bool:
+        if self.path is None or not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            msg = f"读取 BM25 索引 {self.path} 失败，将重新生成：{e}"
+            logger.error(f'{e.__class__.__name__}: {msg}',
+                         exc_info=e if log_verbose else None)
+            return False
+        with self._lock:
+            self.clear(complete=data["complete"])
+            self._postings = data["postings"]
+            self._doc_len = data["doc_len"]
+            self._doc_keys = data["doc_keys"]
+            # 文档的词语列表与来源文件由倒排表推导，不重复保存
+            for term, postings in self._postings.items():
+                for doc_id in postings:
+                    self._doc_terms.setdefault(doc_id, []).append(term)
+            for doc_id, key in self._doc_keys.items():
+                self._sources.setdefault(key[0], set()).add(doc_id)
+            self._total_len = sum(self._doc_len.values())
+            self._dirty = False
+        return True
+
+
+_indexes: Dict[str, BM25Index] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_bm25_path(kb_name: str) -> str:
+    from server.knowledge_base.utils import get_kb_path
+    return os.path.join(get_kb_path(kb_name), "bm25_index", "index.pkl")
+
+
+def get_bm25_index(kb_name: str) -> BM25Index:
+    '''
+    知识库的 BM25 索引，进程内各 KBService 实例共用，首次使用时从磁盘加载
+    '''
+    with _indexes_lock:
+        index = _indexes.get(kb_name)
+        if index is None:
+            index = BM25Index(get_bm25_path(kb_name))
+            index.load()
+            _indexes[kb_name] = index
+        return index
+
+
+def drop_bm25_index(kb_name: str):
+    with _indexes_lock:
+        _indexes.pop(kb_name, None)
+    path = get_bm25_path(kb_name)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def fuse_rankings(rankings: List[List[Tuple[Tuple, float]]],
+                  weights: List[float],
+                  method: str = "rrf",
+                  rrf_k: int = 60) -> List[Tuple[Tuple, float]]:
+    '''
+    融合多路检索结果。rankings 中每一路为按相关度降序排列的 [(key, 相关度), ...]，
+    weighted 方式要求相关度已换算到 [0, 1]。
+    返回按融合分数降序排列的 [(key, 距离)]，距离取值 [0, 1]，越小越相关（与向量检索的分数方向一致）
+    '''
+    fused: Dict[Tuple, float] = {}
+    if method == "weighted":
+        best = sum(weights)
+        for ranking, w in zip(rankings, weights):
+            for key, relevance in ranking:
+                fused[key] = fused.get(key, 0.0) + w * relevance
+    else:
+        best = sum(w / (rrf_k + 1) for w in weights)
+        for ranking, w in zip(rankings, weights):
+            for rank, (key, _) in enumerate(ranking):
+                fused[key] = fused.get(key, 0.0) + w / (rrf_k + rank + 1)
+    items = sorted(fused.items(), key=lambda x: x[1], reverse=True)
+    return [(key, 1 - score / best if best else 1.0) for key, score in items]
+
+
+def rerank_docs(query: str, docs: List[Document], top_k: int) -> List[Document]:
+    '''
+    用临时 BM25 索引对文档按关键词相关度重新排序，取前 top_k 个，命中的文档在 metadata["score"] 中记录 BM25 分数。
+    BM25 只返回包含查询词的文档，不足 top_k 时按原有顺序补充未命中的文档
+    '''
+    index = BM25Index()
+    index.add([str(i) for i in range(len(docs))], docs)
+    ranked = []
+    for i, score in index.search(query, top_k):
+        docs[int(i)].metadata["score"] = score
+        ranked.append(int(i))
+    hit = set(ranked)
+    ranked.extend([i for i in range(len(docs)) if i not in hit][:top_k - len(ranked)])
+    return [docs[i] for i in ranked]
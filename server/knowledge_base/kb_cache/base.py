@@ -1,12 +1,72 @@
 from langchain.embeddings.base import Embeddings
 from langchain.vectorstores.faiss import FAISS
 import threading
-from configs import (EMBEDDING_MODEL, CHUNK_SIZE,
+import time
+from configs import (EMBEDDING_MODEL, EMBEDDING_BACKEND, CHUNK_SIZE,
                      logger, log_verbose)
 from server.utils import embedding_device, get_model_path, list_online_embed_models
+from server.knowledge_base.kb_cache.onnx_embeddings import ONNX_BACKENDS
 from contextlib import contextmanager
 from collections import OrderedDict
-from typing import List, Any, Union, Tuple
+from typing import List, Any, Union, Tuple, Dict, Optional
+
+
+class RWLock:
+    '''
+    读写锁：允许多个读者并发，写者独占，写者优先（有写者等待时新的读者需要等待）。
+    同一线程可以重入读锁或写锁，持有写锁时也可以获取读锁；不支持读锁升级为写锁。
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers: Dict[int, int] = {}
+        self._writer = None
+        self._write_count = 0
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_count += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("不支持将读锁升级为写锁")
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._write_count = 1
+
+    def release_write(self):
+        with self._cond:
+            self._write_count -= 1
+            if self._write_count == 0:
+                self._writer = None
+                self._cond.notify_all()
 
 
 class ThreadSafeObject:
@@ -16,6 +76,11 @@ class ThreadSafeObject:
         self._pool = pool
         self._lock = threading.RLock()
         self._loaded = threading.Event()
+        self.load_failed = False
+        self._create_time = time.time()
+        self.load_seconds = 0.0
+        self.hits = 0
+        self.inflation = 0.0
 
     def __repr__(self) -> str:
         cls = type(self).__name__
@@ -25,27 +90,52 @@ class ThreadSafeObject:
     def key(self):
         return self._key
 
+    def _acquire_lock(self, shared: bool):
+        self._lock.acquire()
+
+    def _release_lock(self, shared: bool):
+        self._lock.release()
+
     @contextmanager
-    def acquire(self, owner: str = "", msg: str = "") -> FAISS:
+    def acquire(self, owner: str = "", msg: str = "", shared: bool = False) -> FAISS:
+        '''
+        shared=True 表示只读操作，子类可据此允许并发读取；默认独占。
+        '''
         owner = owner or f"thread {threading.get_native_id()}"
+        self._acquire_lock(shared)
         try:
-            self._lock.acquire()
             if self._pool is not None:
-                self._pool._cache.move_to_end(self.key)
+                self._pool._touch(self.key)
             if log_verbose:
                 logger.info(f"{owner} 开始操作：{self.key}。{msg}")
             yield self._obj
         finally:
             if log_verbose:
                 logger.info(f"{owner} 结束操作：{self.key}。{msg}")
-            self._lock.release()
+            self._release_lock(shared)
 
     def start_loading(self):
         self._loaded.clear()
 
     def finish_loading(self):
+        self.load_seconds = time.time() - self._create_time
+        self._loaded.set()
+        if self._pool is not None:
+            self._pool._on_loaded(self)
+
+    def fail_loading(self):
+        '''
+        加载失败：唤醒等待加载的线程，CachePool.get 不再返回该对象。调用方需先将其移出缓存
+        '''
+        self.load_failed = True
         self._loaded.set()
 
+    def nbytes(self) -> int:
+        '''
+        对象常驻内存的估计大小，用于按内存预算淘汰缓存。子类按需实现。
+        '''
+        return 0
+
     def wait_for_loading(self):
         self._loaded.wait()
 
@@ -59,22 +149,107 @@ class ThreadSafeObject:
 
 
 class CachePool:
-    def __init__(self, cache_num: int = -1):
+    def __init__(self, cache_num: int = -1, memory_budget: int = -1, pinned: List[str] = None):
+        '''
+        cache_num: 最多缓存的对象数量，<=0 表示不限制
+        memory_budget: 缓存对象总内存预算（字节），<=0 表示不限制。超出预算时按代价加权的 LRU/LFU（GDSF）淘汰：
+                       加载越慢、命中越多、占用越小的对象越晚被淘汰
+        pinned: 常驻缓存、永不淘汰的 key。key 为元组时匹配其第一个元素（如知识库名称）
+        '''
         self._cache_num = cache_num
+        self._memory_budget = memory_budget
+        self._pinned = set(pinned or [])
         self._cache = OrderedDict()
+        self._clock = 0.0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "loads": 0, "load_seconds": 0.0}
         self.atomic = threading.RLock()
 
     def keys(self) -> List[str]:
         return list(self._cache.keys())
 
-    def _check_count(self):
+    def is_pinned(self, key: Union[str, Tuple]) -> bool:
+        if key in self._pinned:
+            return True
+        return isinstance(key, tuple) and len(key) > 0 and key[0] in self._pinned
+
+    def nbytes(self) -> int:
+        return sum(v.nbytes() for v in list(self._cache.values()) if isinstance(v, ThreadSafeObject))
+
+    def _touch(self, key: Union[str, Tuple]):
+        if (cache := self._cache.get(key)) is not None:
+            self._cache.move_to_end(key)
+            if isinstance(cache, ThreadSafeObject):
+                cache.hits += 1
+                cache.inflation = self._clock
+
+    def _record_lookup(self, hit: bool):
+        self._stats["hits" if hit else "misses"] += 1
+
+    def _on_loaded(self, obj: ThreadSafeObject):
+        self._stats["loads"] += 1
+        self._stats["load_seconds"] += obj.load_seconds
+        with self.atomic:
+            self._check_count(keep=obj.key)
+
+    def _priority(self, obj: ThreadSafeObject) -> float:
+        cost = max(obj.load_seconds, 1e-3)
+        size = max(obj.nbytes(), 1)
+        return obj.inflation + (obj.hits + 1) * cost / size
+
+    def _evict(self, key: Union[str, Tuple], reason: str):
+        self._cache.pop(key, None)
+        self._stats["evictions"] += 1
+        logger.info(f"缓存淘汰 {key}（{reason}）")
+
+    def _check_count(self, keep: Union[str, Tuple] = None):
+        # 最近加入的对象正在被使用，不参与淘汰
+        candidates = [k for k in list(self._cache.keys())[:-1] if not self.is_pinned(k) and k != keep]
         if isinstance(self._cache_num, int) and self._cache_num > 0:
-            while len(self._cache) > self._cache_num:
-                self._cache.popitem(last=False)
+            while len(self._cache) > self._cache_num and candidates:
+                self._evict(candidates.pop(0), "超出数量限制")
+
+        if isinstance(self._memory_budget, int) and self._memory_budget > 0:
+            total = self.nbytes()
+            while total > self._memory_budget and candidates:
+                objs = {k: self._cache[k] for k in candidates if isinstance(self._cache.get(k), ThreadSafeObject)}
+                if not objs:
+                    break
+                victim = min(objs, key=lambda k: self._priority(objs[k]))
+                self._clock = self._priority(objs[victim])
+                total -= objs[victim].nbytes()
+                candidates.remove(victim)
+                self._evict(victim, "超出内存预算")
+
+    def stats(self) -> Dict:
+        '''
+        缓存统计信息：命中/未命中/淘汰/加载次数与耗时，以及各缓存对象的内存占用，便于调整内存预算
+        '''
+        lookups = self._stats["hits"] + self._stats["misses"]
+        items = []
+        for k, v in list(self._cache.items()):
+            if isinstance(v, ThreadSafeObject):
+                items.append({"key": str(k), "nbytes": v.nbytes(), "hits": v.hits,
+                              "load_seconds": round(v.load_seconds, 3), "pinned": self.is_pinned(k)})
+        return {
+            **self._stats,
+            "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+            "cache_num": self._cache_num,
+            "memory_budget": self._memory_budget,
+            "nbytes": sum(x["nbytes"] for x in items),
+            "items": items,
+        }
 
     def get(self, key: str) -> ThreadSafeObject:
         if cache := self._cache.get(key):
             cache.wait_for_loading()
+            if not cache.load_failed:
+                return cache
+
+    def get_loaded(self, key: str) -> Optional[ThreadSafeObject]:
+        '''
+        只返回已加载完成的对象，不等待正在加载的对象
+        '''
+        if (cache := self._cache.get(key)) is not None and cache._loaded.is_set():
             return cache
 
     def set(self, key: str, obj: ThreadSafeObject) -> ThreadSafeObject:
@@ -88,13 +263,12 @@ class CachePool:
         else:
             return self._cache.pop(key, None)
 
-    def acquire(self, key: Union[str, Tuple], owner: str = "", msg: str = ""):
+    def acquire(self, key: Union[str, Tuple], owner: str = "", msg: str = "", shared: bool = False):
         cache = self.get(key)
         if cache is None:
             raise RuntimeError(f"请求的资源 {key} 不存在")
         elif isinstance(cache, ThreadSafeObject):
-            self._cache.move_to_end(key)
-            return cache.acquire(owner=owner, msg=msg)
+            return cache.acquire(owner=owner, msg=msg, shared=shared)
         else:
             return cache
 
@@ -116,13 +290,28 @@ class CachePool:
             return embeddings_pool.load_embeddings(model=embed_model, device=embed_device)
 
 
+def _query_instruction(model: str) -> str:
+    if 'bge-' not in model or model == "bge-large-zh-noinstruct":  # bge large -noinstruct embedding
+        return ""
+    if 'zh' in model:
+        # for chinese model
+        return "为这个句子生成表示以用于检索相关文章："
+    elif 'en' in model:
+        # for english model
+        return "Represent this sentence for searching relevant passages:"
+    # maybe ReRanker or else, just use empty string instead
+    return ""
+
+
 class EmbeddingsPool(CachePool):
     def load_embeddings(self, model: str = None, device: str = None) -> Embeddings:
         self.atomic.acquire()
         model = model or EMBEDDING_MODEL
         device = embedding_device()
         key = (model, device)
-        if not self.get(key):
+        cache = self.get(key)
+        self._record_lookup(cache is not None)
+        if not cache:
             item = ThreadSafeObject(key, pool=self)
             self.set(key, item)
             with item.acquire(msg="初始化"):
@@ -132,22 +321,19 @@ class EmbeddingsPool(CachePool):
                     embeddings = OpenAIEmbeddings(model=model,
                                                   openai_api_key=get_model_path(model),
                                                   chunk_size=CHUNK_SIZE)
+                elif EMBEDDING_BACKEND.get(model, "torch") in ONNX_BACKENDS:
+                    from server.knowledge_base.kb_cache.onnx_embeddings import load_onnx_embeddings
+                    # 与 HuggingFaceBgeEmbeddings 一致，bge 模型的向量总是归一化
+                    embeddings = load_onnx_embeddings(model,
+                                                      model_path=get_model_path(model),
+                                                      backend=EMBEDDING_BACKEND[model],
+                                                      query_instruction=_query_instruction(model),
+                                                      normalize=True if 'bge-' in model else None)
                 elif 'bge-' in model:
                     from langchain.embeddings import HuggingFaceBgeEmbeddings
-                    if 'zh' in model:
-                        # for chinese model
-                        query_instruction = "为这个句子生成表示以用于检索相关文章："
-                    elif 'en' in model:
-                        # for english model
-                        query_instruction = "Represent this sentence for searching relevant passages:"
-                    else:
-                        # maybe ReRanker or else, just use empty string instead
-                        query_instruction = ""
                     embeddings = HuggingFaceBgeEmbeddings(model_name=get_model_path(model),
                                                           model_kwargs={'device': device},
-                                                          query_instruction=query_instruction)
-                    if model == "bge-large-zh-noinstruct":  # bge large -noinstruct embedding
-                        embeddings.query_instruction = ""
+                                                          query_instruction=_query_instruction(model))
                 else:
                     from langchain.embeddings.huggingface import HuggingFaceEmbeddings
                     embeddings = HuggingFaceEmbeddings(model_name=get_model_path(model),
@@ -156,7 +342,8 @@ class EmbeddingsPool(CachePool):
                 item.finish_loading()
         else:
             self.atomic.release()
-        return self.get(key).obj
+            item = cache
+        return item.obj
 
 
 embeddings_pool = EmbeddingsPool(cache_num=1)
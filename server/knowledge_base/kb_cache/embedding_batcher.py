@@ -0,0 +1,237 @@
+import asyncio
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from configs import EMBEDDING_BATCH_WAIT, EMBEDDING_MAX_BATCH_SIZE, logger, log_verbose
+from server.knowledge_base.kb_cache.base import embeddings_pool
+
+
+class _EmbedRequest:
+    def __init__(self, texts: List[str], loop: asyncio.AbstractEventLoop = None, priority: bool = False):
+        self.texts = texts
+        self.priority = priority
+        # 已取入批次的文本数、尚未完成向量化的文本数。大请求分多批处理
+        self.taken = 0
+        self.remaining = len(texts)
+        self.embeddings: Optional[np.ndarray] = None
+        self.error: Optional[Exception] = None
+        self.enqueued = time.time()
+        self.done = threading.Event()
+        # 异步调用方通过事件循环中的 future 等待，不占用线程
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+
+    def finish(self):
+        self.done.set()
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if self.future.done():
+            return
+        if self.error is not None:
+            self.future.set_exception(self.error)
+        else:
+            self.future.set_result(self.embeddings)
+
+
+def encode(embeddings, texts: List[str]) -> np.ndarray:
+    '''
+    向量化文本，返回 float32 二维数组。sentence-transformers 模型直接取 encode 的 numpy 结果，
+    不经过 embed_documents 中的 tolist 转换；其他模型的结果转换为数组（OnnxEmbeddings 已返回数组，不再复制）
+    '''
+    client = getattr(embeddings, "client", None)
+    if hasattr(client, "encode") and hasattr(embeddings, "encode_kwargs"):
+        # 与 HuggingFaceEmbeddings / HuggingFaceBgeEmbeddings.embed_documents 相同的预处理
+        texts = [t.replace("\n", " ") for t in texts]
+        kwargs = {"show_progress_bar": False, **embeddings.encode_kwargs, "convert_to_numpy": True}
+        return np.asarray(client.encode(texts, **kwargs), dtype=np.float32)
+    return np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+
+
+def text_lengths(embeddings, texts: List[str]) -> List[int]:
+    '''
+    文本长度，用于按长度排序分批。模型带有分词器（sentence-transformers 的 client.tokenizer、
+    OnnxEmbeddings.tokenizer）时按 token 数计算，否则以字符数近似
+    '''
+    tokenizer = getattr(embeddings, "tokenizer", None)
+    if tokenizer is None:
+        tokenizer = getattr(getattr(embeddings, "client", None), "tokenizer", None)
+    if callable(tokenizer):
+        try:
+            return [len(x) for x in tokenizer(texts, add_special_tokens=False, truncation=False)["input_ids"]]
+        except Exception as e:
+            msg = f"按分词器计算文本长度失败，改用字符数：{e}"
+            logger.warning(f'{e.__class__.__name__}: {msg}', exc_info=e if log_verbose else None)
+    return [len(t) for t in texts]
+
+
+class EmbeddingBatcher:
+    '''
+    本地 Embeddings 模型的动态批处理服务。每个模型一个后台线程：
+    - 并发请求的文本合并，凑满 max_batch_size 条或等待 batch_wait 秒后一起向量化；
+    - 每批最多 max_batch_size 条，超过的请求（如知识库入库）拆成多批；
+      查询请求（to_query）优先取入批次，不必排在大批量入库请求之后；
+    - 合并后的文本按长度（有分词器时为 token 数）排序再分批，同一批长度相近，减少 padding；
+    - 结果按原顺序分发给等待中的线程（embed）或协程（aembed）。
+    模型每批从 embeddings_pool 获取，不影响 embeddings_pool 的淘汰策略。
+    '''
+
+    def __init__(self,
+                 model: str,
+                 device: str,
+                 batch_wait: float = EMBEDDING_BATCH_WAIT,
+                 max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE):
+        self.model = model
+        self.device = device
+        self.batch_wait = batch_wait
+        self.max_batch_size = max(max_batch_size, 1)
+        self._queue: List[_EmbedRequest] = []
+        self._queries: List[_EmbedRequest] = []
+        self._queued_texts = 0
+        self._cond = threading.Condition()
+        self._stats = {"requests": 0, "query_requests": 0, "texts": 0, "batches": 0, "batched_texts": 0, "forward_passes": 0,
+                       "max_batch_texts": 0, "max_queue_depth": 0, "wait_seconds": 0.0, "embed_seconds": 0.0}
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _submit(self, request: _EmbedRequest):
+        with self._cond:
+            if request.priority:
+                self._queries.append(request)
+                self._stats["query_requests"] += 1
+            else:
+                self._queue.append(request)
+            self._queued_texts += len(request.texts)
+            self._stats["requests"] += 1
+            self._stats["texts"] += len(request.texts)
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queued_texts)
+            self._cond.notify()
+
+    def embed(self, texts: List[str], priority: bool = False) -> np.ndarray:
+        '''
+        向量化文本，返回 float32 二维数组，调用线程阻塞直到所在批次完成。
+        priority: 优先处理，用于查询向量化
+        '''
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        request = _EmbedRequest(texts, priority=priority)
+        self._submit(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.embeddings
+
+    async def aembed(self, texts: List[str], priority: bool = False) -> np.ndarray:
+        '''
+        embed 的异步版本
+        '''
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        request = _EmbedRequest(texts, loop=asyncio.get_running_loop(), priority=priority)
+        self._submit(request)
+        return await request.future
+
+    def _take_batch(self) -> List[Tuple[_EmbedRequest, int]]:
+        '''
+        取出一批最多 max_batch_size 条文本，返回 [(请求, 文本序号), ...]。先取查询请求，再按顺序取其他请求
+        '''
+        with self._cond:
+            while not self._queries and not self._queue:
+                self._cond.wait()
+            # 等待其他请求加入同一批次
+            deadline = time.time() + self.batch_wait
+            while self._queued_texts < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            items: List[Tuple[_EmbedRequest, int]] = []
+            for queue in (self._queries, self._queue):
+                while queue and len(items) < self.max_batch_size:
+                    request = queue[0]
+                    n = min(len(request.texts) - request.taken, self.max_batch_size - len(items))
+                    items.extend((request, i) for i in range(request.taken, request.taken + n))
+                    request.taken += n
+                    if request.taken == len(request.texts):
+                        queue.pop(0)
+            self._queued_texts -= len(items)
+            return items
+
+    def _loop(self):
+        while True:
+            items = self._take_batch()
+            counts: Dict[_EmbedRequest, int] = {}
+            for request, _ in items:
+                counts[request] = counts.get(request, 0) + 1
+            try:
+                self._embed(items)
+            except Exception as e:
+                msg = f"模型 {self.model} 向量化出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+                for request in counts:
+                    request.error = e
+            finally:
+                for request, n in counts.items():
+                    request.remaining -= n
+                    if request.remaining == 0:
+                        request.finish()
+
+    def _embed(self, items: List[Tuple[_EmbedRequest, int]]):
+        start = time.time()
+        embeddings = embeddings_pool.load_embeddings(model=self.model, device=self.device)
+        # 排队等待时间按请求的第一批计算
+        first = [r for r, i in items if i == 0]
+        # 按长度排序，同一前向批次中的文本长度相近
+        lengths = text_lengths(embeddings, [r.texts[i] for r, i in items])
+        items = [x for _, x in sorted(zip(lengths, items), key=lambda x: x[0])]
+        for n in range(0, len(items), self.max_batch_size):
+            chunk = items[n: n + self.max_batch_size]
+            vectors = encode(embeddings, [r.texts[i] for r, i in chunk])
+            for (r, i), vector in zip(chunk, vectors):
+                if r.embeddings is None:
+                    r.embeddings = np.empty((len(r.texts), vectors.shape[1]), dtype=np.float32)
+                r.embeddings[i] = vector
+            self._stats["forward_passes"] += 1
+        self._stats["batches"] += 1
+        self._stats["batched_texts"] += len(items)
+        self._stats["max_batch_texts"] = max(self._stats["max_batch_texts"], len(items))
+        self._stats["wait_seconds"] += sum(start - r.enqueued for r in first)
+        self._stats["embed_seconds"] += time.time() - start
+
+    def stats(self) -> Dict:
+        stats = self._stats
+        return {
+            **stats,
+            "wait_seconds": round(stats["wait_seconds"], 3),
+            "embed_seconds": round(stats["embed_seconds"], 3),
+            "avg_batch_texts": round(stats["batched_texts"] / stats["batches"], 2) if stats["batches"] else 0.0,
+            "queue_depth": self._queued_texts,
+            "queued_requests": len(self._queries) + len(self._queue),
+        }
+
+
+_batchers: Dict[Tuple[str, str], EmbeddingBatcher] = {}
+_batchers_lock = threading.Lock()
+
+
+def get_embedding_batcher(model: str, device: str) -> EmbeddingBatcher:
+    '''
+    取得本地 Embeddings 模型的批处理服务，同一进程内按 (模型, 设备) 共用
+    '''
+    key = (model, device)
+    with _batchers_lock:
+        batcher = _batchers.get(key)
+        if batcher is None:
+            batcher = EmbeddingBatcher(model, device)
+            _batchers[key] = batcher
+        return batcher
+
+
+def batcher_stats() -> Dict:
+    with _batchers_lock:
+        return {str(k): v.stats() for k, v in _batchers.items()}
@@ -0,0 +1,460 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+
+from configs import (EMBEDDING_BACKEND, EMBED_CACHE_SIZE, EMBED_CACHE_MEMORY, EMBED_CACHE_TTL, EMBED_CACHE_DB,
+                     CHUNK_EMBED_STORE_PATH, CHUNK_EMBED_STORE_MAX_ROWS, CHUNK_EMBED_STORE_TTL,
+                     logger, log_verbose)
+
+
+# 每个缓存条目除向量本身外的大致开销（键、时间戳、OrderedDict 节点）
+_ENTRY_OVERHEAD_BYTES = 200
+# sqlite 缓存中过期条目的清理间隔（秒）
+_PRUNE_INTERVAL = 600
+# 文本块向量存储中命中的条目，距上次使用超过此时间（秒）才更新使用时间，避免每次读取都写库
+_TOUCH_INTERVAL = 24 * 3600
+
+
+def model_key(embed_model: str) -> str:
+    '''
+    缓存键中的模型标识。不同推理后端（及量化）的输出有差异，非默认后端（torch）时附加后端名称，
+    如 "bge-large-zh-v1.5@onnx-int8"，切换后端后不会读到其他后端计算的向量
+    '''
+    backend = EMBEDDING_BACKEND.get(embed_model, "torch")
+    return embed_model if backend == "torch" else f"{embed_model}@{backend}"
+
+
+class EmbeddingCache:
+    '''
+    向量化结果缓存，键为 (嵌入模型及推理后端, 是否查询, 文本 sha1)。
+    内存中为有界 LRU，支持条目数、内存占用与过期时间限制；
+    可选的 sqlite 文件作为第二级缓存，多个进程可共享。
+    向量以 float32 保存，缓存的是模型原始输出（未归一化）。
+    '''
+
+    def __init__(self,
+                 max_size: int = 10000,
+                 max_bytes: int = -1,
+                 ttl: float = -1,
+                 db_path: Optional[str] = None):
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._cache: Dict[Tuple[str, bool, str], Tuple[np.ndarray, float]] = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "db_hits": 0, "evictions": 0, "expired": 0}
+        self._db_path = db_path
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._last_prune = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_size != 0
+
+    @staticmethod
+    def make_key(embed_model: str, to_query: bool, text: str) -> Tuple[str, bool, str]:
+        return model_key(embed_model), bool(to_query), hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self._ttl > 0 and now - created > self._ttl
+
+    def _get_db(self) -> Optional[sqlite3.Connection]:
+        if not self._db_path:
+            return None
+        if self._db is None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self._db_path)), exist_ok=True)
+                db = sqlite3.connect(self._db_path, timeout=5, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                           "(key TEXT PRIMARY KEY, vector BLOB, created REAL)")
+                db.execute("CREATE INDEX IF NOT EXISTS embeddings_created ON embeddings (created)")
+                db.commit()
+                self._db = db
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: 打开向量缓存文件 {self._db_path} 失败：{e}",
+                             exc_info=e if log_verbose else None)
+                self._db_path = None
+        return self._db
+
+    @staticmethod
+    def _db_key(key: Tuple[str, bool, str]) -> str:
+        return f"{key[0]}:{int(key[1])}:{key[2]}"
+
+    def _db_get_many(self, keys: List[Tuple[str, bool, str]]) -> Dict[Tuple[str, bool, str], Tuple[np.ndarray, float]]:
+        result = {}
+        if not keys:
+            return result
+        with self._db_lock:
+            db = self._get_db()
+            if db is None:
+                return result
+            db_keys = {self._db_key(k): k for k in keys}
+            names = list(db_keys)
+            try:
+                # sqlite 单条语句的参数个数有限，分批查询
+                for i in range(0, len(names), 500):
+                    batch = names[i: i + 500]
+                    sql = f"SELECT key, vector, created FROM embeddings WHERE key IN ({','.join('?' * len(batch))})"
+                    for k, v, created in db.execute(sql, batch):
+                        result[db_keys[k]] = (np.frombuffer(v, dtype=np.float32), created)
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: 读取向量缓存文件失败：{e}",
+                             exc_info=e if log_verbose else None)
+        return result
+
+    def _db_put_many(self, items: List[Tuple[Tuple[str, bool, str], np.ndarray, float]]):
+        if not items:
+            return
+        with self._db_lock:
+            db = self._get_db()
+            if db is None:
+                return
+            try:
+                db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                               [(self._db_key(k), v.tobytes(), created) for k, v, created in items])
+                now = time.time()
+                # 过期条目定期清理，读取时另外按 created 判断是否过期
+                if self._ttl > 0 and now - self._last_prune > _PRUNE_INTERVAL:
+                    db.execute("DELETE FROM embeddings WHERE created < ?", (now - self._ttl,))
+                    self._last_prune = now
+                db.commit()
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: 写入向量缓存文件失败：{e}",
+                             exc_info=e if log_verbose else None)
+
+    def _set(self, key: Tuple[str, bool, str], vector: np.ndarray, created: float):
+        # 调用方需持有 self._lock
+        if key in self._cache:
+            self._nbytes -= self._cache.pop(key)[0].nbytes + _ENTRY_OVERHEAD_BYTES
+        self._cache[key] = (vector, created)
+        self._nbytes += vector.nbytes + _ENTRY_OVERHEAD_BYTES
+        while self._cache and ((0 < self._max_size < len(self._cache))
+                               or (0 < self._max_bytes < self._nbytes)):
+            _, (v, _) = self._cache.popitem(last=False)
+            self._nbytes -= v.nbytes + _ENTRY_OVERHEAD_BYTES
+            self._stats["evictions"] += 1
+
+    def get_many(self, embed_model: str, to_query: bool, texts: List[str]) -> List[Optional[np.ndarray]]:
+        '''
+        查询缓存，返回与 texts 一一对应的向量，未命中的位置为 None
+        '''
+        keys = [self.make_key(embed_model, to_query, t) for t in texts]
+        result: List[Optional[np.ndarray]] = [None] * len(texts)
+        missing = []
+        now = time.time()
+        with self._lock:
+            for i, key in enumerate(keys):
+                item = self._cache.get(key)
+                if item is not None and self._expired(item[1], now):
+                    self._nbytes -= self._cache.pop(key)[0].nbytes + _ENTRY_OVERHEAD_BYTES
+                    self._stats["expired"] += 1
+                    item = None
+                if item is None:
+                    missing.append(i)
+                else:
+                    self._cache.move_to_end(key)
+                    result[i] = item[0]
+
+        if missing and self._db_path:
+            found = self._db_get_many([keys[i] for i in missing])
+            with self._lock:
+                for i in missing:
+                    item = found.get(keys[i])
+                    if item is not None and not self._expired(item[1], now):
+                        self._set(keys[i], item[0], item[1])
+                        result[i] = item[0]
+                        self._stats["db_hits"] += 1
+
+        with self._lock:
+            misses = sum(1 for x in result if x is None)
+            self._stats["misses"] += misses
+            self._stats["hits"] += len(result) - misses
+        return result
+
+    def put_many(self, embed_model: str, to_query: bool, texts: List[str], embeddings: List[List[float]]):
+        now = time.time()
+        # 复制每一行，缓存不引用（也不会被修改）整批向量的数组
+        items = [(self.make_key(embed_model, to_query, t), np.array(e, dtype=np.float32), now)
+                 for t, e in zip(texts, embeddings)]
+        with self._lock:
+            for key, vector, created in items:
+                self._set(key, vector, created)
+        self._db_put_many(items)
+
+    def embed(self,
+              texts: List[str],
+              embed_model: str,
+              to_query: bool,
+              embed_func: Callable[[List[str]], Optional[List[List[float]]]],
+              ) -> Optional[List[List[float]]]:
+        '''
+        先查缓存，只对未命中（且去重后）的文本调用 embed_func，结果写回缓存。
+        embed_func 返回 None 表示向量化失败，此时整体返回 None
+        '''
+        if not self.enabled or not texts:
+            return embed_func(texts)
+        result = self.get_many(embed_model, to_query, texts)
+        missing = list(dict.fromkeys(t for t, e in zip(texts, result) if e is None))
+        if missing:
+            embeddings = embed_func(missing)
+            if embeddings is None:
+                return None
+            self.put_many(embed_model, to_query, missing, embeddings)
+            computed = dict(zip(missing, embeddings))
+            result = [computed[t] if e is None else e for t, e in zip(texts, result)]
+        return result
+
+    async def aembed(self,
+                     texts: List[str],
+                     embed_model: str,
+                     to_query: bool,
+                     embed_func: Callable[[List[str]], Awaitable[Optional[List[List[float]]]]],
+                     ) -> Optional[List[List[float]]]:
+        '''
+        embed 的异步版本，embed_func 为协程函数。启用 sqlite 缓存时读写在线程池中执行，不阻塞事件循环
+        '''
+        if not self.enabled or not texts:
+            return await embed_func(texts)
+        if self._db_path:
+            result = await run_in_threadpool(self.get_many, embed_model, to_query, texts)
+        else:
+            result = self.get_many(embed_model, to_query, texts)
+        missing = list(dict.fromkeys(t for t, e in zip(texts, result) if e is None))
+        if missing:
+            embeddings = await embed_func(missing)
+            if embeddings is None:
+                return None
+            if self._db_path:
+                await run_in_threadpool(self.put_many, embed_model, to_query, missing, embeddings)
+            else:
+                self.put_many(embed_model, to_query, missing, embeddings)
+            computed = dict(zip(missing, embeddings))
+            result = [computed[t] if e is None else e for t, e in zip(texts, result)]
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._nbytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+                "size": len(self._cache),
+                "max_size": self._max_size,
+                "nbytes": self._nbytes,
+                "max_bytes": self._max_bytes,
+                "ttl": self._ttl,
+                "db_path": self._db_path,
+            }
+
+
+# 当前上下文（线程/协程）中正在统计的复用情况，见 ChunkEmbeddingStore.track
+_chunk_embed_report: ContextVar[Optional[Dict]] = ContextVar("chunk_embed_report", default=None)
+
+
+class ChunkEmbeddingStore:
+    '''
+    以内容寻址的文档向量持久化存储，键为 (嵌入模型及推理后端, 文本 sha256)。
+    重建知识库或重新入库文件时，内容未变化的文本块直接复用已有向量，不再调用模型。
+    只用于知识库入库（KBService._docs_to_embeddings），接口与 EmbeddingCache.embed/aembed 一致。
+    按最近使用时间定期淘汰：超过 ttl 秒未使用的条目删除，条目数超过 max_rows 时删除最久未使用的条目。
+    '''
+
+    def __init__(self, path: Optional[str], max_rows: int = -1, ttl: float = -1):
+        self._path = path
+        self._max_rows = max_rows
+        self._ttl = ttl
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self._stats = {"reused": 0, "computed": 0, "pruned": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._path)
+
+    def _get_db(self) -> Optional[sqlite3.Connection]:
+        if self._db is None and self._path:
+            try:
+                db = sqlite3.connect(self._path, timeout=30, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS chunk_embeddings "
+                           "(model TEXT, hash TEXT, vector BLOB, used REAL, PRIMARY KEY (model, hash))")
+                columns = [x[1] for x in db.execute("PRAGMA table_info(chunk_embeddings)")]
+                if "used" not in columns:
+                    # 旧版本创建的存储没有使用时间，已有条目按当前时间计
+                    db.execute("ALTER TABLE chunk_embeddings ADD COLUMN used REAL")
+                    db.execute("UPDATE chunk_embeddings SET used = ?", (time.time(),))
+                db.execute("CREATE INDEX IF NOT EXISTS chunk_embeddings_used ON chunk_embeddings (used)")
+                db.commit()
+                self._db = db
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: 打开文本块向量存储 {self._path} 失败：{e}",
+                             exc_info=e if log_verbose else None)
+                self._path = None
+        return self._db
+
+    @staticmethod
+    def make_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, embed_model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        hashes = [self.make_hash(t) for t in texts]
+        embed_model = model_key(embed_model)
+        found = {}
+        now = time.time()
+        with self._lock:
+            db = self._get_db()
+            if db is not None:
+                try:
+                    uniq = list(dict.fromkeys(hashes))
+                    stale = []
+                    for i in range(0, len(uniq), 500):
+                        batch = uniq[i: i + 500]
+                        sql = (f"SELECT hash, vector, used FROM chunk_embeddings "
+                               f"WHERE model = ? AND hash IN ({','.join('?' * len(batch))})")
+                        for h, v, used in db.execute(sql, [embed_model, *batch]):
+                            found[h] = np.frombuffer(v, dtype=np.float32)
+                            if (used or 0) < now - _TOUCH_INTERVAL:
+                                stale.append(h)
+                    if stale:
+                        db.executemany("UPDATE chunk_embeddings SET used = ? WHERE model = ? AND hash = ?",
+                                       [(now, embed_model, h) for h in stale])
+                        db.commit()
+                except Exception as e:
+                    logger.error(f"{e.__class__.__name__}: 读取文本块向量存储失败：{e}",
+                                 exc_info=e if log_verbose else None)
+        return [found.get(h) for h in hashes]
+
+    def put_many(self, embed_model: str, texts: List[str], embeddings: List[List[float]]):
+        embed_model = model_key(embed_model)
+        now = time.time()
+        with self._lock:
+            db = self._get_db()
+            if db is None:
+                return
+            try:
+                db.executemany("INSERT OR REPLACE INTO chunk_embeddings VALUES (?, ?, ?, ?)",
+                               [(embed_model, self.make_hash(t), np.asarray(e, dtype=np.float32).tobytes(), now)
+                                for t, e in zip(texts, embeddings)])
+                if now - self._last_prune > _PRUNE_INTERVAL:
+                    self._prune(db, now)
+                    self._last_prune = now
+                db.commit()
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: 写入文本块向量存储失败：{e}",
+                             exc_info=e if log_verbose else None)
+
+    def _prune(self, db: sqlite3.Connection, now: float):
+        # 调用方需持有 self._lock
+        pruned = 0
+        if self._ttl > 0:
+            pruned += db.execute("DELETE FROM chunk_embeddings WHERE used < ?", (now - self._ttl,)).rowcount
+        if self._max_rows > 0:
+            count = db.execute("SELECT COUNT(*) FROM chunk_embeddings").fetchone()[0]
+            if count > self._max_rows:
+                pruned += db.execute("DELETE FROM chunk_embeddings WHERE rowid IN "
+                                     "(SELECT rowid FROM chunk_embeddings ORDER BY used LIMIT ?)",
+                                     (count - self._max_rows,)).rowcount
+        self._stats["pruned"] += pruned
+
+    def _record(self, reused: int, computed: int):
+        with self._lock:
+            self._stats["reused"] += reused
+            self._stats["computed"] += computed
+        if (report := _chunk_embed_report.get()) is not None:
+            report["reused"] += reused
+            report["computed"] += computed
+
+    def _lookup(self, texts: List[str], embed_model: str) -> Tuple[List[Optional[List[float]]], List[str]]:
+        result = self.get_many(embed_model, texts)
+        missing = list(dict.fromkeys(t for t, e in zip(texts, result) if e is None))
+        return result, missing
+
+    def _merge(self, texts, result, missing, embeddings) -> List[List[float]]:
+        computed = dict(zip(missing, embeddings))
+        self._record(reused=len(texts) - sum(1 for e in result if e is None), computed=len(missing))
+        return [computed[t] if e is None else e for t, e in zip(texts, result)]
+
+    def embed(self,
+              texts: List[str],
+              embed_model: str,
+              to_query: bool,
+              embed_func: Callable[[List[str]], Optional[List[List[float]]]],
+              ) -> Optional[List[List[float]]]:
+        if not self.enabled or not texts:
+            return embed_func(texts)
+        result, missing = self._lookup(texts, embed_model)
+        embeddings = embed_func(missing) if missing else []
+        if embeddings is None:
+            return None
+        self.put_many(embed_model, missing, embeddings)
+        return self._merge(texts, result, missing, embeddings)
+
+    async def aembed(self,
+                     texts: List[str],
+                     embed_model: str,
+                     to_query: bool,
+                     embed_func: Callable[[List[str]], Awaitable[Optional[List[List[float]]]]],
+                     ) -> Optional[List[List[float]]]:
+        if not self.enabled or not texts:
+            return await embed_func(texts)
+        # sqlite 读写在线程池中执行，不阻塞事件循环
+        result, missing = await run_in_threadpool(self._lookup, texts, embed_model)
+        embeddings = (await embed_func(missing)) if missing else []
+        if embeddings is None:
+            return None
+        await run_in_threadpool(self.put_many, embed_model, missing, embeddings)
+        return self._merge(texts, result, missing, embeddings)
+
+    @contextmanager
+    def track(self):
+        '''
+        统计 with 块内（同一线程/协程）向量复用与重新计算的文本块数量：
+            with chunk_embedding_store.track() as report:
+                kb.add_doc(kb_file)
+            report -> {"reused": 10, "computed": 2}
+        '''
+        report = {"reused": 0, "computed": 0}
+        token = _chunk_embed_report.set(report)
+        try:
+            yield report
+        finally:
+            _chunk_embed_report.reset(token)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self._stats["reused"] + self._stats["computed"]
+            return {
+                **self._stats,
+                "reuse_rate": self._stats["reused"] / total if total else 0.0,
+                "path": self._path,
+                "max_rows": self._max_rows,
+                "ttl": self._ttl,
+            }
+
+
+embedding_cache = EmbeddingCache(max_size=EMBED_CACHE_SIZE,
+                                 max_bytes=EMBED_CACHE_MEMORY * 1024 * 1024 if EMBED_CACHE_MEMORY > 0 else -1,
+                                 ttl=EMBED_CACHE_TTL,
+                                 db_path=EMBED_CACHE_DB)
+
+chunk_embedding_store = ChunkEmbeddingStore(CHUNK_EMBED_STORE_PATH,
+                                            max_rows=CHUNK_EMBED_STORE_MAX_ROWS,
+                                            ttl=CHUNK_EMBED_STORE_TTL)
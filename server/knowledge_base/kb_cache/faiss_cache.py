@@ -1,13 +1,29 @@
-from configs import CACHED_VS_NUM, CACHED_MEMO_VS_NUM
+from configs import (CACHED_VS_NUM, CACHED_MEMO_VS_NUM, CACHED_VS_MEMORY, CACHED_VS_PINNED, FAISS_LOAD_MODE,
+                     FAISS_COMPACT_DOCSTORE, FAISS_DELTA_LOG)
 from server.knowledge_base.kb_cache.base import *
+from server.knowledge_base.kb_cache.faiss_delta_log import FaissDeltaLog, commit_files, recover_commit
+from server.knowledge_base.kb_cache.faiss_docstore import (SqliteDocDict, CompactDocDict, DocIdArray, make_compact,
+                                                           write_docstore_db, DOCSTORE_DB_NAME)
+from server.knowledge_base.kb_cache.faiss_index import (Tombstones, apply_search_params, describe_index,
+                                                        get_tombstones, is_flat, rebuild_index, remove_positions)
+from server.knowledge_base.kb_cache.faiss_shards import shard_path
+from server.knowledge_base.kb_cache.faiss_metadata_index import (FaissMetadataIndex, get_metadata_index,
+                                                                 METADATA_INDEX_NAME)
 from server.knowledge_base.kb_service.base import EmbeddingsFunAdapter
 from server.utils import load_local_embeddings
 from server.knowledge_base.utils import get_vs_path
 from langchain.vectorstores.faiss import FAISS
 from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
+import copy
+import faiss
+import numpy as np
 import os
-from langchain.schema import Document
+import pickle
+import sys
+import time
+import uuid
+from typing import Callable, Optional
 
 
 # patch FAISS to include doc id in Document.metadata
@@ -22,7 +38,285 @@ def _new_ds_search(self, search: str) -> Union[str, Document]:
 InMemoryDocstore.search = _new_ds_search
 
 
+# patch InMemoryDocstore.add：原实现将 _dict 替换为合并后的普通 dict，CompactDocDict 等紧凑格式会被丢弃。
+# FAISS.add_texts / add_documents 经由此方法写入，这里改为逐条写入原字典
+def _new_ds_add(self, texts: Dict[str, Document]) -> None:
+    overlapping = [k for k in texts if k in self._dict]
+    if overlapping:
+        raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+    for k, v in texts.items():
+        self._dict[k] = v
+InMemoryDocstore.add = _new_ds_add
+
+
+def compact_vector_store(vector_store: FAISS):
+    '''
+    开启 FAISS_COMPACT_DOCSTORE 时将文档与向量序号映射转换为紧凑格式（见 CompactDocDict）
+    '''
+    if FAISS_COMPACT_DOCSTORE and not isinstance(vector_store.docstore._dict, SqliteDocDict):
+        docs, index_to_docstore_id = make_compact(vector_store.docstore._dict, vector_store.index_to_docstore_id)
+        vector_store.docstore._dict = docs
+        vector_store.index_to_docstore_id = index_to_docstore_id
+
+
+def _make_id_map(ids: List[str]) -> Dict[int, str]:
+    return DocIdArray(ids) if FAISS_COMPACT_DOCSTORE else dict(enumerate(ids))
+
+
+def save_faiss_local(vector_store: FAISS, path: str, delta_log: FaissDeltaLog = None):
+    '''
+    保存 FAISS 向量库，与 FAISS.save_local 生成相同的 index.faiss/index.pkl。
+    先写临时文件，再经 commit_files 整体原子替换，保存中途崩溃不会留下不一致的文件，
+    其它进程对旧文件的内存映射也不受影响；mmap 模式下同时生成可随机读取的 docstore.db。
+    metadata 倒排索引保存为 metadata_index.pkl。
+    传入 delta_log 时一并记录已合并的日志序号，并删除已合并的段文件。
+    '''
+    import faiss
+
+    os.makedirs(path, exist_ok=True)
+    index_file = os.path.join(path, "index.faiss")
+    pkl_file = os.path.join(path, "index.pkl")
+    meta_file = os.path.join(path, METADATA_INDEX_NAME)
+    suffix = f".{os.getpid()}.tmp"
+    docstore, index_to_docstore_id = vector_store.docstore, vector_store.index_to_docstore_id
+    if FAISS_COMPACT_DOCSTORE and isinstance(docstore._dict, SqliteDocDict):
+        # mmap 模式下 index.pkl 同样保存为紧凑格式
+        docs, index_to_docstore_id = make_compact(docstore._dict, index_to_docstore_id)
+        docstore = InMemoryDocstore(docs)
+    faiss.write_index(vector_store.index, index_file + suffix)
+    with open(pkl_file + suffix, "wb") as f:
+        pickle.dump((docstore, index_to_docstore_id), f)
+    # 在 index.pkl 之后写入，加载时据修改时间判断索引是否与文档一致
+    get_metadata_index(vector_store).save(meta_file + suffix)
+    files = [(os.path.basename(x) + suffix, os.path.basename(x)) for x in [index_file, pkl_file, meta_file]]
+    seq = None
+    if delta_log is not None:
+        seq, base_file = delta_log.prepare_base(suffix)
+        files.append(base_file)
+    commit_files(path, files)
+    if seq is not None:
+        delta_log.truncate(seq)
+    if FAISS_LOAD_MODE == "mmap":
+        write_docstore_db(os.path.join(path, DOCSTORE_DB_NAME),
+                          vector_store.docstore._dict,
+                          vector_store.index_to_docstore_id)
+
+
+def load_faiss_local(path: str, embeddings: Embeddings) -> Tuple[FAISS, bool]:
+    '''
+    从磁盘加载 FAISS 向量库，返回 (vector_store, 是否为内存映射加载)。
+    mmap 模式下索引以只读内存映射方式打开，文档从 docstore.db 按需读取，避免每次加载都反序列化整个 index.pkl。
+    增量日志不在这里重放，见 replay_delta_log
+    '''
+    recover_commit(path)
+    if FAISS_LOAD_MODE != "mmap":
+        vector_store = FAISS.load_local(path, embeddings, distance_strategy="METRIC_INNER_PRODUCT")
+        # 旧版本保存的 index.pkl 为 Document 字典，加载后转换，下次保存时写入紧凑格式
+        compact_vector_store(vector_store)
+        apply_search_params(vector_store.index)
+        _load_metadata_index(vector_store, path)
+        return vector_store, False
+
+    import faiss
+
+    index_file = os.path.join(path, "index.faiss")
+    pkl_file = os.path.join(path, "index.pkl")
+    db_file = os.path.join(path, DOCSTORE_DB_NAME)
+    if not os.path.isfile(db_file) or os.path.getmtime(db_file) < os.path.getmtime(pkl_file):
+        # 旧版本保存的向量库，首次加载时生成 docstore.db
+        with open(pkl_file, "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        write_docstore_db(db_file, docstore._dict, index_to_docstore_id)
+        del docstore
+
+    # faiss>=1.9 中 IO_FLAG_MMAP_IFC 才会映射 Flat 索引的向量数据，旧版本仅 IVF 倒排表生效
+    io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    index = faiss.read_index(index_file, io_flags)
+    doc_dict = SqliteDocDict(db_file)
+    vector_store = FAISS(embeddings,
+                         index,
+                         InMemoryDocstore(doc_dict),
+                         doc_dict.load_index_to_docstore_id(),
+                         distance_strategy="METRIC_INNER_PRODUCT")
+    apply_search_params(vector_store.index)
+    _load_metadata_index(vector_store, path)
+    return vector_store, True
+
+
+def _load_metadata_index(vector_store: FAISS, path: str):
+    # 旧版本保存的向量库没有 metadata 索引，或索引早于 index.pkl 时，首次使用时重新生成
+    meta_file = os.path.join(path, METADATA_INDEX_NAME)
+    pkl_file = os.path.join(path, "index.pkl")
+    if os.path.isfile(meta_file) and os.path.getmtime(meta_file) >= os.path.getmtime(pkl_file):
+        index = FaissMetadataIndex.load(meta_file)
+        if index is not None:
+            vector_store.metadata_index = index
+
+
+def add_embeddings(vector_store: FAISS,
+                   texts: List[str],
+                   embeddings: np.ndarray,
+                   metadatas: List[Dict],
+                   ids: List[str] = None) -> List[str]:
+    '''
+    向向量库添加文档并同步更新 metadata 索引。
+    与 FAISS.add_embeddings 的结果相同，但 float32 二维数组直接写入索引，不再逐行拆分为 (文本, 向量) 再合并
+    '''
+    index = get_metadata_index(vector_store)
+    vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if vectors.shape[0] != len(texts):
+        raise ValueError(f"文本数量 {len(texts)} 与向量数量 {vectors.shape[0]} 不一致")
+    if vector_store._normalize_L2:
+        faiss.normalize_L2(vectors)
+    metadatas = metadatas or [{} for _ in texts]
+    ids = ids or [str(uuid.uuid4()) for _ in texts]
+    docs = [Document(page_content=t, metadata=m) for t, m in zip(texts, metadatas)]
+    doc_dict = vector_store.docstore._dict
+    if len(set(ids)) != len(ids) or any(x in doc_dict for x in ids):
+        raise ValueError("添加的文档 id 重复或已存在")
+    start = len(vector_store.index_to_docstore_id)
+    vector_store.index.add(vectors)
+    # 直接写入 _dict：InMemoryDocstore.add 会遍历全部文档检查重复，并将 _dict 替换为普通 dict
+    for doc_id, doc in zip(ids, docs):
+        doc_dict[doc_id] = doc
+    for i, doc_id in enumerate(ids):
+        vector_store.index_to_docstore_id[start + i] = doc_id
+    index.add(ids, metadatas)
+    return ids
+
+
+def delete_docs(vector_store: FAISS, ids: List[str]) -> List[str]:
+    '''
+    从向量库删除文档并同步更新 metadata 索引，返回实际删除的 id，不存在的 id 忽略。
+    与 FAISS.delete 的结果相同，但用集合判断被删除的序号，批量删除不再是 O(总数 * 删除数)。
+    Flat 索引直接删除向量；HNSW/IVF 索引只标记删除（见 Tombstones），不在写锁内重建索引
+    '''
+    doc_dict = vector_store.docstore._dict
+    ids = [x for x in dict.fromkeys(ids) if x in doc_dict]
+    if not ids:
+        return []
+    get_metadata_index(vector_store).remove(ids, doc_dict)
+    reversed_index = {doc_id: pos for pos, doc_id in vector_store.index_to_docstore_id.items()}
+    positions = {reversed_index[x] for x in ids if x in reversed_index}
+    for doc_id in ids:
+        del doc_dict[doc_id]
+    if is_flat(vector_store.index):
+        vector_store.index = remove_positions(vector_store.index, sorted(positions))
+        remaining = [doc_id for pos, doc_id in sorted(vector_store.index_to_docstore_id.items())
+                     if pos not in positions]
+        vector_store.index_to_docstore_id = _make_id_map(remaining)
+    else:
+        for pos in positions:
+            vector_store.index_to_docstore_id[pos] = None
+        get_tombstones(vector_store).add(positions)
+    return ids
+
+
+def update_metadata(vector_store: FAISS, metadatas: Dict[str, Dict]) -> List[str]:
+    '''
+    原地修改文档的部分 metadata（{doc_id: {key: value}}，与原 metadata 合并）并同步更新 metadata 索引，
+    返回实际修改的 id。文档对象可能被 copy_vector_store 的副本共享，替换为新对象而不是原地修改
+    '''
+    doc_dict = vector_store.docstore._dict
+    ids = [x for x in metadatas if x in doc_dict]
+    if not ids:
+        return []
+    index = get_metadata_index(vector_store)
+    index.remove(ids, doc_dict)
+    new_metadatas = []
+    for doc_id in ids:
+        doc = doc_dict[doc_id]
+        metadata = {**doc.metadata, **metadatas[doc_id]}
+        doc_dict[doc_id] = Document(page_content=doc.page_content, metadata=metadata)
+        new_metadatas.append(metadata)
+    index.add(ids, new_metadatas)
+    return ids
+
+
+def replay_delta_log(vector_store: FAISS, delta_log: FaissDeltaLog, before_write: Callable[[], None] = None) -> int:
+    '''
+    在基础索引上按顺序重放增量日志，返回重放的记录数。
+    before_write 在第一次需要修改索引（新增向量、删除 Flat 索引中的向量）之前调用，用于将只读的索引转为可写；
+    更新 metadata、HNSW/IVF 标记删除只修改文档与序号映射，不需要可写的索引
+    '''
+    count = 0
+    doc_dict = vector_store.docstore._dict
+    for seq, record in delta_log.records():
+        if record["op"] == "add":
+            keep = [i for i, x in enumerate(record["ids"]) if x not in doc_dict]
+            if keep:
+                if before_write is not None:
+                    before_write()
+                add_embeddings(vector_store,
+                               [record["texts"][i] for i in keep],
+                               record["embeddings"][keep],
+                               [record["metadatas"][i] for i in keep],
+                               ids=[record["ids"][i] for i in keep])
+        elif record["op"] == "delete":
+            if (before_write is not None and is_flat(vector_store.index)
+                    and any(x in doc_dict for x in record["ids"])):
+                before_write()
+            delete_docs(vector_store, record["ids"])
+        elif record["op"] == "update":
+            update_metadata(vector_store, record["metadatas"])
+        count += 1
+    return count
+
+
+# 每个文档除文本外的对象开销估计（Document、metadata dict、id 映射等）
+_DOC_OVERHEAD_BYTES = 600
+
+
+def copy_vector_store(vector_store: FAISS) -> FAISS:
+    '''
+    复制一份可独立修改的向量库：索引深拷贝，文档对象本身共享（写入只会增删文档，不会原地修改）
+    '''
+    import faiss
+
+    new_vs = copy.copy(vector_store)
+    new_vs.index = faiss.clone_index(vector_store.index)
+    new_vs.docstore = InMemoryDocstore(vector_store.docstore._dict.copy())
+    new_vs.index_to_docstore_id = vector_store.index_to_docstore_id.copy()
+    new_vs.metadata_index = get_metadata_index(vector_store).copy()
+    new_vs.tombstones = get_tombstones(vector_store).copy()
+    return new_vs
+
+
 class ThreadSafeFaiss(ThreadSafeObject):
+    '''
+    使用读写锁：检索等只读操作（acquire(shared=True)）可以并发执行，增删文档时独占。
+    写者之间另用一把互斥锁串行化，以便 copy_on_write 在复制与修改期间不阻塞读者。
+    知识库向量库带有增量日志（delta_log），增删文档后由 log_add / log_delete 记录，flush 按需在后台合并。
+    '''
+    mmapped: bool = False
+    delta_log: Optional[FaissDeltaLog] = None
+    _nbytes_cache: Tuple[int, int] = (-1, 0)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._rwlock = RWLock()
+        self._write_mutex = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._compacting = False
+
+    def _acquire_lock(self, shared: bool):
+        if shared:
+            self._rwlock.acquire_read()
+        else:
+            self._write_mutex.acquire()
+            try:
+                self._rwlock.acquire_write()
+            except Exception:
+                self._write_mutex.release()
+                raise
+
+    def _release_lock(self, shared: bool):
+        if shared:
+            self._rwlock.release_read()
+        else:
+            self._rwlock.release_write()
+            self._write_mutex.release()
+
     def __repr__(self) -> str:
         cls = type(self).__name__
         return f"<{cls}: key: {self.key}, obj: {self._obj}, docs_count: {self.docs_count()}>"
@@ -30,21 +324,198 @@ class ThreadSafeFaiss(ThreadSafeObject):
     def docs_count(self) -> int:
         return len(self._obj.docstore._dict)
 
+    def nbytes(self) -> int:
+        '''
+        估计常驻内存：向量数据 + 文档。内存映射的索引由系统页缓存承担，不计入；
+        按需读取的 docstore 只计算内存中新增的文档。结果按向量数量缓存，避免每次淘汰检查都遍历文档。
+        '''
+        if self._obj is None:
+            return 0
+        index = self._obj.index
+        ntotal = index.ntotal
+        if self._nbytes_cache[0] == ntotal:
+            return self._nbytes_cache[1]
+
+        size = 0 if self.mmapped else ntotal * getattr(index, "code_size", index.d * 4)
+        doc_dict = self._obj.docstore._dict
+        if isinstance(doc_dict, CompactDocDict):
+            size += doc_dict.nbytes()
+            self._nbytes_cache = (ntotal, size)
+            return size
+        docs = doc_dict._added.values() if isinstance(doc_dict, SqliteDocDict) else doc_dict.values()
+        for doc in list(docs):
+            size += sys.getsizeof(doc.page_content) + _DOC_OVERHEAD_BYTES
+        self._nbytes_cache = (ntotal, size)
+        return size
+
+    def load(self, path: str, embeddings: Embeddings):
+        '''
+        从磁盘加载向量库并重放增量日志，需要在持有锁时调用。
+        mmap 模式下只有重放需要修改索引时才复制出可写的索引，此时重放后立即合并进基础索引，
+        并重新以内存映射方式打开，之后再加载时没有待重放的日志，不必每次都将索引复制到内存中。
+        增量日志损坏时重放中止并抛出异常，不保存、不合并只重放了一部分的向量库，磁盘上的基础索引与日志保持不变
+        '''
+        self._obj, self.mmapped = load_faiss_local(path, embeddings)
+        self.delta_log = FaissDeltaLog(path)
+        if not self.delta_log.pending():
+            return
+        mmapped = self.mmapped
+        count = replay_delta_log(self._obj, self.delta_log, before_write=self.ensure_writable)
+        logger.info(f"向量库 {path} 已重放 {count} 条增量日志")
+        if mmapped and not self.mmapped:
+            self.save(path)
+            doc_dict = self._obj.docstore._dict
+            self._obj, self.mmapped = load_faiss_local(path, embeddings)
+            if isinstance(doc_dict, SqliteDocDict):
+                doc_dict.close()
+        elif self.delta_log.needs_compaction():
+            self.compact_async(path)
+
+    def ensure_writable(self):
+        '''
+        内存映射加载的索引是只读的，写入前复制一份到进程内存中。需要在持有锁时调用。
+        '''
+        if self.mmapped:
+            import faiss
+            self._obj.index = faiss.clone_index(self._obj.index)
+            self.mmapped = False
+            logger.info(f"向量库 {self.key} 由内存映射转为可写")
+
+    @contextmanager
+    def copy_on_write(self, owner: str = "", msg: str = "") -> FAISS:
+        '''
+        在向量库副本上执行写操作，完成后再短暂独占并替换，期间检索不受阻塞。
+        代价是写入期间需要额外一份索引内存。
+        '''
+        with self._write_mutex:
+            with self.acquire(owner=owner, msg=f"复制向量库。{msg}", shared=True) as vs:
+                new_vs = copy_vector_store(vs)
+            yield new_vs
+            with self.acquire(owner=owner, msg=f"替换向量库。{msg}"):
+                old_dict = self._obj.docstore._dict
+                self._obj = new_vs
+                self.mmapped = False
+            # 替换后旧副本不再被检索使用，释放其对 docstore.db 连接的引用
+            if isinstance(old_dict, SqliteDocDict) and old_dict is not new_vs.docstore._dict:
+                old_dict.close()
+
+    def log_add(self, ids: List[str], texts: List[str], embeddings: np.ndarray, metadatas: List[Dict]):
+        '''
+        记录新增的文档，需要在写入向量库的同一锁（或 copy_on_write）内调用，保证日志顺序与写入顺序一致
+        '''
+        if FAISS_DELTA_LOG and self.delta_log is not None:
+            self.delta_log.append_add(ids, texts, embeddings, metadatas)
+
+    def log_delete(self, ids: List[str]):
+        if FAISS_DELTA_LOG and self.delta_log is not None:
+            self.delta_log.append_delete(ids)
+
+    def log_update(self, metadatas: Dict[str, Dict]):
+        if FAISS_DELTA_LOG and self.delta_log is not None:
+            self.delta_log.append_update(metadatas)
+
+    def needs_rebuild(self) -> bool:
+        '''
+        标记删除的向量超过 FAISS_TOMBSTONE_RATIO 时需要重建索引
+        '''
+        vs = self._obj
+        return vs is not None and get_tombstones(vs).needs_rebuild(vs.index.ntotal)
+
+    def rebuild(self, index_type: str = None) -> Optional[str]:
+        '''
+        重建索引，清除标记删除的向量；index_type 不为空时同时转换索引类型（如 Flat 转换为 HNSW）。
+        构建期间持有 _write_mutex 阻止其他写入，检索照常进行，完成后短暂独占替换。返回新索引的描述，无需重建时返回 None
+        '''
+        with self._write_mutex:
+            with self.acquire(msg="重建索引", shared=True) as vs:
+                removed = set(get_tombstones(vs).positions)
+                if not removed and index_type is None:
+                    return None
+                start = time.time()
+                ntotal = vs.index.ntotal
+                index = rebuild_index(vs.index, removed, index_type)
+                ids = [doc_id for pos, doc_id in sorted(vs.index_to_docstore_id.items()) if pos not in removed]
+            with self.acquire(msg="替换索引"):
+                self._obj.index = index
+                if removed:
+                    self._obj.index_to_docstore_id = _make_id_map(ids)
+                self._obj.tombstones = Tombstones()
+                self.mmapped = False
+        description = describe_index(index)
+        logger.info(f"向量库 {self.key} 已重建为 {description}：{ntotal} 条向量，清除 {len(removed)} 条已删除向量，"
+                    f"耗时 {time.time() - start:.1f} 秒")
+        return description
+
+    def flush(self, path: str):
+        '''
+        持久化增删操作：未开启增量日志时完整保存；开启时写操作已经落盘，
+        仅在日志累积超过 FAISS_DELTA_MAX_SEGMENTS / FAISS_DELTA_MAX_BYTES 后在后台合并进基础索引。
+        标记删除的向量过多时在后台重建索引
+        '''
+        rebuild = self.needs_rebuild()
+        if not FAISS_DELTA_LOG or self.delta_log is None or not self.delta_log.covers(path):
+            ret = self.save(path)
+            if rebuild:
+                self.compact_async(path, rebuild=True)
+            return ret
+        if rebuild or self.delta_log.needs_compaction():
+            self.compact_async(path, rebuild=rebuild)
+
+    def compact_async(self,
+                      path: str,
+                      rebuild: bool = False,
+                      index_type: str = None,
+                      on_rebuilt: Callable[[str], None] = None):
+        '''
+        在后台完整保存向量库（合并增量日志）。rebuild 为 True 或指定 index_type 时先重建索引（见 rebuild），
+        重建完成后以新索引的描述调用 on_rebuilt。已有后台任务在执行时直接返回
+        '''
+        with self._write_mutex:
+            if self._compacting:
+                return
+            self._compacting = True
+
+        def compact():
+            try:
+                if rebuild or index_type is not None:
+                    description = self.rebuild(index_type)
+                    if description is not None and on_rebuilt is not None:
+                        on_rebuilt(description)
+                self.save(path)
+            except Exception as e:
+                msg = f"合并向量库 {self.key} 的增量日志出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+            finally:
+                self._compacting = False
+
+        threading.Thread(target=compact, daemon=True).start()
+
     def save(self, path: str, create_path: bool = True):
-        with self.acquire():
+        # 保存只读取向量库，持有读锁即可，检索可以继续进行；同时阻止写入，保证保存的内容与日志序号一致
+        with self._save_lock, self._write_mutex, self.acquire(shared=True) as vs:
             if not os.path.isdir(path) and create_path:
                 os.makedirs(path)
-            ret = self._obj.save_local(path)
+            delta_log = self.delta_log if self.delta_log is not None and self.delta_log.covers(path) else None
+            ret = save_faiss_local(vs, path, delta_log=delta_log)
             logger.info(f"已将向量库 {self.key} 保存到磁盘")
         return ret
 
     def clear(self):
         ret = []
         with self.acquire():
+            self.ensure_writable()
             ids = list(self._obj.docstore._dict.keys())
             if ids:
-                ret = self._obj.delete(ids)
+                ret = delete_docs(self._obj, ids)
+                self.log_delete(ret)
                 assert len(self._obj.docstore._dict) == 0
+            if not is_flat(self._obj.index):
+                # 全部删除时直接清空索引，不保留删除标记（IVF 保留训练结果）
+                self._obj.index.reset()
+                self._obj.index_to_docstore_id = _make_id_map([])
+                self._obj.tombstones = Tombstones()
+            self._obj.metadata_index = FaissMetadataIndex()
             logger.info(f"已将向量库 {self.key} 清空")
         return ret
 
@@ -60,6 +531,7 @@ class _FaissPool(CachePool):
         vector_store = FAISS.from_documents([doc], embeddings, distance_strategy="METRIC_INNER_PRODUCT")
         ids = list(vector_store.docstore._dict.keys())
         vector_store.delete(ids)
+        compact_vector_store(vector_store)
         return vector_store
 
     def save_vector_store(self, kb_name: str, path: str=None):
@@ -73,6 +545,10 @@ class _FaissPool(CachePool):
 
 
 class KBFaissPool(_FaissPool):
+    @staticmethod
+    def cache_key(kb_name: str, vector_name: str, shard: int = None) -> Tuple:
+        return (kb_name, vector_name) if shard is None else (kb_name, vector_name, shard)
+
     def load_vector_store(
             self,
             kb_name: str,
@@ -80,34 +556,50 @@ class KBFaissPool(_FaissPool):
             create: bool = True,
             embed_model: str = EMBEDDING_MODEL,
             embed_device: str = embedding_device(),
+            shard: int = None,
     ) -> ThreadSafeFaiss:
+        '''
+        shard 为分片编号，分片的向量库各自缓存、加锁与淘汰，缓存键为 (kb_name, vector_name, shard)
+        '''
         self.atomic.acquire()
         vector_name = vector_name or embed_model
-        cache = self.get((kb_name, vector_name)) # 用元组比拼接字符串好一些
+        key = self.cache_key(kb_name, vector_name, shard) # 用元组比拼接字符串好一些
+        cache = self.get(key)
+        self._record_lookup(cache is not None)
         if cache is None:
-            item = ThreadSafeFaiss((kb_name, vector_name), pool=self)
-            self.set((kb_name, vector_name), item)
+            item = ThreadSafeFaiss(key, pool=self)
+            self.set(key, item)
             with item.acquire(msg="初始化"):
                 self.atomic.release()
-                logger.info(f"loading vector store in '{kb_name}/vector_store/{vector_name}' from disk.")
-                vs_path = get_vs_path(kb_name, vector_name)
-
-                if os.path.isfile(os.path.join(vs_path, "index.faiss")):
-                    embeddings = self.load_kb_embeddings(kb_name=kb_name, embed_device=embed_device, default_embed_model=embed_model)
-                    vector_store = FAISS.load_local(vs_path, embeddings, distance_strategy="METRIC_INNER_PRODUCT")
-                elif create:
-                    # create an empty vector store
-                    if not os.path.exists(vs_path):
-                        os.makedirs(vs_path)
-                    vector_store = self.new_vector_store(embed_model=embed_model, embed_device=embed_device)
-                    vector_store.save_local(vs_path)
-                else:
-                    raise RuntimeError(f"knowledge base {kb_name} not exist.")
-                item.obj = vector_store
+                vs_path = shard_path(get_vs_path(kb_name, vector_name), shard)
+                logger.info(f"loading vector store in '{vs_path}' from disk.")
+
+                try:
+                    if os.path.isfile(os.path.join(vs_path, "index.faiss")):
+                        embeddings = self.load_kb_embeddings(kb_name=kb_name, embed_device=embed_device, default_embed_model=embed_model)
+                        item.load(vs_path, embeddings)
+                    elif create:
+                        # create an empty vector store
+                        if not os.path.exists(vs_path):
+                            os.makedirs(vs_path)
+                        item.obj = self.new_vector_store(embed_model=embed_model, embed_device=embed_device)
+                        # 目录中残留的增量日志属于已不存在的索引，随保存一起丢弃
+                        item.delta_log = FaissDeltaLog(vs_path)
+                        item.save(vs_path)
+                    else:
+                        raise RuntimeError(f"knowledge base {kb_name} not exist.")
+                except Exception:
+                    # 加载失败（如增量日志损坏）时移出缓存，不缓存不完整的向量库，下次使用时重新加载。
+                    # 等待加载的线程持有 atomic，这里不能再获取
+                    self.pop(key)
+                    item.obj = None
+                    item.fail_loading()
+                    raise
                 item.finish_loading()
         else:
             self.atomic.release()
-        return self.get((kb_name, vector_name))
+            item = cache
+        return item
 
 
 class MemoFaissPool(_FaissPool):
@@ -119,6 +611,7 @@ class MemoFaissPool(_FaissPool):
     ) -> ThreadSafeFaiss:
         self.atomic.acquire()
         cache = self.get(kb_name)
+        self._record_lookup(cache is not None)
         if cache is None:
             item = ThreadSafeFaiss(kb_name, pool=self)
             self.set(kb_name, item)
@@ -131,10 +624,11 @@ class MemoFaissPool(_FaissPool):
                 item.finish_loading()
         else:
             self.atomic.release()
-        return self.get(kb_name)
+            item = cache
+        return item
 
 
-kb_faiss_pool = KBFaissPool(cache_num=CACHED_VS_NUM)
+kb_faiss_pool = KBFaissPool(cache_num=CACHED_VS_NUM, memory_budget=CACHED_VS_MEMORY, pinned=CACHED_VS_PINNED)
 memo_faiss_pool = MemoFaissPool(cache_num=CACHED_MEMO_VS_NUM)
 
 
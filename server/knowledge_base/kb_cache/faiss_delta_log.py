@@ -0,0 +1,201 @@
+import json
+import os
+import pickle
+import threading
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from configs import FAISS_DELTA_MAX_SEGMENTS, FAISS_DELTA_MAX_BYTES, logger, log_verbose
+
+
+DELTA_DIR_NAME = "delta"
+COMMIT_NAME = "commit.json"
+_BASE_SEQ_NAME = "base_seq"
+_SEGMENT_SUFFIX = ".seg"
+
+
+def fsync_file(path: str):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path: str):
+    # Windows 不能打开目录，也不需要同步目录项
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def commit_files(path: str, files: List[Tuple[str, str]]):
+    '''
+    原子地用临时文件替换一组文件，files 为 [(临时文件名, 目标文件名), ...]（相对 path）。
+    临时文件落盘后先写入 commit.json 作为提交点，再依次替换：
+    提交点之前中断时旧文件保持不变；之后中断时下次加载由 recover_commit 继续完成替换
+    '''
+    for tmp, _ in files:
+        fsync_file(os.path.join(path, tmp))
+    commit_file = os.path.join(path, COMMIT_NAME)
+    with open(commit_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"files": files}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(commit_file + ".tmp", commit_file)
+    fsync_dir(path)
+    _apply_commit(path, files)
+    os.remove(commit_file)
+    fsync_dir(path)
+
+
+def _apply_commit(path: str, files: List[Tuple[str, str]]):
+    for tmp, final in files:
+        tmp_path = os.path.join(path, tmp)
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, os.path.join(path, final))
+            fsync_dir(os.path.dirname(os.path.join(path, final)))
+
+
+def recover_commit(path: str):
+    '''
+    完成上次中断的 commit_files，在读取向量库文件之前调用
+    '''
+    commit_file = os.path.join(path, COMMIT_NAME)
+    if os.path.isfile(commit_file + ".tmp"):
+        os.remove(commit_file + ".tmp")
+    if not os.path.isfile(commit_file):
+        return
+    with open(commit_file, encoding="utf-8") as f:
+        files = json.load(f)["files"]
+    _apply_commit(path, files)
+    os.remove(commit_file)
+    fsync_dir(path)
+    logger.warning(f"向量库 {path} 上次保存时中断，已完成文件替换")
+
+
+class FaissDeltaLog:
+    '''
+    FAISS 向量库的增量日志（预写日志）。每次增删文档写入 delta 目录下的一个小段文件并 fsync，
+    不再每次重写整个 index.faiss / index.pkl；加载时在基础索引之上按顺序重放，
+    段文件累积到一定数量或大小后由后台合并进基础索引（即完整保存一次）。
+    段文件按递增序号命名，base_seq 记录基础索引已包含的最后一个序号，与基础索引文件一起原子替换
+    '''
+
+    def __init__(self, vs_path: str):
+        self.vs_path = vs_path
+        self.dir = os.path.join(vs_path, DELTA_DIR_NAME)
+        self._lock = threading.Lock()
+        self.base_seq = self._read_base_seq()
+        self._segments: Dict[int, int] = {}
+        if os.path.isdir(self.dir):
+            for name in os.listdir(self.dir):
+                file = os.path.join(self.dir, name)
+                if name.endswith(".tmp"):
+                    # 写入中断的段文件，对应的写操作没有完成
+                    os.remove(file)
+                elif name.endswith(_SEGMENT_SUFFIX):
+                    self._segments[int(name[:-len(_SEGMENT_SUFFIX)])] = os.path.getsize(file)
+        self.last_seq = max([self.base_seq, *self._segments])
+
+    def _read_base_seq(self) -> int:
+        file = os.path.join(self.dir, _BASE_SEQ_NAME)
+        if not os.path.isfile(file):
+            return 0
+        with open(file, encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+
+    def _segment_file(self, seq: int) -> str:
+        return os.path.join(self.dir, f"{seq:012d}{_SEGMENT_SUFFIX}")
+
+    def covers(self, path: str) -> bool:
+        return os.path.abspath(path) == os.path.abspath(self.vs_path)
+
+    def pending(self) -> List[int]:
+        '''
+        尚未合并进基础索引的段序号。写入与合并在其他线程中修改 _segments，在锁内取快照
+        '''
+        with self._lock:
+            return sorted(x for x in self._segments if x > self.base_seq)
+
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(v for k, v in self._segments.items() if k > self.base_seq)
+
+    def needs_compaction(self) -> bool:
+        pending = self.pending()
+        return len(pending) >= FAISS_DELTA_MAX_SEGMENTS or self.nbytes() >= FAISS_DELTA_MAX_BYTES
+
+    def _append(self, record: Dict):
+        with self._lock:
+            os.makedirs(self.dir, exist_ok=True)
+            seq = self.last_seq + 1
+            file = self._segment_file(seq)
+            with open(file + ".tmp", "wb") as f:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(file + ".tmp", file)
+            fsync_dir(self.dir)
+            self._segments[seq] = os.path.getsize(file)
+            self.last_seq = seq
+
+    def append_add(self, ids: List[str], texts: List[str], embeddings: np.ndarray, metadatas: List[Dict]):
+        self._append({"op": "add", "ids": list(ids), "texts": list(texts),
+                      "embeddings": np.ascontiguousarray(embeddings, dtype=np.float32),
+                      "metadatas": list(metadatas or [{} for _ in texts])})
+
+    def append_delete(self, ids: List[str]):
+        if ids:
+            self._append({"op": "delete", "ids": list(ids)})
+
+    def append_update(self, metadatas: Dict[str, Dict]):
+        if metadatas:
+            self._append({"op": "update", "metadatas": dict(metadatas)})
+
+    def records(self) -> Iterator[Tuple[int, Dict]]:
+        '''
+        按顺序读取未合并的段文件。段文件在 fsync 后才改名，不会读到写了一半的记录。
+        遇到无法读取的段（磁盘损坏等）时停止并抛出 RuntimeError：跳过该段重放之后的记录会得到不一致的向量库，
+        需要修复或删除该段文件后再加载
+        '''
+        for seq in self.pending():
+            file = self._segment_file(seq)
+            try:
+                with open(file, "rb") as f:
+                    record = pickle.load(f)
+            except Exception as e:
+                msg = f"读取向量库增量日志 {file} 失败，已停止重放：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+                raise RuntimeError(msg) from e
+            yield seq, record
+
+    def prepare_base(self, suffix: str) -> Tuple[int, Tuple[str, str]]:
+        '''
+        写入记录基础索引所含序号的临时文件，返回 (序号, (临时文件名, 目标文件名))，交给 commit_files 一起替换。
+        调用方需要保证期间没有新的写入
+        '''
+        os.makedirs(self.dir, exist_ok=True)
+        seq = self.last_seq
+        final = os.path.join(DELTA_DIR_NAME, _BASE_SEQ_NAME)
+        with open(os.path.join(self.vs_path, final + suffix), "w", encoding="utf-8") as f:
+            f.write(str(seq))
+        return seq, (final + suffix, final)
+
+    def truncate(self, seq: int):
+        '''
+        基础索引提交后删除已合并的段文件
+        '''
+        with self._lock:
+            self.base_seq = max(self.base_seq, seq)
+            for x in [x for x in self._segments if x <= seq]:
+                file = self._segment_file(x)
+                if os.path.exists(file):
+                    os.remove(file)
+                del self._segments[x]
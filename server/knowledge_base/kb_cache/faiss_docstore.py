@@ -0,0 +1,428 @@
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+from array import array
+from collections.abc import Mapping, MutableMapping
+from typing import Any, Dict, Iterator, Iterable, List, Optional, Tuple
+
+from langchain.docstore.document import Document
+
+
+DOCSTORE_DB_NAME = "docstore.db"
+# 删除的文档超过该数量且超过总数一半时整理存储，回收文本与 metadata 占用的空间
+_COMPACT_MIN_DELETED = 1024
+
+
+class _SharedConnection:
+    '''
+    SqliteDocDict 与 copy 出的副本共享的只读连接，按引用计数在最后一个副本关闭时关闭
+    '''
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.refs = 1
+
+
+class SqliteDocDict(MutableMapping):
+    '''
+    以 sqlite 文件为底层存储的文档字典，用于替换 InMemoryDocstore._dict。
+    文档按需从磁盘读取，不会在加载知识库时将全部文档反序列化到内存中；
+    多个进程可以同时只读打开同一个文件，共享系统页缓存。
+    写入（新增/删除）只记录在内存中，保存向量库时再整体写回磁盘。
+    '''
+
+    def __init__(self, path: str, shared: Optional[_SharedConnection] = None):
+        self.path = path
+        self._shared = shared or _SharedConnection(path)
+        self._conn = self._shared.conn
+        self._lock = self._shared.lock
+        self._closed = False
+        self._added: Dict[str, Document] = {}
+        self._deleted = set()
+        self._len = self._query_one("SELECT COUNT(*) FROM docs")[0] if shared is None else 0
+
+    def _query_one(self, sql: str, params: Tuple = ()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _query_all(self, sql: str, params: Tuple = ()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _in_base(self, key: str) -> bool:
+        return self._query_one("SELECT 1 FROM docs WHERE id = ?", (key,)) is not None
+
+    def load_index_to_docstore_id(self) -> Dict[int, str]:
+        return {pos: doc_id for pos, doc_id in self._query_all("SELECT pos, doc_id FROM ids")}
+
+    def __getitem__(self, key: str) -> Document:
+        if key in self._added:
+            return self._added[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        row = self._query_one("SELECT doc FROM docs WHERE id = ?", (key,))
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key: str, value: Document):
+        if key not in self:
+            self._len += 1
+        self._deleted.discard(key)
+        self._added[key] = value
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        self._added.pop(key, None)
+        self._deleted.add(key)
+        self._len -= 1
+
+    def __contains__(self, key) -> bool:
+        if key in self._added:
+            return True
+        if key in self._deleted:
+            return False
+        return self._in_base(key)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _scan(self, columns: str, page_size: int = 1000) -> Iterator[Tuple]:
+        # 按 rowid 分页整表扫描，避免逐条查询，也避免一次性读出全部文档
+        last = 0
+        while True:
+            rows = self._query_all(f"SELECT rowid, {columns} FROM docs WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                   (last, page_size))
+            if not rows:
+                break
+            last = rows[-1][0]
+            for row in rows:
+                if row[1] in self._added or row[1] in self._deleted:
+                    continue
+                yield row[1:]
+
+    def __iter__(self) -> Iterator[str]:
+        for (k,) in self._scan("id"):
+            yield k
+        yield from list(self._added)
+
+    def items(self) -> Iterable[Tuple[str, Document]]:
+        for k, v in self._scan("id, doc"):
+            yield k, pickle.loads(v)
+        yield from list(self._added.items())
+
+    def values(self) -> Iterable[Document]:
+        for _, v in self.items():
+            yield v
+
+    def copy(self) -> "SqliteDocDict":
+        # copy_on_write 每次写入都会复制，副本共享连接，不再各自打开文件
+        with self._lock:
+            self._shared.refs += 1
+        new = SqliteDocDict(self.path, shared=self._shared)
+        new._added = dict(self._added)
+        new._deleted = set(self._deleted)
+        new._len = self._len
+        return new
+
+    def __reduce__(self):
+        # FAISS.save_local 直接 pickle docstore，这里退化为普通 dict 以保持 index.pkl 的兼容性
+        return dict, (dict(self.items()),)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._shared.refs -= 1
+            if self._shared.refs == 0:
+                self._conn.close()
+
+
+def write_docstore_db(path: str, docs: Dict[str, Document], index_to_docstore_id: Dict[int, str]):
+    '''
+    将文档与向量序号映射写入 sqlite 文件。先写临时文件再原子替换，正在读取旧文件的进程不受影响。
+    '''
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("CREATE TABLE docs (id TEXT PRIMARY KEY, doc BLOB)")
+        conn.execute("CREATE TABLE ids (pos INTEGER PRIMARY KEY, doc_id TEXT)")
+        conn.executemany("INSERT INTO docs VALUES (?, ?)",
+                         ((k, pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)) for k, v in docs.items()))
+        conn.executemany("INSERT INTO ids VALUES (?, ?)", index_to_docstore_id.items())
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+
+class _Pickled:
+    '''
+    不可哈希的 metadata 取值（list、dict 等）以 pickle 后的字节编码，每次取出时反序列化为新对象
+    '''
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __reduce__(self):
+        return _Pickled, (self.data,)
+
+
+def _value_key(value) -> Tuple:
+    try:
+        hash(value)
+        # 带上类型，避免 1、1.0、True 被编码为同一个取值
+        return type(value), value
+    except TypeError:
+        return _Pickled, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class _Column:
+    '''
+    字典编码的 metadata 列：每个文档一个 int32 编码，-1 表示该文档没有这个键
+    '''
+    __slots__ = ("codes", "values", "lookup")
+
+    def __init__(self, size: int = 0):
+        self.codes = array("i", [-1]) * size
+        self.values: List[Any] = []
+        self.lookup: Dict[Tuple, int] = {}
+
+    def encode(self, value) -> int:
+        key = _value_key(value)
+        code = self.lookup.get(key)
+        if code is None:
+            code = len(self.values)
+            self.values.append(_Pickled(key[1]) if key[0] is _Pickled else value)
+            self.lookup[key] = code
+        return code
+
+    def decode(self, code: int):
+        value = self.values[code]
+        return pickle.loads(value.data) if isinstance(value, _Pickled) else value
+
+    def rebuild_lookup(self):
+        self.lookup = {_value_key(self.decode(code)): code for code in range(len(self.values))}
+
+
+class CompactDocDict(MutableMapping):
+    '''
+    紧凑的列式文档字典，用于替换 InMemoryDocstore._dict：
+    - 全部文本拼接为一个 UTF-8 字节串，另用偏移量数组定位每个文档；
+    - metadata 按键分列做字典编码，source、kb_name 等重复取值只保存一份；
+    - 文档 id 保存在列表中，另有 id -> 行号的映射。
+    读取时才构造 Document（每次返回新对象），检索只为命中的文档构造。
+    删除只做标记，删除数量较多时整理存储。pickle 时保存紧凑的数组，index.pkl 也随之变小。
+    '''
+
+    def __init__(self):
+        self._ids: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}
+        self._text = bytearray()
+        self._offsets = array("q", [0])
+        self._columns: Dict[str, _Column] = {}
+        self._deleted = 0
+
+    @classmethod
+    def from_items(cls, items: Iterable[Tuple[str, Document]]) -> "CompactDocDict":
+        docs = cls()
+        for k, v in items:
+            docs[k] = v
+        return docs
+
+    def _append(self, key: str, doc: Document):
+        row = len(self._ids)
+        self._ids.append(key)
+        self._rows[key] = row
+        self._text += doc.page_content.encode("utf-8")
+        self._offsets.append(len(self._text))
+        for name, column in self._columns.items():
+            column.codes.append(column.encode(doc.metadata[name]) if name in doc.metadata else -1)
+        for name, value in doc.metadata.items():
+            if name not in self._columns:
+                column = _Column(row)
+                column.codes.append(column.encode(value))
+                self._columns[name] = column
+
+    def _text_of(self, row: int) -> str:
+        return self._text[self._offsets[row]: self._offsets[row + 1]].decode("utf-8")
+
+    def _metadata_of(self, row: int) -> Dict:
+        metadata = {}
+        for name, column in self._columns.items():
+            code = column.codes[row]
+            if code >= 0:
+                metadata[name] = column.decode(code)
+        return metadata
+
+    def __getitem__(self, key: str) -> Document:
+        row = self._rows[key]
+        return Document(page_content=self._text_of(row), metadata=self._metadata_of(row))
+
+    def __setitem__(self, key: str, value: Document):
+        if key in self._rows:
+            del self[key]
+        self._append(key, value)
+
+    def __delitem__(self, key: str):
+        row = self._rows.pop(key)
+        self._ids[row] = None
+        self._deleted += 1
+        if self._deleted >= _COMPACT_MIN_DELETED and self._deleted * 2 > len(self._ids):
+            self._compact()
+
+    def __contains__(self, key) -> bool:
+        return key in self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __iter__(self) -> Iterator[str]:
+        return (k for k in list(self._ids) if k is not None)
+
+    def items(self) -> Iterable[Tuple[str, Document]]:
+        for k in list(self._ids):
+            if k is not None and k in self._rows:
+                yield k, self[k]
+
+    def values(self) -> Iterable[Document]:
+        for _, v in self.items():
+            yield v
+
+    def _compact(self):
+        live = [(row, k) for row, k in enumerate(self._ids) if k is not None]
+        text = bytearray()
+        offsets = array("q", [0])
+        for row, _ in live:
+            text += self._text[self._offsets[row]: self._offsets[row + 1]]
+            offsets.append(len(text))
+        columns = {}
+        for name, column in self._columns.items():
+            new = _Column()
+            for row, _ in live:
+                code = column.codes[row]
+                new.codes.append(new.encode(column.decode(code)) if code >= 0 else -1)
+            if any(code >= 0 for code in new.codes):
+                columns[name] = new
+        self._ids = [k for _, k in live]
+        self._rows = {k: row for row, k in enumerate(self._ids)}
+        self._text = text
+        self._offsets = offsets
+        self._columns = columns
+        self._deleted = 0
+
+    def copy(self) -> "CompactDocDict":
+        new = CompactDocDict.__new__(CompactDocDict)
+        new._ids = list(self._ids)
+        new._rows = dict(self._rows)
+        new._text = bytearray(self._text)
+        new._offsets = array("q", self._offsets)
+        new._columns = {}
+        for name, column in self._columns.items():
+            c = _Column()
+            c.codes = array("i", column.codes)
+            c.values = list(column.values)
+            c.lookup = dict(column.lookup)
+            new._columns[name] = c
+        new._deleted = self._deleted
+        return new
+
+    def __getstate__(self) -> Dict:
+        docs = self
+        if self._deleted:
+            docs = self.copy()
+            docs._compact()
+        return {"ids": docs._ids,
+                "text": bytes(docs._text),
+                "offsets": docs._offsets,
+                "columns": {name: (c.codes, c.values) for name, c in docs._columns.items()}}
+
+    def __setstate__(self, state: Dict):
+        self._ids = state["ids"]
+        self._rows = {k: row for row, k in enumerate(self._ids)}
+        self._text = bytearray(state["text"])
+        self._offsets = state["offsets"]
+        self._columns = {}
+        for name, (codes, values) in state["columns"].items():
+            column = _Column()
+            column.codes = codes
+            column.values = values
+            column.rebuild_lookup()
+            self._columns[name] = column
+        self._deleted = 0
+
+    def nbytes(self) -> int:
+        '''
+        估计占用的内存：文本与数组按实际大小，id 与 metadata 取值按对象大小
+        '''
+        size = len(self._text) + self._offsets.itemsize * len(self._offsets)
+        size += sys.getsizeof(self._ids) + sum(sys.getsizeof(k) for k in self._ids if k is not None) * 2
+        for column in self._columns.values():
+            size += column.codes.itemsize * len(column.codes)
+            size += sum(sys.getsizeof(v) for v in column.values) * 2
+        return size
+
+
+class DocIdArray(MutableMapping):
+    '''
+    向量序号 -> 文档 id 的映射（FAISS.index_to_docstore_id）。序号总是从 0 开始连续，
+    用列表代替 dict，只支持在末尾追加
+    '''
+
+    def __init__(self, ids: Iterable[str] = ()):
+        self._ids = list(ids)
+
+    def __getitem__(self, pos: int) -> str:
+        if pos < 0:
+            raise KeyError(pos)
+        try:
+            return self._ids[pos]
+        except IndexError:
+            raise KeyError(pos)
+
+    def __setitem__(self, pos: int, doc_id: str):
+        if pos == len(self._ids):
+            self._ids.append(doc_id)
+        elif 0 <= pos < len(self._ids):
+            self._ids[pos] = doc_id
+        else:
+            raise KeyError(f"向量序号 {pos} 不连续")
+
+    def __delitem__(self, pos: int):
+        if pos != len(self._ids) - 1:
+            raise KeyError(f"只能删除最后一个向量序号，而不是 {pos}")
+        self._ids.pop()
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(len(self._ids)))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def items(self) -> Iterable[Tuple[int, str]]:
+        return enumerate(self._ids)
+
+    def values(self) -> Iterable[str]:
+        return iter(self._ids)
+
+    def copy(self) -> "DocIdArray":
+        return DocIdArray(self._ids)
+
+
+def make_compact(docs: Mapping, index_to_docstore_id: Mapping) -> Tuple[CompactDocDict, DocIdArray]:
+    '''
+    将 InMemoryDocstore._dict 与 index_to_docstore_id 转换为紧凑格式，已是紧凑格式的直接返回
+    '''
+    if not isinstance(docs, CompactDocDict):
+        docs = CompactDocDict.from_items(docs.items())
+    if not isinstance(index_to_docstore_id, DocIdArray):
+        index_to_docstore_id = DocIdArray(v for _, v in sorted(index_to_docstore_id.items()))
+    return docs, index_to_docstore_id
@@ -0,0 +1,242 @@
+import math
+from typing import Iterable, List, Optional, Set, Tuple
+
+import faiss
+import numpy as np
+
+from configs import (FAISS_INDEX_TYPE, FAISS_INDEX_TYPES, FAISS_AUTO_INDEX_THRESHOLD, FAISS_AUTO_INDEX_TYPE,
+                     FAISS_HNSW_M, FAISS_HNSW_EF_CONSTRUCTION, FAISS_HNSW_EF_SEARCH,
+                     FAISS_IVF_NLIST, FAISS_IVF_NPROBE, FAISS_TRAIN_SAMPLE, FAISS_PQ_M, FAISS_TOMBSTONE_RATIO)
+
+
+# IVF 每个聚类中心至少需要的训练向量数（少于此数 faiss 会给出警告，聚类质量较差）
+_MIN_POINTS_PER_CENTROID = 39
+
+
+def target_index_type(kb_name: str) -> str:
+    return FAISS_INDEX_TYPES.get(kb_name, FAISS_INDEX_TYPE)
+
+
+def _nlist(ntotal: int) -> int:
+    if FAISS_IVF_NLIST > 0:
+        return FAISS_IVF_NLIST
+    return min(max(int(4 * math.sqrt(ntotal)), 16), 65536)
+
+
+def _pq_m(d: int) -> int:
+    # PQ 的子空间数需要整除向量维度
+    m = min(FAISS_PQ_M, d)
+    while d % m:
+        m -= 1
+    return m
+
+
+def factory_string(index_type: str, d: int, ntotal: int) -> str:
+    '''
+    索引类型转换为 faiss.index_factory 的描述。不是预设类型时视为 index_factory 描述直接使用
+    '''
+    t = index_type.lower()
+    if t == "flat":
+        return "Flat"
+    if t == "hnsw":
+        return f"HNSW{FAISS_HNSW_M},Flat"
+    if t == "ivf":
+        return f"IVF{_nlist(ntotal)},Flat"
+    if t == "ivfpq":
+        return f"IVF{_nlist(ntotal)},PQ{_pq_m(d)}"
+    if t == "ivfsq8":
+        return f"IVF{_nlist(ntotal)},SQ8"
+    return index_type
+
+
+def _min_size(index_type: str, ntotal: int) -> int:
+    # 转换为该类型至少需要的向量数量：IVF 需要足够的训练数据，HNSW 随时可以构建
+    if index_type.upper().startswith("IVF"):
+        return _nlist(ntotal) * _MIN_POINTS_PER_CENTROID
+    return 1
+
+
+def is_flat(index: faiss.Index) -> bool:
+    return isinstance(faiss.downcast_index(index), faiss.IndexFlat)
+
+
+def describe_index(index: faiss.Index) -> str:
+    '''
+    以 index_factory 描述的形式返回索引类型，用于记录到数据库
+    '''
+    idx = faiss.downcast_index(index)
+    if isinstance(idx, faiss.IndexFlat):
+        return "Flat"
+    if isinstance(idx, faiss.IndexHNSW):
+        storage = "SQ8" if isinstance(faiss.downcast_index(idx.storage), faiss.IndexScalarQuantizer) else "Flat"
+        return f"HNSW{idx.hnsw.nb_neighbors(1)},{storage}"
+    if isinstance(idx, faiss.IndexIVFPQ):
+        return f"IVF{idx.nlist},PQ{idx.pq.M}"
+    if isinstance(idx, faiss.IndexIVFScalarQuantizer):
+        return f"IVF{idx.nlist},SQ8"
+    if isinstance(idx, faiss.IndexIVFFlat):
+        return f"IVF{idx.nlist},Flat"
+    return type(idx).__name__
+
+
+def apply_search_params(index: faiss.Index):
+    '''
+    设置检索参数：HNSW 的 efSearch、IVF 的 nprobe，越大召回率越高、检索越慢
+    '''
+    idx = faiss.downcast_index(index)
+    if isinstance(idx, faiss.IndexHNSW):
+        idx.hnsw.efSearch = FAISS_HNSW_EF_SEARCH
+    elif isinstance(idx, faiss.IndexIVF):
+        idx.nprobe = FAISS_IVF_NPROBE
+
+
+def search_parameters(index: faiss.Index, selector: Optional[faiss.IDSelector]) -> Optional[faiss.SearchParameters]:
+    '''
+    带 IDSelector 的检索参数。IVF/HNSW 索引要求对应类型的参数，同时沿用索引当前的 nprobe/efSearch。
+    selector 为 None 时返回 None，即使用索引的默认参数
+    '''
+    if selector is None:
+        return None
+    idx = faiss.downcast_index(index)
+    if isinstance(idx, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=idx.nprobe)
+    if isinstance(idx, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=idx.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def reconstruct_all(index: faiss.Index) -> np.ndarray:
+    '''
+    取出索引中的全部向量（按序号排列）。PQ/SQ8 压缩的索引取出的是近似值
+    '''
+    idx = faiss.downcast_index(index)
+    if isinstance(idx, faiss.IndexIVF) and idx.direct_map.no():
+        idx.make_direct_map()
+    if not index.ntotal:
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def build_index(index_type: str, vectors: np.ndarray, metric: int) -> Tuple[faiss.Index, str]:
+    '''
+    按类型构建索引并加入向量，需要训练的索引从向量中随机抽取至多 FAISS_TRAIN_SAMPLE 条训练。
+    向量在新索引中的序号与原顺序一致，index_to_docstore_id 不需要改变
+    '''
+    ntotal, d = vectors.shape
+    description = factory_string(index_type, d, ntotal)
+    index = faiss.index_factory(d, description, metric)
+    idx = faiss.downcast_index(index)
+    if isinstance(idx, faiss.IndexHNSW):
+        idx.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+    if not index.is_trained:
+        sample = vectors
+        if FAISS_TRAIN_SAMPLE > 0 and ntotal > FAISS_TRAIN_SAMPLE:
+            rng = np.random.default_rng(0)
+            sample = vectors[np.sort(rng.choice(ntotal, FAISS_TRAIN_SAMPLE, replace=False))]
+        index.train(sample)
+    index.add(vectors)
+    apply_search_params(index)
+    return index, describe_index(index)
+
+
+class Tombstones:
+    '''
+    HNSW/IVF 索引中已删除向量的序号。HNSW 不支持删除，IVF 删除后不会重新编号，
+    这两类索引删除文档时只标记序号（index_to_docstore_id 中对应的 id 置为 None），检索时通过 IDSelector 排除，
+    标记的数量超过 FAISS_TOMBSTONE_RATIO 后由后台重建索引时清除（见 ThreadSafeFaiss.rebuild）
+    '''
+
+    def __init__(self, positions: Iterable[int] = ()):
+        self.positions: Set[int] = set(positions)
+        self._selector: Optional[Tuple[faiss.IDSelector, faiss.IDSelector]] = None
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def add(self, positions: Iterable[int]):
+        self.positions.update(positions)
+        self._selector = None
+
+    def selector(self) -> Optional[faiss.IDSelector]:
+        '''
+        排除已删除向量的 IDSelector，没有删除标记时为 None。结果缓存到下次标记删除
+        '''
+        if not self.positions:
+            return None
+        selector = self._selector
+        if selector is None:
+            batch = faiss.IDSelectorBatch(np.array(sorted(self.positions), dtype=np.int64))
+            # IDSelectorNot 不持有 batch 的所有权，一起保存以免被回收
+            selector = (faiss.IDSelectorNot(batch), batch)
+            self._selector = selector
+        return selector[0]
+
+    def needs_rebuild(self, ntotal: int) -> bool:
+        return len(self.positions) > 0 and len(self.positions) >= ntotal * FAISS_TOMBSTONE_RATIO
+
+    def copy(self) -> "Tombstones":
+        return Tombstones(self.positions)
+
+
+def get_tombstones(vector_store) -> Tombstones:
+    '''
+    取得向量库的删除标记。从磁盘加载的向量库由 index_to_docstore_id 中为 None 的序号恢复
+    '''
+    tombstones = getattr(vector_store, "tombstones", None)
+    if tombstones is None:
+        tombstones = Tombstones(pos for pos, doc_id in vector_store.index_to_docstore_id.items() if doc_id is None)
+        vector_store.tombstones = tombstones
+    return tombstones
+
+
+def remove_positions(index: faiss.Index, positions: List[int]) -> faiss.Index:
+    '''
+    删除 Flat 索引中指定序号的向量，之后的向量序号依次前移（IndexFlat.remove_ids）
+    '''
+    index.remove_ids(np.array(positions, dtype=np.int64))
+    return index
+
+
+def rebuild_index(index: faiss.Index, removed: Set[int], index_type: str = None) -> faiss.Index:
+    '''
+    构建不含 removed 中序号的新索引，原索引不变，剩余向量的序号依次前移。
+    index_type 为空时保持原类型：IVF 沿用原索引的训练结果，其他索引按原描述重新构建
+    '''
+    vectors = reconstruct_all(index)
+    if removed:
+        keep = np.ones(len(vectors), dtype=bool)
+        keep[sorted(removed)] = False
+        vectors = np.ascontiguousarray(vectors[keep])
+    if index_type is None and isinstance(faiss.downcast_index(index), faiss.IndexIVF):
+        new_index = faiss.clone_index(index)
+        new_index.reset()
+        new_index.add(vectors)
+        apply_search_params(new_index)
+        return new_index
+    return build_index(index_type or describe_index(index), vectors, index.metric_type)[0]
+
+
+def upgrade_target(indexes: List[faiss.Index], kb_name: str) -> Optional[str]:
+    '''
+    按配置判断是否需要将平面索引转换为 HNSW/IVF 等索引，需要时返回目标索引的 index_factory 描述。
+    indexes 为知识库各分片的索引，按整个知识库判断，所有分片转换为同一描述的索引：
+    - 配置为 flat 时不转换；
+    - 配置为 auto 时，向量总数达到 FAISS_AUTO_INDEX_THRESHOLD 后转换为 FAISS_AUTO_INDEX_TYPE；
+    - 配置为其他类型时，最小的分片也满足训练要求后转换，IVF 的聚类数按最小的分片确定；
+    - 部分分片已经转换（上次转换中断）时，其余分片转换为相同的描述。
+    只做判断，转换耗时较长，由 ThreadSafeFaiss.rebuild 在后台进行
+    '''
+    index_type = target_index_type(kb_name)
+    flat = [x for x in indexes if is_flat(x)]
+    if index_type.lower() == "flat" or not flat:
+        return None
+    if len(flat) < len(indexes):
+        return describe_index(next(x for x in indexes if not is_flat(x)))
+    if index_type.lower() == "auto":
+        if sum(x.ntotal for x in indexes) < FAISS_AUTO_INDEX_THRESHOLD:
+            return None
+        index_type = FAISS_AUTO_INDEX_TYPE
+    smallest = min(x.ntotal for x in flat)
+    if smallest < _min_size(index_type, smallest):
+        return None
+    return factory_string(index_type, flat[0].d, smallest)
@@ -0,0 +1,151 @@
+import os
+import pickle
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from langchain.docstore.document import Document
+
+from configs import FAISS_METADATA_INDEX_KEYS, logger, log_verbose
+from server.knowledge_base.utils import metadata_filter_values
+
+
+METADATA_INDEX_NAME = "metadata_index.pkl"
+
+
+def _index_keys() -> List[str]:
+    # source 用于按文件删除与列出文档，总是建立索引
+    return list(dict.fromkeys(["source", *FAISS_METADATA_INDEX_KEYS]))
+
+
+class FaissMetadataIndex:
+    '''
+    FAISS 向量库的 metadata 倒排索引：{key: {str(value): {doc_id, ...}}}。
+    按文件删除、列出文档与按 metadata 过滤检索时直接定位文档 id，不再遍历整个 docstore。
+    随向量库的增删同步更新（见 faiss_cache.add_embeddings / delete_docs），与 index.faiss 一同保存。
+    '''
+
+    def __init__(self, keys: List[str] = None):
+        self.keys = keys if keys is not None else _index_keys()
+        self._index: Dict[str, Dict[str, Set[str]]] = {k: {} for k in self.keys}
+        # 每次增删文档加一；向量库的增删都经过 add / remove，据此判断 index_to_docstore_id 是否变化
+        self._version = 0
+        # ((版本, index_to_docstore_id 的标识), doc_id -> 向量序号)
+        self._positions: Tuple[Tuple[int, int], Dict[str, int]] = ((-1, 0), {})
+
+    @classmethod
+    def build(cls, docs: Iterable[Tuple[str, Document]]) -> "FaissMetadataIndex":
+        index = cls()
+        for doc_id, doc in docs:
+            index._add(doc_id, doc.metadata)
+        return index
+
+    def _add(self, doc_id: str, metadata: Dict):
+        for k in self.keys:
+            if k in metadata:
+                self._index[k].setdefault(str(metadata[k]), set()).add(doc_id)
+
+    def add(self, ids: List[str], metadatas: List[Dict]):
+        self._version += 1
+        for doc_id, metadata in zip(ids, metadatas):
+            self._add(doc_id, metadata or {})
+
+    def remove(self, ids: List[str], docs: Dict[str, Document]):
+        '''
+        移除文档，需要在文档从 docstore 删除前调用以取得其 metadata
+        '''
+        self._version += 1
+        for doc_id in ids:
+            doc = docs.get(doc_id)
+            if doc is None:
+                continue
+            for k in self.keys:
+                if k not in doc.metadata:
+                    continue
+                value = str(doc.metadata[k])
+                bucket = self._index[k].get(value)
+                if bucket is not None:
+                    bucket.discard(doc_id)
+                    if not bucket:
+                        del self._index[k][value]
+
+    def lookup(self, key: str, value, ignore_case: bool = False) -> Set[str]:
+        values = self._index[key]
+        if not ignore_case:
+            return set(values.get(str(value), ()))
+        # 忽略大小写时遍历该键的不同取值（如文件数），而不是全部文档
+        value = str(value).lower()
+        result = set()
+        for v, ids in values.items():
+            if v.lower() == value:
+                result |= ids
+        return result
+
+    def indexed(self, filter: Dict) -> bool:
+        return all(k in self._index for k in filter)
+
+    def filter_ids(self, filter: Dict) -> Optional[Set[str]]:
+        '''
+        返回满足过滤条件中已索引键的文档 id，过滤条件中没有已索引的键时返回 None
+        '''
+        result = None
+        for k, v in filter.items():
+            if k not in self._index:
+                continue
+            ids = set()
+            for x in metadata_filter_values(v):
+                ids |= self._index[k].get(str(x), set())
+            result = ids if result is None else result & ids
+            if not result:
+                break
+        return result
+
+    def positions(self, index_to_docstore_id: Dict[int, str], ids: Iterable[str]) -> List[int]:
+        '''
+        文档 id 转换为向量序号。反向映射在向量库增删（版本号变化）或换用新的 index_to_docstore_id 后重建
+        '''
+        key = (self._version, id(index_to_docstore_id))
+        cached_key, mapping = self._positions
+        if cached_key != key:
+            mapping = {doc_id: pos for pos, doc_id in index_to_docstore_id.items()}
+            self._positions = (key, mapping)
+        return sorted(mapping[x] for x in ids if x in mapping)
+
+    def copy(self) -> "FaissMetadataIndex":
+        new = FaissMetadataIndex(list(self.keys))
+        new._index = {k: {v: set(ids) for v, ids in values.items()} for k, values in self._index.items()}
+        return new
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            pickle.dump({"keys": self.keys, "index": self._index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["FaissMetadataIndex"]:
+        '''
+        读取保存的索引，文件不存在、已损坏或索引的键与配置不一致时返回 None
+        '''
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            msg = f"读取 metadata 索引 {path} 失败，将重新生成：{e}"
+            logger.error(f'{e.__class__.__name__}: {msg}',
+                         exc_info=e if log_verbose else None)
+            return None
+        if data.get("keys") != _index_keys():
+            return None
+        index = cls(data["keys"])
+        index._index = data["index"]
+        return index
+
+
+def get_metadata_index(vector_store) -> FaissMetadataIndex:
+    '''
+    取得向量库的 metadata 索引，旧版本保存的向量库首次使用时遍历 docstore 生成
+    '''
+    index = getattr(vector_store, "metadata_index", None)
+    if index is None:
+        index = FaissMetadataIndex.build(vector_store.docstore._dict.items())
+        vector_store.metadata_index = index
+    return index
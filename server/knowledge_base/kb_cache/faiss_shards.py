@@ -0,0 +1,82 @@
+import json
+import os
+import zlib
+from typing import List, Optional
+
+from configs import FAISS_DEFAULT_SHARDS, FAISS_SHARDS, FAISS_SHARD_BY
+
+
+SHARDS_FILE_NAME = "shards.json"
+
+
+class ShardLayout:
+    '''
+    向量库的分片方式：num_shards 个分片，文本块按 by（file: 来源文件；id: 文档 id）的哈希分配到分片。
+    只有一个分片时沿用未分片的目录结构与缓存键，分片编号为 None
+    '''
+
+    def __init__(self, num_shards: int = 1, by: str = "file"):
+        self.num_shards = max(int(num_shards), 1)
+        self.by = by
+
+    @property
+    def shards(self) -> List[Optional[int]]:
+        return [None] if self.num_shards == 1 else list(range(self.num_shards))
+
+    def _hash(self, key: str) -> int:
+        # 不使用 hash()：字符串哈希每个进程随机，分片分配需要在不同进程、重启后保持一致
+        return zlib.crc32(key.encode("utf-8")) % self.num_shards
+
+    def shard_of(self, doc_id: str, source: str) -> Optional[int]:
+        if self.num_shards == 1:
+            return None
+        if self.by == "file":
+            # 与按文件删除一致，来源文件不区分大小写
+            return self._hash(str(source).lower())
+        return self._hash(doc_id)
+
+    def shards_of_source(self, source: str) -> List[Optional[int]]:
+        '''
+        可能包含某个文件的文本块的分片
+        '''
+        if self.num_shards > 1 and self.by == "file":
+            return [self.shard_of("", source)]
+        return self.shards
+
+    def shards_of_ids(self, ids: List[str]) -> List[Optional[int]]:
+        '''
+        可能包含这些文档 id 的分片
+        '''
+        if self.num_shards > 1 and self.by == "id":
+            return sorted({self.shard_of(x, "") for x in ids})
+        return self.shards
+
+    def dict(self):
+        return {"num_shards": self.num_shards, "by": self.by}
+
+
+def shard_path(vs_path: str, shard: Optional[int]) -> str:
+    return vs_path if shard is None else os.path.join(vs_path, f"shard_{shard:03d}")
+
+
+def load_shard_layout(vs_path: str, kb_name: str) -> ShardLayout:
+    '''
+    读取向量库的分片方式。已有 shards.json 时以其为准；
+    向量库已存在但没有 shards.json 的是未分片的向量库；其他情况按配置确定，由 save_shard_layout 在创建时记录
+    '''
+    file = os.path.join(vs_path, SHARDS_FILE_NAME)
+    if os.path.isfile(file):
+        with open(file, encoding="utf-8") as f:
+            return ShardLayout(**json.load(f))
+    if os.path.isfile(os.path.join(vs_path, "index.faiss")):
+        return ShardLayout(1)
+    return ShardLayout(FAISS_SHARDS.get(kb_name, FAISS_DEFAULT_SHARDS), FAISS_SHARD_BY)
+
+
+def save_shard_layout(vs_path: str, layout: ShardLayout):
+    file = os.path.join(vs_path, SHARDS_FILE_NAME)
+    if layout.num_shards == 1 or os.path.isfile(file):
+        return
+    os.makedirs(vs_path, exist_ok=True)
+    with open(file, "w", encoding="utf-8") as f:
+        json.dump(layout.dict(), f)
@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List
+
+from configs import (KB_SERVICE_POOL_SIZE, KB_SERVICE_IDLE_TIMEOUT, KB_SERVICE_HEALTH_CHECK_INTERVAL,
+                     KB_SERVICE_CLOSE_DELAY, logger, log_verbose)
+
+
+class _PooledService:
+    def __init__(self, key: Hashable, version: int):
+        self.key = key
+        self.version = version
+        self.service = None
+        self.error = None
+        self.ready = threading.Event()
+        self.created = time.time()
+        self.last_used = self.created
+        self.last_checked = self.created
+        self.uses = 0
+
+
+class KBServicePool:
+    '''
+    KBService 实例池。ES/Milvus/PG/Chroma 等向量库在 do_init 中建立客户端连接，
+    按 key（知识库名称、向量库类型、嵌入模型）复用实例，避免每个请求都重新连接：
+    - 知识库版本号变化（被修改或删除）时重建；
+    - 同一 key 并发请求时只构造一次，其他请求等待；
+    - 距上次检查超过 health_check_interval 秒时调用 KBService.health_check，失败则关闭并重新连接；
+    - 超过 idle_timeout 秒未使用或超出 max_size 时按 LRU 淘汰。
+    取出的实例没有归还操作，淘汰的实例先移出池子，距最后一次被取用超过 close_delay 秒后才关闭，
+    避免关闭仍在其他请求中使用的连接（如检索中的 ES 客户端）。
+    '''
+
+    def __init__(self,
+                 max_size: int = KB_SERVICE_POOL_SIZE,
+                 idle_timeout: float = KB_SERVICE_IDLE_TIMEOUT,
+                 health_check_interval: float = KB_SERVICE_HEALTH_CHECK_INTERVAL,
+                 close_delay: float = KB_SERVICE_CLOSE_DELAY):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.close_delay = close_delay
+        self._entries: Dict[Hashable, _PooledService] = OrderedDict()
+        # 已淘汰、等待关闭的实例
+        self._retired: List[_PooledService] = []
+        self._lock = threading.Lock()
+        self._stats = {"constructions": 0, "reuses": 0, "construct_failures": 0, "construct_seconds": 0.0,
+                       "health_checks": 0, "health_failures": 0, "reconnects": 0, "evictions": 0}
+
+    def _retire(self, entry: _PooledService, reason: str):
+        # 调用方持有 self._lock
+        self._stats["evictions"] += 1
+        logger.info(f"淘汰知识库服务 {entry.key}（{reason}）")
+        self._retired.append(entry)
+
+    def _reap(self, now: float) -> List[_PooledService]:
+        # 调用方持有 self._lock，返回可以在锁外关闭的实例；仍在构造中的实例等构造完成后再处理
+        victims, retired = [], []
+        for x in self._retired:
+            if x.ready.is_set() and now - x.last_used >= self.close_delay:
+                victims.append(x)
+            else:
+                retired.append(x)
+        self._retired = retired
+        return victims
+
+    def _close(self, entry: _PooledService):
+        if entry.service is None:
+            return
+        logger.info(f"关闭知识库服务 {entry.key}")
+        try:
+            entry.service.close()
+        except Exception as e:
+            msg = f"关闭知识库服务 {entry.key} 时出错：{e}"
+            logger.error(f'{e.__class__.__name__}: {msg}',
+                         exc_info=e if log_verbose else None)
+
+    def _evict_idle(self, now: float, keep: Hashable = None):
+        # 调用方持有 self._lock
+        if self.idle_timeout > 0:
+            for key, entry in list(self._entries.items()):
+                if key != keep and entry.ready.is_set() and now - entry.last_used > self.idle_timeout:
+                    self._retire(self._entries.pop(key), "空闲超时")
+        if self.max_size > 0:
+            for key in list(self._entries)[:-1]:
+                if len(self._entries) <= self.max_size:
+                    break
+                if self._entries[key].ready.is_set():
+                    self._retire(self._entries.pop(key), "超出数量限制")
+
+    def _healthy(self, entry: _PooledService) -> bool:
+        self._stats["health_checks"] += 1
+        try:
+            ok = entry.service.health_check()
+        except Exception as e:
+            msg = f"知识库服务 {entry.key} 健康检查出错：{e}"
+            logger.error(f'{e.__class__.__name__}: {msg}',
+                         exc_info=e if log_verbose else None)
+            ok = False
+        entry.last_checked = time.time()
+        if not ok:
+            self._stats["health_failures"] += 1
+        return ok
+
+    def get(self, key: Hashable, version: int, factory: Callable[[], Any]) -> Any:
+        '''
+        获取 key 对应的实例，不存在、版本不一致或健康检查失败时调用 factory 构造
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version != version:
+                self._retire(self._entries.pop(key), "知识库已变更")
+                entry = None
+            if entry is None:
+                entry = _PooledService(key, version)
+                self._entries[key] = entry
+                owner = True
+            else:
+                owner = False
+                self._entries.move_to_end(key)
+            self._evict_idle(now, keep=key)
+            victims = self._reap(now)
+        for victim in victims:
+            self._close(victim)
+
+        if owner:
+            return self._build(entry, factory)
+
+        entry.ready.wait()
+        if entry.error is not None:
+            raise entry.error
+        entry.last_used = time.time()
+        entry.uses += 1
+        self._stats["reuses"] += 1
+        if (self.health_check_interval > 0
+                and entry.last_used - entry.last_checked > self.health_check_interval
+                and not self._healthy(entry)):
+            # 重新连接：丢弃当前实例后重新获取，由一个请求负责重建
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._entries.pop(key)
+                    self._stats["reconnects"] += 1
+                    self._retire(entry, "健康检查失败")
+            return self.get(key, version, factory)
+        return entry.service
+
+    def _build(self, entry: _PooledService, factory: Callable[[], Any]) -> Any:
+        start = time.time()
+        try:
+            entry.service = factory()
+        except Exception as e:
+            entry.error = e
+            self._stats["construct_failures"] += 1
+            with self._lock:
+                if self._entries.get(entry.key) is entry:
+                    self._entries.pop(entry.key)
+            raise
+        finally:
+            entry.ready.set()
+        self._stats["constructions"] += 1
+        self._stats["construct_seconds"] += time.time() - start
+        entry.last_used = entry.last_checked = time.time()
+        entry.uses += 1
+        return entry.service
+
+    def discard(self, key_prefix: Hashable = None):
+        '''
+        移除实例，同样延迟关闭。key_prefix 为 None 时全部移除，否则移除 key[0] 等于 key_prefix 的实例
+        '''
+        with self._lock:
+            keys = [k for k in self._entries if key_prefix is None or k[0] == key_prefix]
+            for k in keys:
+                self._retire(self._entries.pop(k), "手动移除")
+            victims = self._reap(time.time())
+        for victim in victims:
+            self._close(victim)
+
+    def stats(self) -> Dict:
+        now = time.time()
+        with self._lock:
+            items = [{"key": str(e.key), "version": e.version, "uses": e.uses,
+                      "age_seconds": round(now - e.created, 1), "idle_seconds": round(now - e.last_used, 1)}
+                     for e in self._entries.values() if e.ready.is_set()]
+        lookups = self._stats["constructions"] + self._stats["reuses"]
+        return {
+            **self._stats,
+            "construct_seconds": round(self._stats["construct_seconds"], 3),
+            "reuse_rate": round(self._stats["reuses"] / lookups, 4) if lookups else 0.0,
+            "size": len(items),
+            "retired": len(self._retired),
+            "max_size": self.max_size,
+            "items": items,
+        }
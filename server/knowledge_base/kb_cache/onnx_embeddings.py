@@ -0,0 +1,207 @@
+import json
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from configs import EMBEDDING_ONNX_DIR, EMBEDDING_ONNX_THREADS, logger
+
+
+ONNX_BACKENDS = ("onnx", "onnx-int8")
+_CONFIG_NAME = "onnx_config.json"
+
+
+def get_onnx_dir(model: str) -> str:
+    return os.path.join(EMBEDDING_ONNX_DIR, model)
+
+
+def _onnx_file(quantize: bool) -> str:
+    return "model.int8.onnx" if quantize else "model.onnx"
+
+
+def _read_export_config(output_dir: str) -> Dict:
+    path = os.path.join(output_dir, _CONFIG_NAME)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def export_onnx(model_path: str, output_dir: str, quantize: bool = False, force: bool = False) -> str:
+    '''
+    将 sentence-transformers 模型导出为 ONNX（可选动态 int8 量化），连同分词器保存到 output_dir。
+    已导出且来源模型一致时直接返回，返回 onnx 文件路径。
+    池化方式、是否归一化、最大长度从 sentence-transformers 的模块配置读取，记录在 onnx_config.json
+    '''
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+
+    onnx_path = os.path.join(output_dir, _onnx_file(quantize))
+    config = _read_export_config(output_dir)
+    if not force and config.get("model_path") == model_path and os.path.isfile(onnx_path):
+        return onnx_path
+
+    start = time.time()
+    os.makedirs(output_dir, exist_ok=True)
+    fp32_path = os.path.join(output_dir, _onnx_file(False))
+    if force or config.get("model_path") != model_path or not os.path.isfile(fp32_path):
+        st_model = SentenceTransformer(model_path, device="cpu")
+        transformer = st_model[0]
+        pooling = next((m for m in st_model if isinstance(m, Pooling)), None)
+        config = {
+            "model_path": model_path,
+            "pooling": "cls" if pooling is not None and pooling.pooling_mode_cls_token else "mean",
+            "normalize": any(isinstance(m, Normalize) for m in st_model),
+            "max_length": st_model.max_seq_length or 512,
+        }
+        tokenizer = transformer.tokenizer
+        tokenizer.save_pretrained(output_dir)
+        inputs = tokenizer(["onnx export"], return_tensors="pt")
+        input_names = list(inputs.keys())
+        auto_model = transformer.auto_model.eval()
+        with torch.no_grad():
+            torch.onnx.export(auto_model,
+                              args=tuple(inputs[k] for k in input_names),
+                              f=fp32_path,
+                              input_names=input_names,
+                              output_names=["last_hidden_state"],
+                              dynamic_axes={**{k: {0: "batch", 1: "sequence"} for k in input_names},
+                                            "last_hidden_state": {0: "batch", 1: "sequence"}},
+                              opset_version=14)
+        with open(os.path.join(output_dir, _CONFIG_NAME), "w", encoding="utf-8") as f:
+            json.dump(config, f, ensure_ascii=False, indent=2)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, onnx_path, weight_type=QuantType.QInt8)
+    logger.info(f"已将模型 {model_path} 导出为 {onnx_path}，耗时 {time.time() - start:.1f} 秒")
+    return onnx_path
+
+
+class OnnxEmbeddings(Embeddings):
+    '''
+    通过 ONNX Runtime 在 CPU 上运行的 Embeddings 模型，与 HuggingFaceEmbeddings / HuggingFaceBgeEmbeddings
+    的输出一致（池化方式与归一化取自导出时的模型配置），embed_query 同样拼接 query_instruction。
+    embed_documents / embed_query 直接返回 float32 数组，不转换为列表
+    '''
+
+    def __init__(self,
+                 onnx_dir: str,
+                 quantize: bool = False,
+                 query_instruction: str = "",
+                 normalize: bool = None,
+                 num_threads: int = EMBEDDING_ONNX_THREADS,
+                 batch_size: int = 32):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        config = _read_export_config(onnx_dir)
+        self.pooling = config.get("pooling", "mean")
+        self.normalize = config.get("normalize", False) if normalize is None else normalize
+        self.max_length = config.get("max_length", 512)
+        self.query_instruction = query_instruction
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(os.path.join(onnx_dir, _onnx_file(quantize)),
+                                            sess_options=options,
+                                            providers=["CPUExecutionProvider"])
+        self._input_names = {x.name for x in self.session.get_inputs()}
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        result = []
+        for n in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(texts[n: n + self.batch_size], padding=True, truncation=True,
+                                    max_length=self.max_length, return_tensors="np")
+            feed = {k: v.astype(np.int64) for k, v in inputs.items() if k in self._input_names}
+            hidden = self.session.run(None, feed)[0]
+            if self.pooling == "cls":
+                vectors = hidden[:, 0]
+            else:
+                mask = inputs["attention_mask"][..., None].astype(np.float32)
+                vectors = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+            result.append(vectors.astype(np.float32, copy=False))
+        return np.concatenate(result) if result else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        texts = [t.replace("\n", " ") for t in texts]
+        return self._encode(texts)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        text = text.replace("\n", " ")
+        return self._encode([self.query_instruction + text])[0]
+
+
+def load_onnx_embeddings(model: str,
+                         model_path: str,
+                         backend: str,
+                         query_instruction: str = "",
+                         normalize: bool = None) -> OnnxEmbeddings:
+    '''
+    按 backend（onnx / onnx-int8）加载模型，首次使用时导出并缓存到 EMBEDDING_ONNX_DIR
+    '''
+    quantize = backend == "onnx-int8"
+    onnx_dir = get_onnx_dir(model)
+    export_onnx(model_path, onnx_dir, quantize=quantize)
+    return OnnxEmbeddings(onnx_dir, quantize=quantize, query_instruction=query_instruction, normalize=normalize)
+
+
+def check_parity(model: str, texts: List[str], backend: str = "onnx-int8") -> Dict:
+    '''
+    对比 ONNX 与 PyTorch（sentence-transformers）的向量，报告余弦偏差（1 - 余弦相似度）与耗时
+    '''
+    from sentence_transformers import SentenceTransformer
+    from server.utils import get_model_path
+
+    model_path = get_model_path(model)
+    onnx_model = load_onnx_embeddings(model, model_path, backend)
+    st_model = SentenceTransformer(model_path, device="cpu")
+
+    start = time.time()
+    expected = st_model.encode(texts, normalize_embeddings=True)
+    torch_seconds = time.time() - start
+    start = time.time()
+    actual = onnx_model.embed_documents(texts)
+    onnx_seconds = time.time() - start
+
+    actual = actual / np.clip(np.linalg.norm(actual, axis=1, keepdims=True), 1e-12, None)
+    deviation = 1 - (expected * actual).sum(axis=1)
+    return {
+        "model": model,
+        "backend": backend,
+        "texts": len(texts),
+        "max_cosine_deviation": float(deviation.max()),
+        "mean_cosine_deviation": float(deviation.mean()),
+        "torch_seconds": round(torch_seconds, 3),
+        "onnx_seconds": round(onnx_seconds, 3),
+    }
+
+
+if __name__ == "__main__":
+    # 在项目根目录以模块方式运行：python -m server.knowledge_base.kb_cache.onnx_embeddings
+    import argparse
+    from configs import EMBEDDING_MODEL
+
+    parser = argparse.ArgumentParser(description="导出 Embeddings 模型为 ONNX 并检查与 PyTorch 输出的一致性")
+    parser.add_argument("-m", "--model", default=EMBEDDING_MODEL, help="MODEL_PATH['embed_model'] 中的模型名称")
+    parser.add_argument("-b", "--backend", default="onnx-int8", choices=ONNX_BACKENDS)
+    parser.add_argument("-f", "--file", help="用于对比的文本文件，每行一条；默认使用内置示例")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            samples = [line.strip() for line in f if line.strip()]
+    else:
+        samples = ["如何申请年假？", "Langchain-Chatchat 支持哪些向量库？",
+                   "ERR-1024 错误码表示连接超时，请检查网络配置。",
+                   "The quick brown fox jumps over the lazy dog."]
+    print(json.dumps(check_parity(args.model, samples, args.backend), ensure_ascii=False, indent=2))
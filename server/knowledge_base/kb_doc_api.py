@@ -1,3 +1,4 @@
+import asyncio
 import json
 import mimetypes
 import urllib
@@ -6,6 +7,7 @@ from typing import List, Dict
 from urllib.parse import quote
 
 from fastapi import File, Form, Body, Query, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from langchain.docstore.document import Document
 from pydantic import Json
 from sse_starlette import EventSourceResponse
@@ -16,7 +18,9 @@ from configs import (DEFAULT_VS_TYPE, EMBEDDING_MODEL,
                      CHUNK_SIZE, OVERLAP_SIZE, ZH_TITLE_ENHANCE,
                      logger, log_verbose, MAX_KNOWLEDGE_FILE_SIZE)
 from server.db.repository.knowledge_file_repository import get_file_detail
-from server.knowledge_base.kb_service.base import KBServiceFactory
+from server.knowledge_base.kb_cache.embedding_cache import chunk_embedding_store
+from server.knowledge_base.kb_pipeline import IngestPipeline
+from server.knowledge_base.kb_service.base import KBServiceFactory, EmbeddingsFunAdapter
 from server.knowledge_base.model.kb_document_model import DocumentWithVSId
 from server.knowledge_base.oss import default_oss
 from server.knowledge_base.utils import (validate_kb_name, list_files_from_folder, files2docs_in_thread, KnowledgeFile)
@@ -34,14 +38,21 @@ def search_docs(
                                                   "SCORE越小，相关度越高，"
                                                   "取到1相当于不筛选，建议设置在0.5左右",
                                       ge=0, le=1),
-        file_name: str = Body("", description="文件名称，支持 sql 通配符"),
-        metadata: dict = Body({}, description="根据 metadata 进行过滤，仅支持一级键"),
+        file_name: str = Body("", description="文件名称，支持 sql 通配符（指定 query 时精确匹配）"),
+        metadata: dict = Body({}, description="根据 metadata 进行过滤，仅支持一级键，值为列表时匹配其中任意一个"),
+        search_mode: str = Body("", description="检索方式：dense（向量检索）或 hybrid（向量检索与 BM25 融合），"
+                                                "为空时使用配置 SEARCH_MODE"),
 ) -> List[DocumentWithVSId]:
     kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
     data = []
     if kb is not None:
         if query:
-            docs = kb.search_docs(query, top_k, score_threshold)
+            # 过滤条件下推到向量库，先过滤再取 top_k
+            filter = dict(metadata)
+            if file_name:
+                filter["source"] = file_name
+            docs = kb.search_docs(query, top_k, score_threshold, filter=filter or None,
+                                  search_mode=search_mode or None)
             data = [DocumentWithVSId(**x[0].dict(), score=x[1], id=x[0].metadata.get("id")) for x in docs]
         elif file_name or metadata:
             data = kb.list_docs(file_name=file_name, metadata=metadata)
@@ -51,6 +62,72 @@ def search_docs(
     return data
 
 
+def search_docs_batch(
+        queries: List[str] = Body(..., description="用户输入列表", examples=[["你好", "介绍一下知识库"]]),
+        knowledge_base_name: str = Body(..., description="知识库名称", examples=["samples"]),
+        top_k: int = Body(VECTOR_SEARCH_TOP_K, description="每条查询的匹配向量数"),
+        score_threshold: float = Body(SCORE_THRESHOLD,
+                                      description="知识库匹配相关度阈值，取值范围在0-1之间，"
+                                                  "SCORE越小，相关度越高，"
+                                                  "取到1相当于不筛选，建议设置在0.5左右",
+                                      ge=0, le=1),
+) -> List[List[DocumentWithVSId]]:
+    '''
+    批量检索：所有查询一次性向量化，并尽可能在向量库中一次完成检索，结果顺序与 queries 一致
+    '''
+    kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
+    if kb is None:
+        return [[] for _ in queries]
+    result = kb.search_docs_batch(queries, top_k, score_threshold)
+    return [[DocumentWithVSId(**x[0].dict(), score=x[1], id=x[0].metadata.get("id")) for x in docs]
+            for docs in result]
+
+
+async def search_docs_multi(
+        query: str,
+        knowledge_base_names: List[str],
+        top_k: int = VECTOR_SEARCH_TOP_K,
+        score_threshold: float = SCORE_THRESHOLD,
+        filter: Dict = None,
+        search_mode: str = None,
+) -> List[DocumentWithVSId]:
+    '''
+    并发检索多个知识库。同一嵌入模型的查询只向量化一次，各知识库共用；
+    各向量库的分数经 normalize_score 换算到 [0, 1]（越小越相关）后合并排序，
+    原始分数保存在 metadata["raw_score"] 中
+    filter 为 metadata 过滤条件，下推到各向量库中执行；混合检索的分数已是 [0, 1] 的距离，不再换算
+    '''
+    kbs = await asyncio.gather(*[KBServiceFactory.aget_service_by_name(name) for name in knowledge_base_names])
+    kbs = [kb for kb in kbs if kb is not None]
+
+    embed_models = list({kb.embed_model for kb in kbs if kb.can_search_by_vector()})
+    query_embeddings = await asyncio.gather(
+        *[run_in_threadpool(EmbeddingsFunAdapter(m).embed_query, query) for m in embed_models])
+    query_embeddings = dict(zip(embed_models, query_embeddings))
+
+    results = await asyncio.gather(
+        *[run_in_threadpool(kb.search_docs_by_vector,
+                            query=query,
+                            embedding=query_embeddings.get(kb.embed_model),
+                            top_k=top_k,
+                            score_threshold=score_threshold,
+                            filter=filter,
+                            search_mode=search_mode)
+          for kb in kbs])
+
+    data = []
+    for kb, docs in zip(kbs, results):
+        for doc, score in docs:
+            hybrid = doc.metadata.get("search_mode") == "hybrid"
+            d = DocumentWithVSId(**doc.dict(), score=score if hybrid else kb.normalize_score(score),
+                                 id=doc.metadata.get("id"))
+            d.metadata["kb_name"] = kb.kb_name
+            d.metadata["raw_score"] = float(score)
+            data.append(d)
+    data.sort(key=lambda x: x.score)
+    return data
+
+
 def update_docs_by_id(
         knowledge_base_name: str = Body(..., description="知识库名称", examples=["samples"]),
         docs: Dict[str, Document] = Body(..., description="要更新的文档内容，形如：{id: Document, ...}")
@@ -281,6 +358,7 @@ def update_docs(
 
     failed_files = {}
     kb_files = []
+    embed_report = {"reused": 0, "computed": 0}
 
     # 生成需要加载docs的文件列表
     for file_name in file_names:
@@ -310,7 +388,10 @@ def update_docs(
             kb_file = KnowledgeFile(filename=file_name,
                                     knowledge_base_name=knowledge_base_name, separators=separators)
             kb_file.splited_docs = new_docs
-            kb.update_doc(kb_file, not_refresh_vs_cache=True)
+            with chunk_embedding_store.track() as report:
+                kb.update_doc(kb_file, not_refresh_vs_cache=True)
+            embed_report["reused"] += report["reused"]
+            embed_report["computed"] += report["computed"]
         else:
             kb_name, file_name, error = result
             failed_files[file_name] = error
@@ -320,7 +401,10 @@ def update_docs(
         try:
             v = [x if isinstance(x, Document) else Document(**x) for x in v]
             kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=knowledge_base_name, separators=separators)
-            kb.update_doc(kb_file, docs=v, not_refresh_vs_cache=True)
+            with chunk_embedding_store.track() as report:
+                kb.update_doc(kb_file, docs=v, not_refresh_vs_cache=True)
+            embed_report["reused"] += report["reused"]
+            embed_report["computed"] += report["computed"]
         except Exception as e:
             msg = f"为 {file_name} 添加自定义docs时出错：{e}"
             logger.error(f'{e.__class__.__name__}: {msg}',
@@ -330,7 +414,8 @@ def update_docs(
     if not not_refresh_vs_cache:
         kb.save_vector_store()
 
-    return BaseResponse(code=200, msg=Message_I18N.COMMON_CALL_SUCCESS.value, data={"failed_files": failed_files})
+    return BaseResponse(code=200, msg=Message_I18N.COMMON_CALL_SUCCESS.value,
+                        data={"failed_files": failed_files, "embeddings": embed_report})
 
 
 def download_doc(
@@ -397,37 +482,46 @@ def recreate_vector_store(
         else:
             if kb.exists():
                 kb.clear_vs()
+                # 清空后重新获取实例，分片方式等按当前配置重新确定
+                kb = KBServiceFactory.get_service(knowledge_base_name, vs_type, embed_model)
             kb.create_kb()
             files = list_files_from_folder(knowledge_base_name)
             kb_files = [(file, knowledge_base_name) for file in files]
-            i = 0
-            for status, result in files2docs_in_thread(kb_files,
-                                                       chunk_size=chunk_size,
-                                                       chunk_overlap=chunk_overlap,
-                                                       zh_title_enhance=zh_title_enhance,
-                                                       separators=separators):
-                if status:
-                    kb_name, file_name, docs = result
-                    kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=kb_name, separators=separators)
-                    kb_file.splited_docs = docs
+            pipeline = IngestPipeline(kb, kb_files,
+                                      chunk_size=chunk_size,
+                                      chunk_overlap=chunk_overlap,
+                                      zh_title_enhance=zh_title_enhance,
+                                      separators=separators)
+            for event in pipeline.run():
+                file_name = event["file_name"]
+                if event["status"]:
                     yield json.dumps({
                         "code": 200,
-                        "msg": f"({i + 1} / {len(kb_files)}): {file_name}",
-                        "total": len(kb_files),
-                        "finished": i + 1,
+                        "msg": f"({event['finished']} / {event['total']}): {file_name}",
+                        "total": event["total"],
+                        "finished": event["finished"],
                         "doc": file_name,
+                        "stages": event["stages"],
                     }, ensure_ascii=False)
-                    kb.add_doc(kb_file, not_refresh_vs_cache=True)
                 else:
-                    kb_name, file_name, error = result
-                    msg = f"添加文件‘{file_name}’到知识库‘{knowledge_base_name}’时出错：{error}。已跳过。"
+                    msg = f"添加文件‘{file_name}’到知识库‘{knowledge_base_name}’时出错：{event['msg']}。已跳过。"
                     logger.error(msg)
                     yield json.dumps({
                         "code": 500,
                         "msg": msg,
-                    })
-                i += 1
+                        "stages": event["stages"],
+                    }, ensure_ascii=False)
             if not not_refresh_vs_cache:
                 kb.save_vector_store()
+            if kb_files:
+                embed_report = pipeline.embed_report
+                yield json.dumps({
+                    "code": 200,
+                    "msg": f"复用向量 {embed_report['reused']} 条，重新计算 {embed_report['computed']} 条",
+                    "total": len(kb_files),
+                    "finished": len(kb_files),
+                    "embeddings": embed_report,
+                    "stages": pipeline.stages_report(),
+                }, ensure_ascii=False)
 
     return EventSourceResponse(output())
@@ -0,0 +1,336 @@
+import contextlib
+import queue
+import threading
+import time
+from typing import Dict, Generator, List, Optional, Tuple, Union
+
+from langchain.docstore.document import Document
+
+from configs import (CHUNK_SIZE, OVERLAP_SIZE, ZH_TITLE_ENHANCE,
+                     INGEST_LOAD_WORKERS, INGEST_SPLIT_WORKERS, INGEST_EMBED_BATCH_SIZE, INGEST_QUEUE_SIZE,
+                     PARSE_PROCESS_WORKERS, logger, log_verbose)
+from server.knowledge_base.kb_cache.embedding_cache import chunk_embedding_store
+from server.knowledge_base.kb_service.base import KBService
+from server.knowledge_base.utils import KnowledgeFile, files2docs_in_thread
+
+
+_DONE = object()
+
+
+class StageStats:
+    '''
+    流水线单个阶段的统计：处理数量、处理耗时，以及因下游队列已满而阻塞的时间（背压）
+    '''
+
+    def __init__(self, name: str, in_queue: Optional[queue.Queue] = None):
+        self.name = name
+        self.in_queue = in_queue
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, processed: int, busy_seconds: float):
+        with self._lock:
+            self.processed += processed
+            self.busy_seconds += busy_seconds
+
+    def add_blocked(self, seconds: float):
+        with self._lock:
+            self.blocked_seconds += seconds
+
+    def report(self, elapsed: float) -> Dict:
+        return {
+            "processed": self.processed,
+            "per_second": round(self.processed / elapsed, 2) if elapsed > 0 else 0.0,
+            "busy_seconds": round(self.busy_seconds, 2),
+            "blocked_seconds": round(self.blocked_seconds, 2),
+            "queue": self.in_queue.qsize() if self.in_queue is not None else 0,
+        }
+
+
+class IngestPipeline:
+    '''
+    分阶段的入库流水线，各阶段之间通过有界队列连接：
+        加载（多线程） -> 切分（多线程） -> 跨文件批量向量化（单线程） -> 写入向量库（调用方线程）
+    配置了 PARSE_PROCESS_WORKERS 时，加载与切分改由与上传文件共用的解析进程池（files2docs_in_thread）完成，
+    切分阶段直接转交已切分的文本块。
+    文件加载、向量化与写入互相重叠，下游处理不过来时上游阻塞（背压）。
+    run() 为生成器，每写入（或失败）一个文件产出一个事件，其中包含各阶段的吞吐统计。
+    '''
+
+    def __init__(self,
+                 kb: KBService,
+                 files: List[Union[KnowledgeFile, Tuple[str, str]]],
+                 chunk_size: int = CHUNK_SIZE,
+                 chunk_overlap: int = OVERLAP_SIZE,
+                 zh_title_enhance: bool = ZH_TITLE_ENHANCE,
+                 separators: List[str] = None,
+                 load_workers: int = INGEST_LOAD_WORKERS,
+                 split_workers: int = INGEST_SPLIT_WORKERS,
+                 embed_batch_size: int = INGEST_EMBED_BATCH_SIZE,
+                 queue_size: int = INGEST_QUEUE_SIZE,
+                 ):
+        self.kb = kb
+        self.files = files
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.zh_title_enhance = zh_title_enhance
+        self.separators = separators
+        self.load_workers = max(load_workers, 1)
+        self.split_workers = max(split_workers, 1)
+        self.embed_batch_size = max(embed_batch_size, 1)
+
+        self._file_q = queue.Queue()
+        self._split_q = queue.Queue(maxsize=queue_size)
+        self._embed_q = queue.Queue(maxsize=queue_size)
+        self._write_q = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._start_time = None
+        self.stats = {
+            "load": StageStats("load", self._file_q),
+            "split": StageStats("split", self._split_q),
+            "embed": StageStats("embed", self._embed_q),
+            "write": StageStats("write", self._write_q),
+        }
+        self.embed_report = {"reused": 0, "computed": 0}
+
+    def _put(self, q: queue.Queue, item, stats: StageStats) -> bool:
+        start = time.time()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                stats.add_blocked(time.time() - start)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue, timeout: float = None):
+        start = time.time()
+        while not self._stop.is_set():
+            wait = 0.5 if timeout is None else min(0.5, max(timeout - (time.time() - start), 0))
+            try:
+                return q.get(timeout=wait)
+            except queue.Empty:
+                if timeout is not None and time.time() - start >= timeout:
+                    raise
+        return _DONE
+
+    def _error(self, kb_file: KnowledgeFile, msg: str, stats: StageStats):
+        self._put(self._write_q, ("error", kb_file.filename, msg), stats)
+
+    def _load_worker(self):
+        stats = self.stats["load"]
+        while not self._stop.is_set():
+            try:
+                kb_file = self._file_q.get_nowait()
+            except queue.Empty:
+                break
+            start = time.time()
+            try:
+                docs = kb_file.file2docs()
+            except Exception as e:
+                msg = f"从文件 {kb_file.kb_name}/{kb_file.filename} 加载文档时出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+                self._error(kb_file, msg, stats)
+                continue
+            stats.add(1, time.time() - start)
+            self._put(self._split_q, (kb_file, docs, False), stats)
+
+    def _parse_pool_worker(self):
+        '''
+        通过解析进程池加载并切分文件。进程池按需提交任务，本线程在下游队列已满时阻塞，背压同样生效
+        '''
+        stats = self.stats["load"]
+        files = {}
+        while True:
+            try:
+                kb_file = self._file_q.get_nowait()
+            except queue.Empty:
+                break
+            files[(kb_file.kb_name, kb_file.filename)] = kb_file
+        results = files2docs_in_thread(list(files.values()),
+                                       chunk_size=self.chunk_size,
+                                       chunk_overlap=self.chunk_overlap,
+                                       zh_title_enhance=self.zh_title_enhance)
+        start = time.time()
+        with contextlib.closing(results):
+            for status, (kb_name, file_name, result) in results:
+                kb_file = files[(kb_name, file_name)]
+                stats.add(1, time.time() - start)
+                if status:
+                    self._put(self._split_q, (kb_file, result, True), stats)
+                else:
+                    self._error(kb_file, result, stats)
+                if self._stop.is_set():
+                    break
+                start = time.time()
+
+    def _split_worker(self):
+        stats = self.stats["split"]
+        while True:
+            item = self._get(self._split_q)
+            if item is _DONE:
+                break
+            kb_file, docs, splitted = item
+            if splitted:
+                self._put(self._embed_q, (kb_file, docs), stats)
+                continue
+            start = time.time()
+            try:
+                chunks = kb_file.docs2texts(docs=docs,
+                                            zh_title_enhance=self.zh_title_enhance,
+                                            chunk_size=self.chunk_size,
+                                            chunk_overlap=self.chunk_overlap)
+            except Exception as e:
+                msg = f"切分文件 {kb_file.kb_name}/{kb_file.filename} 时出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+                self._error(kb_file, msg, stats)
+                continue
+            stats.add(1, time.time() - start)
+            self._put(self._embed_q, (kb_file, chunks), stats)
+
+    def _embed_worker(self):
+        '''
+        将多个文件的文本块凑满一批再向量化，某个文件的全部文本块完成后交给写入阶段
+        '''
+        stats = self.stats["embed"]
+        embed = self.kb.accepts_embeddings()
+        batch: List[Tuple[Dict, int]] = []
+
+        def flush():
+            if not batch:
+                return
+            docs: List[Document] = [entry["docs"][i] for entry, i in batch]
+            start = time.time()
+            with chunk_embedding_store.track() as report:
+                data = self.kb._docs_to_embeddings(docs)
+            stats.add(len(docs), time.time() - start)
+            self.embed_report["reused"] += report["reused"]
+            self.embed_report["computed"] += report["computed"]
+
+            embeddings = data["embeddings"] if data else None
+            for n, (entry, i) in enumerate(batch):
+                if entry["failed"]:
+                    continue
+                if embeddings is None:
+                    entry["failed"] = True
+                    self._error(entry["file"], f"文件 {entry['file'].filename} 向量化失败", stats)
+                    continue
+                entry["embeddings"][i] = embeddings[n]
+                entry["remaining"] -= 1
+                if entry["remaining"] == 0:
+                    self._put(self._write_q, ("ok", entry["file"], entry["docs"], entry["embeddings"]), stats)
+            batch.clear()
+
+        while True:
+            try:
+                item = self._get(self._embed_q, timeout=0.5 if batch else None)
+            except queue.Empty:
+                # 上游暂时没有新的文本块，不再等待凑满一批
+                flush()
+                continue
+            if item is _DONE:
+                flush()
+                break
+            kb_file, docs = item
+            if not embed or not docs:
+                self._put(self._write_q, ("ok", kb_file, docs, None), stats)
+                continue
+            entry = {"file": kb_file, "docs": docs, "embeddings": [None] * len(docs),
+                     "remaining": len(docs), "failed": False}
+            for i in range(len(docs)):
+                batch.append((entry, i))
+                if len(batch) >= self.embed_batch_size:
+                    flush()
+
+    def _start(self) -> List[threading.Thread]:
+        def stage(target, stats: StageStats, workers: int, next_q: queue.Queue, next_workers: int) -> threading.Thread:
+            threads = [threading.Thread(target=target, daemon=True) for _ in range(workers)]
+            for t in threads:
+                t.start()
+
+            def close():
+                # 本阶段全部结束后通知下游每个工作线程
+                for t in threads:
+                    t.join()
+                for _ in range(next_workers):
+                    self._put(next_q, _DONE, stats)
+
+            closer = threading.Thread(target=close, daemon=True)
+            closer.start()
+            return closer
+
+        if PARSE_PROCESS_WORKERS > 0:
+            load = stage(self._parse_pool_worker, self.stats["load"], 1, self._split_q, self.split_workers)
+        else:
+            load = stage(self._load_worker, self.stats["load"], self.load_workers, self._split_q, self.split_workers)
+        return [
+            load,
+            stage(self._split_worker, self.stats["split"], self.split_workers, self._embed_q, 1),
+            stage(self._embed_worker, self.stats["embed"], 1, self._write_q, 1),
+        ]
+
+    def stages_report(self) -> Dict:
+        elapsed = time.time() - self._start_time if self._start_time else 0
+        return {k: v.report(elapsed) for k, v in self.stats.items()}
+
+    def run(self) -> Generator[Dict, None, None]:
+        '''
+        产出事件：{"status": bool, "file_name": str, "msg": str, "finished": int, "total": int, "stages": {...}}
+        '''
+        total = len(self.files)
+        finished = 0
+        self._start_time = time.time()
+        for file in self.files:
+            if isinstance(file, tuple):
+                try:
+                    file = KnowledgeFile(filename=file[0], knowledge_base_name=file[1], separators=self.separators)
+                except Exception as e:
+                    finished += 1
+                    yield {"status": False, "file_name": file[0], "msg": str(e),
+                           "finished": finished, "total": total, "stages": self.stages_report()}
+                    continue
+            self._file_q.put(file)
+
+        self._start()
+        stats = self.stats["write"]
+        try:
+            while finished < total:
+                item = self._get(self._write_q)
+                if item is _DONE:
+                    break
+                finished += 1
+                if item[0] == "error":
+                    _, file_name, msg = item
+                    yield {"status": False, "file_name": file_name, "msg": msg,
+                           "finished": finished, "total": total, "stages": self.stages_report()}
+                    continue
+
+                _, kb_file, docs, embeddings = item
+                start = time.time()
+                kwargs = {"not_refresh_vs_cache": True}
+                if embeddings is not None:
+                    kwargs["embeddings"] = embeddings
+                kb_file.splited_docs = docs
+                try:
+                    # 不接受预计算向量的向量库在写入时向量化，一并统计复用情况
+                    with chunk_embedding_store.track() as report:
+                        status = self.kb.add_doc(kb_file, **kwargs)
+                    self.embed_report["reused"] += report["reused"]
+                    self.embed_report["computed"] += report["computed"]
+                    msg = "" if status else f"文件 {kb_file.filename} 未能添加到知识库"
+                except Exception as e:
+                    status = False
+                    msg = f"添加文件 {kb_file.filename} 到知识库时出错：{e}"
+                    logger.error(f'{e.__class__.__name__}: {msg}',
+                                 exc_info=e if log_verbose else None)
+                stats.add(1, time.time() - start)
+                yield {"status": status, "file_name": kb_file.filename, "msg": msg,
+                       "finished": finished, "total": total, "stages": self.stages_report()}
+        finally:
+            # 调用方提前结束（如客户端断开）时通知所有阶段退出
+            self._stop.set()
@@ -11,36 +11,50 @@ from langchain.docstore.document import Document
 
 from server.db.repository.knowledge_base_repository import (
     add_kb_to_db, delete_kb_from_db, list_kbs_from_db, kb_exists,
-    load_kb_from_db, get_kb_detail,
+    load_kb_from_db, aload_kb_from_db, get_kb_detail,
 )
+from server.db.kb_metadata_cache import kb_metadata_cache
+from server.knowledge_base.kb_cache.kb_service_pool import KBServicePool
 from server.db.repository.knowledge_file_repository import (
     add_file_to_db, delete_file_from_db, delete_files_from_db, file_exists_in_db,
     count_files_from_db, list_files_from_db, get_file_detail, delete_file_from_db,
-    list_docs_from_db,
+    list_docs_from_db, update_file_docs_in_db,
 )
 
 from configs import (kbs_config, VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD,
-                     EMBEDDING_MODEL, KB_INFO)
+                     EMBEDDING_MODEL, KB_INFO, SEARCH_MODE, BM25_INDEX_ENABLED, HYBRID_FUSION, HYBRID_RRF_K,
+                     HYBRID_DENSE_WEIGHT, HYBRID_CANDIDATE_FACTOR, logger, log_verbose)
+from server.knowledge_base.bm25_index import get_bm25_index, drop_bm25_index, fuse_rankings, chunk_key
 from server.knowledge_base.oss import default_oss
 from server.knowledge_base.utils import (
     get_kb_path, get_doc_path, KnowledgeFile,
-    list_kbs_from_folder, list_files_from_folder,
+    list_kbs_from_folder, list_files_from_folder, get_chunk_hash, match_metadata, POSITIONAL_METADATA_KEYS,
 )
 
 from typing import List, Union, Dict, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
 
 from server.embeddings_api import embed_texts, aembed_texts, embed_documents
 from server.knowledge_base.model.kb_document_model import DocumentWithVSId
 
 
-def normalize(embeddings: List[List[float]]) -> np.ndarray:
+def normalize(embeddings: Union[np.ndarray, List[List[float]]]) -> np.ndarray:
     '''
-    sklearn.preprocessing.normalize 的替代（使用 L2），避免安装 scipy, scikit-learn
+    sklearn.preprocessing.normalize 的替代（使用 L2），避免安装 scipy, scikit-learn。
+    返回连续的 float32 数组，float32 数组原地相除；模型输出已经归一化（如 bge）时直接返回
     '''
-    norm = np.linalg.norm(embeddings, axis=1)
-    norm = np.reshape(norm, (norm.shape[0], 1))
-    norm = np.tile(norm, (1, len(embeddings[0])))
-    return np.divide(embeddings, norm)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if embeddings.ndim == 1:
+        embeddings = embeddings.reshape(1, -1)
+    if not embeddings.size:
+        return embeddings
+    norm = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    if np.allclose(norm, 1.0, atol=1e-4):
+        return embeddings
+    if not embeddings.flags.writeable:
+        embeddings = embeddings.copy()
+    embeddings /= np.maximum(norm, 1e-12)
+    return embeddings
 
 
 class SupportedVSType:
@@ -74,8 +88,10 @@ class KBService(ABC):
     def save_vector_store(self):
         '''
         保存向量库:FAISS保存到磁盘，milvus保存到数据库。PGVector暂未支持
+        BM25 索引在这里一并保存，子类重写时需要调用
         '''
-        pass
+        if BM25_INDEX_ENABLED:
+            get_bm25_index(self.kb_name).save()
 
     def create_kb(self):
         """
@@ -84,6 +100,7 @@ class KBService(ABC):
         if not os.path.exists(self.doc_path):
             os.makedirs(self.doc_path)
         self.do_create_kb()
+        self._update_sparse_index(clear=True)
         status = add_kb_to_db(self.kb_name, self.kb_name_cn, self.kb_info, self.vs_type(), self.embed_model)
         return status
 
@@ -92,6 +109,7 @@ class KBService(ABC):
         删除向量库中所有内容
         """
         self.do_clear_vs()
+        self._update_sparse_index(clear=True)
         status = delete_files_from_db(self.kb_name)
         return status
 
@@ -100,14 +118,89 @@ class KBService(ABC):
         删除知识库
         """
         self.do_drop_kb()
+        drop_bm25_index(self.kb_name)
         status = delete_kb_from_db(self.kb_name)
+        KBServiceFactory.pool.discard(self.kb_name)
         return status
 
-    def _docs_to_embeddings(self, docs: List[Document]) -> Dict:
+    def health_check(self) -> bool:
+        """
+        检查向量库连接是否可用，实例池定期调用，返回 False 时重建实例（重新连接）
+        """
+        return True
+
+    def close(self):
+        """
+        释放向量库客户端连接，实例被实例池淘汰时调用
+        """
+        pass
+
+    def _docs_to_embeddings(self, docs: List[Document], embeddings: List[np.ndarray] = None) -> Dict:
+        '''
+        将 List[Document] 转化为 VectorStore.add_embeddings 可以接受的参数，embeddings 为 float32 二维数组
+        如果传入了预先计算好的 embeddings（如入库流水线中跨文件批量向量化的结果），则不再调用模型
         '''
-        将 List[Document] 转化为 VectorStore.add_embeddings 可以接受的参数
+        if embeddings is not None and len(embeddings) == len(docs):
+            return {
+                "texts": [x.page_content for x in docs],
+                "embeddings": np.ascontiguousarray(embeddings, dtype=np.float32),
+                "metadatas": [x.metadata for x in docs],
+            }
+        return embed_documents(docs=docs, embed_model=self.embed_model, to_query=False, use_chunk_store=True)
+
+    def _update_sparse_index(self,
+                             clear: bool = False,
+                             source: str = None,
+                             deleted_ids: List[str] = None,
+                             doc_infos: List[Dict] = None,
+                             docs: List[Document] = None,
+                             save: bool = True):
         '''
-        return embed_documents(docs=docs, embed_model=self.embed_model, to_query=False)
+        随向量库的增删维护 BM25 索引，未开启 BM25_INDEX_ENABLED 时不做任何事。
+        save=False（not_refresh_vs_cache）时由之后的 save_vector_store 保存
+        '''
+        if not BM25_INDEX_ENABLED:
+            return
+        try:
+            index = get_bm25_index(self.kb_name)
+            if clear:
+                index.clear(complete=True)
+            if source is not None:
+                index.remove_source(source)
+            if deleted_ids:
+                index.remove(deleted_ids)
+            if doc_infos:
+                index.add([x["id"] for x in doc_infos], docs)
+            if save:
+                index.save()
+        except Exception as e:
+            msg = f"更新知识库 {self.kb_name} 的 BM25 索引时出错：{e}"
+            logger.error(f'{e.__class__.__name__}: {msg}',
+                         exc_info=e if log_verbose else None)
+
+    def accepts_embeddings(self) -> bool:
+        '''
+        do_add_doc 是否接受预先计算好的向量（kwargs["embeddings"]）。
+        不接受的向量库在 do_add_doc 中自行向量化
+        '''
+        return False
+
+    def _normalize_doc_sources(self, kb_file: KnowledgeFile, docs: List[Document]):
+        # 将 metadata["source"] 改为相对路径
+        for doc in docs:
+            try:
+                doc.metadata.setdefault("source", kb_file.filename)
+                source = doc.metadata.get("source", "")
+                if os.path.isabs(source):
+                    rel_path = Path(source).relative_to(self.doc_path)
+                    doc.metadata["source"] = str(rel_path.as_posix().strip("/"))
+            except Exception as e:
+                print(f"cannot convert absolute path ({source}) to relative path. error is : {e}")
+
+    @staticmethod
+    def _with_chunk_hash(doc_infos: List[Dict], hashes: List[str]) -> List[Dict]:
+        # 文本块哈希只记录在数据库中，不写入向量库的 metadata
+        return [{"id": x["id"], "metadata": {**x["metadata"], "chunk_hash": h}} for x, h in zip(doc_infos, hashes)]
 
     def add_doc(self, kb_file: KnowledgeFile, docs: List[Document] = [], **kwargs):
         """
@@ -121,27 +214,23 @@ class KBService(ABC):
             custom_docs = False
 
         if docs:
-            # 将 metadata["source"] 改为相对路径
-            for doc in docs:
-                try:
-                    doc.metadata.setdefault("source", kb_file.filename)
-                    source = doc.metadata.get("source", "")
-                    if os.path.isabs(source):
-                        rel_path = Path(source).relative_to(self.doc_path)
-                        doc.metadata["source"] = str(rel_path.as_posix().strip("/"))
-                except Exception as e:
-                    print(f"cannot convert absolute path ({source}) to relative path. error is : {e}")
+            self._normalize_doc_sources(kb_file, docs)
+            # 在 do_add_doc 之前计算，部分向量库会改写 metadata
+            hashes = [get_chunk_hash(doc) for doc in docs]
             self.delete_doc(kb_file)
             doc_infos = self.do_add_doc(docs, **kwargs)
             try:
                 status = add_file_to_db(kb_file,
                                         custom_docs=custom_docs,
                                         docs_count=len(docs),
-                                        doc_infos=doc_infos)
+                                        doc_infos=self._with_chunk_hash(doc_infos, hashes))
             except Exception as e:
                 status = False
                 print(f"add file to db error: {e}")
                 self.del_doc_by_ids([doc_info["id"] for doc_info in doc_infos])
+            else:
+                self._update_sparse_index(doc_infos=doc_infos, docs=docs,
+                                          save=not kwargs.get("not_refresh_vs_cache"))
         else:
             status = False
         return status
@@ -151,6 +240,7 @@ class KBService(ABC):
         从知识库删除文件
         """
         self.do_delete_doc(kb_file)
+        self._update_sparse_index(source=kb_file.filename, save=not kwargs.get("not_refresh_vs_cache"))
         status = delete_file_from_db(kb_file)
         if delete_content:
             default_oss().delete_object(kb_file.kb_name, kb_file.filename)
@@ -171,9 +261,77 @@ class KBService(ABC):
         如果指定了docs，则使用自定义docs，并将数据库对应条目标为custom_docs=True
         """
         if default_oss().object_exist(kb_file.kb_name, kb_file.filename):
+            try:
+                status = self._update_doc_incremental(kb_file, docs=docs, **kwargs)
+                if status is not None:
+                    return status
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: 增量更新文件 {kb_file.filename} 失败，改为全量更新：{e}",
+                             exc_info=e if log_verbose else None)
             self.delete_doc(kb_file, **kwargs)
             return self.add_doc(kb_file, docs=docs, **kwargs)
 
+    def _update_doc_incremental(self, kb_file: KnowledgeFile, docs: List[Document] = [], **kwargs) -> Optional[bool]:
+        """
+        增量更新文件：重新切分后按文本块哈希与已入库的文本块比对，
+        只删除已移除的文本块、只向量化并写入新增的文本块，数据库记录原地更新。
+        文本块哈希不含位置（metadata["index"]），保留的文本块位置变化时原地改写位置，不重新向量化。
+        文件尚未入库或旧记录没有文本块哈希时返回 None，由调用方全量更新
+        """
+        if not file_exists_in_db(kb_file):
+            return None
+        old_infos = list_docs_from_db(kb_name=self.kb_name, file_name=kb_file.filename, with_chunk_hash=True)
+        if not old_infos or any("chunk_hash" not in (x["metadata"] or {}) for x in old_infos):
+            return None
+
+        custom_docs = bool(docs)
+        if not docs:
+            docs = kb_file.file2text()
+        if not docs:
+            return None
+        self._normalize_doc_sources(kb_file, docs)
+
+        old_docs: Dict[str, List[Dict]] = {}
+        for x in old_infos:
+            old_docs.setdefault(x["metadata"]["chunk_hash"], []).append(x)
+        new_docs, new_hashes = [], []
+        moved: Dict[str, Tuple[Document, str, Dict]] = {}  # 位置变化的文本块：{id: (文本块, 哈希, 新位置)}
+        for doc in docs:
+            h = get_chunk_hash(doc)
+            if old_docs.get(h):
+                old = old_docs[h].pop()
+                position = {k: doc.metadata[k] for k in POSITIONAL_METADATA_KEYS if k in doc.metadata}
+                if any(old["metadata"].get(k) != v for k, v in position.items()):
+                    moved[old["id"]] = (doc, h, position)
+            else:
+                new_docs.append(doc)
+                new_hashes.append(h)
+        deleted_ids = [x["id"] for infos in old_docs.values() for x in infos]
+
+        if deleted_ids:
+            self.del_doc_by_ids(deleted_ids)
+        if moved and not self.do_update_metadata({k: v[2] for k, v in moved.items()}):
+            # 向量库不支持原地修改 metadata 时删除后重新添加，向量由文本块向量存储复用
+            self.del_doc_by_ids(list(moved))
+            deleted_ids.extend(moved)
+            for doc, h, _ in moved.values():
+                new_docs.append(doc)
+                new_hashes.append(h)
+            moved = {}
+        doc_infos = self.do_add_doc(new_docs, **kwargs) if new_docs else []
+        self._update_sparse_index(deleted_ids=deleted_ids, doc_infos=doc_infos, docs=new_docs,
+                                  save=not kwargs.get("not_refresh_vs_cache"))
+        if not new_docs and (deleted_ids or moved) and not kwargs.get("not_refresh_vs_cache"):
+            self.save_vector_store()
+        logger.info(f"增量更新文件 {kb_file.filename}：保留 {len(docs) - len(new_docs)} 个文本块"
+                    f"（其中 {len(moved)} 个位置变化），新增 {len(new_docs)} 个，删除 {len(deleted_ids)} 个")
+        return update_file_docs_in_db(kb_file,
+                                      docs_count=len(docs),
+                                      custom_docs=custom_docs,
+                                      deleted_ids=deleted_ids,
+                                      doc_infos=self._with_chunk_hash(doc_infos, new_hashes),
+                                      updated_infos=[{"id": k, "metadata": v[2]} for k, v in moved.items()])
+
     def exist_doc(self, file_name: str):
         return file_exists_in_db(KnowledgeFile(knowledge_base_name=self.kb_name,
                                                filename=file_name))
@@ -196,10 +354,150 @@ class KBService(ABC):
                     query: str,
                     top_k: int = VECTOR_SEARCH_TOP_K,
                     score_threshold: float = SCORE_THRESHOLD,
+                    filter: Dict = None,
+                    search_mode: str = None,
                     ) -> List[Tuple[Document, float]]:
+        '''
+        filter 按 metadata 过滤，形如 {key: value 或 [value, ...]}，在向量库内先过滤再取 top_k
+        search_mode 为 dense（向量检索）或 hybrid（向量检索与 BM25 融合），为 None 时使用配置 SEARCH_MODE
+        '''
+        if self._use_hybrid(search_mode):
+            return self.do_search_hybrid(query, top_k, score_threshold, filter=filter)
+        return self._search_dense(query, top_k, score_threshold, filter)
+
+    def _search_dense(self,
+                      query: str,
+                      top_k: int,
+                      score_threshold: float,
+                      filter: Dict = None,
+                      ) -> List[Tuple[Document, float]]:
+        if filter:
+            return self.do_search_filtered(query, top_k, score_threshold, filter)
         docs = self.do_search(query, top_k, score_threshold)
         return docs
 
+    @staticmethod
+    def _use_hybrid(search_mode: str = None) -> bool:
+        # 混合检索依赖 BM25 索引，未开启时退回向量检索
+        return (search_mode or SEARCH_MODE) == "hybrid" and BM25_INDEX_ENABLED
+
+    def search_docs_batch(self,
+                          queries: List[str],
+                          top_k: int = VECTOR_SEARCH_TOP_K,
+                          score_threshold: float = SCORE_THRESHOLD,
+                          ) -> List[List[Tuple[Document, float]]]:
+        '''
+        批量检索，返回结果与 queries 一一对应
+        '''
+        if not queries:
+            return []
+        return self.do_search_batch(queries, top_k, score_threshold)
+
+    def search_docs_by_vector(self,
+                              query: str,
+                              embedding: Optional[List[float]],
+                              top_k: int = VECTOR_SEARCH_TOP_K,
+                              score_threshold: float = SCORE_THRESHOLD,
+                              filter: Dict = None,
+                              search_mode: str = None,
+                              ) -> List[Tuple[Document, float]]:
+        '''
+        使用已向量化的查询检索，多个知识库共用同一嵌入模型时只需向量化一次。
+        不支持按向量检索的向量库退回到 do_search
+        '''
+        if self._use_hybrid(search_mode):
+            return self.do_search_hybrid(query, top_k, score_threshold, filter=filter, embedding=embedding)
+        if embedding is None or not self.can_search_by_vector():
+            return self._search_dense(query, top_k, score_threshold, filter)
+        return self.do_search_by_vector(embedding, top_k, score_threshold, filter=filter)
+
+    def do_search_hybrid(self,
+                         query: str,
+                         top_k: int,
+                         score_threshold: float,
+                         filter: Dict = None,
+                         embedding: Optional[List[float]] = None,
+                         ) -> List[Tuple[Document, float]]:
+        '''
+        混合检索：向量检索与 BM25 检索各召回 top_k * HYBRID_CANDIDATE_FACTOR 个候选，按 HYBRID_FUSION 融合后取 top_k。
+        score_threshold 只作用于向量检索。返回的分数为融合后的距离，取值 [0, 1]，越小越相关，
+        metadata 中记录 search_mode="hybrid" 以及各路的原始分数 dense_score / bm25_score
+        '''
+        n = top_k * max(HYBRID_CANDIDATE_FACTOR, 1)
+        if embedding is not None and self.can_search_by_vector():
+            dense = self.do_search_by_vector(embedding, n, score_threshold, filter=filter)
+        else:
+            dense = self._search_dense(query, n, score_threshold, filter)
+        sparse = self.search_sparse(query, n, filter=filter)
+
+        docs: Dict[Tuple, Document] = {}
+        dense_scores: Dict[Tuple, float] = {}
+        sparse_scores: Dict[Tuple, float] = {}
+        for results, scores in ((dense, dense_scores), (sparse, sparse_scores)):
+            for doc, score in results:
+                key = chunk_key(doc)
+                docs.setdefault(key, doc)
+                scores.setdefault(key, float(score))
+
+        # 两路结果都换算为 [0, 1] 的相关度（越大越相关），weighted 融合时使用
+        dense_ranking = [(k, 1 - self.normalize_score(s)) for k, s in dense_scores.items()]
+        best = max(sparse_scores.values(), default=0) or 1
+        sparse_ranking = [(k, s / best) for k, s in sparse_scores.items()]
+        fused = fuse_rankings([dense_ranking, sparse_ranking],
+                              weights=[HYBRID_DENSE_WEIGHT, 1 - HYBRID_DENSE_WEIGHT],
+                              method=HYBRID_FUSION,
+                              rrf_k=HYBRID_RRF_K)
+
+        result = []
+        for key, distance in fused[:top_k]:
+            doc = docs[key]
+            # 复制一份，不修改向量库中缓存的文档
+            metadata = {**doc.metadata, "search_mode": "hybrid"}
+            if key in dense_scores:
+                metadata["dense_score"] = dense_scores[key]
+            if key in sparse_scores:
+                metadata["bm25_score"] = sparse_scores[key]
+            result.append((Document(page_content=doc.page_content, metadata=metadata), distance))
+        return result
+
+    def search_sparse(self,
+                      query: str,
+                      top_k: int,
+                      filter: Dict = None,
+                      ) -> List[Tuple[Document, float]]:
+        '''
+        BM25 检索，返回 [(Document, BM25 分数)]，分数越大越相关。
+        索引不完整（旧版本创建的知识库）时先从知识库读取全部文本块重建
+        '''
+        index = get_bm25_index(self.kb_name)
+        index.ensure_complete(self._load_all_docs)
+        # 有过滤条件时多取一些候选，过滤后再截断
+        hits = index.search(query, top_k * 4 if filter else top_k)
+        if not hits:
+            return []
+        by_key = {chunk_key(doc): doc for doc in self.get_doc_by_ids([x for x, _ in hits]) if doc is not None}
+        result = []
+        for doc_id, score in hits:
+            doc = by_key.get(index.key_of(doc_id))
+            if doc is None or (filter and not match_metadata(doc.metadata, filter)):
+                continue
+            result.append((doc, score))
+        return result[:top_k]
+
+    def _load_all_docs(self) -> Tuple[List[str], List[Document]]:
+        docs = self.list_docs()
+        return [x.id for x in docs], docs
+
+    def can_search_by_vector(self) -> bool:
+        return type(self).do_search_by_vector is not KBService.do_search_by_vector
+
+    def normalize_score(self, score: float) -> float:
+        '''
+        将 do_search 返回的原始分数换算为 [0, 1] 区间的距离，0 表示最相关，用于合并多个知识库的检索结果。
+        各向量库的度量方式不同，子类按自身的度量重写
+        '''
+        return min(max(float(score), 0.0), 1.0)
+
     def get_doc_by_ids(self, ids: List[str]) -> List[Document]:
         return []
 
@@ -219,7 +517,8 @@ class KBService(ABC):
                 continue
             ids.append(_id)
             pending_docs.append(doc)
-        self.do_add_doc(docs=pending_docs, ids=ids)
+        doc_infos = self.do_add_doc(docs=pending_docs, ids=ids)
+        self._update_sparse_index(deleted_ids=list(docs.keys()), doc_infos=doc_infos, docs=pending_docs)
         return True
 
     def list_docs(self, file_name: str = None, metadata: Dict = {}) -> List[DocumentWithVSId]:
@@ -302,6 +601,44 @@ class KBService(ABC):
         """
         pass
 
+    def do_search_batch(self,
+                        queries: List[str],
+                        top_k: int,
+                        score_threshold: float,
+                        ) -> List[List[Tuple[Document, float]]]:
+        """
+        批量搜索知识库，默认逐条调用 do_search。子类可以一次性向量化全部查询并批量检索
+        """
+        return [self.do_search(query, top_k, score_threshold) for query in queries]
+
+    def do_search_by_vector(self,
+                            embedding: List[float],
+                            top_k: int,
+                            score_threshold: float,
+                            filter: Dict = None,
+                            ) -> List[Tuple[Document, float]]:
+        """
+        使用查询向量搜索知识库，子类重写后即可在多知识库检索时共用查询向量。
+        filter 不为空时在向量库内按 metadata 过滤后再取 top_k
+        """
+        raise NotImplementedError
+
+    def do_search_filtered(self,
+                           query: str,
+                           top_k: int,
+                           score_threshold: float,
+                           filter: Dict,
+                           ) -> List[Tuple[Document, float]]:
+        """
+        按 metadata 过滤后检索。支持按向量检索的向量库在 do_search_by_vector 中下推过滤条件，
+        其他向量库可以重写本方法，否则退化为扩大召回数量后在结果中过滤
+        """
+        if self.can_search_by_vector():
+            embedding = EmbeddingsFunAdapter(self.embed_model).embed_query(query)
+            return self.do_search_by_vector(embedding, top_k, score_threshold, filter=filter)
+        docs = self.do_search(query, top_k * 10, score_threshold)
+        return [x for x in docs if match_metadata(x[0].metadata, filter)][:top_k]
+
     @abstractmethod
     def do_add_doc(self,
                    docs: List[Document],
@@ -312,6 +649,13 @@ class KBService(ABC):
         """
         pass
 
+    def do_update_metadata(self, metadatas: Dict[str, Dict]) -> bool:
+        """
+        原地修改文档的部分 metadata：{doc_id: {key: value}}，与原有 metadata 合并，不重新向量化。
+        向量库不支持时返回 False，由调用方删除后重新添加
+        """
+        return False
+
     @abstractmethod
     def do_delete_doc(self,
                       kb_file: KnowledgeFile):
@@ -329,6 +673,9 @@ class KBService(ABC):
 
 
 class KBServiceFactory:
+    # 已存在知识库的 KBService 实例池，key 为 (kb_name, vs_type, embed_model)。
+    # 知识库被修改或删除后版本号变化，实例随之重建
+    pool = KBServicePool()
 
     @staticmethod
     def get_service(kb_name: str,
@@ -366,12 +713,29 @@ class KBServiceFactory:
             from server.knowledge_base.kb_service.default_kb_service import DefaultKBService
             return DefaultKBService(kb_name)
 
+    @staticmethod
+    def _get_registered(kb_name: str, vs_type: str, embed_model: str) -> KBService:
+        return KBServiceFactory.pool.get(key=(kb_name, vs_type, embed_model),
+                                         version=kb_metadata_cache.kb_version(kb_name),
+                                         factory=lambda: KBServiceFactory.get_service(kb_name, vs_type, embed_model))
+
     @staticmethod
     def get_service_by_name(kb_name: str) -> KBService:
         _, vs_type, embed_model = load_kb_from_db(kb_name)
         if _ is None:  # kb not in db, just return None
             return None
-        return KBServiceFactory.get_service(kb_name, vs_type, embed_model)
+        return KBServiceFactory._get_registered(kb_name, vs_type, embed_model)
+
+    @staticmethod
+    async def aget_service_by_name(kb_name: str) -> KBService:
+        """
+        get_service_by_name 的异步版本，供请求链路使用，查询数据库时不阻塞事件循环
+        """
+        _, vs_type, embed_model = await aload_kb_from_db(kb_name)
+        if _ is None:
+            return None
+        # 构造实例、健康检查都会阻塞（建立连接等），在线程池中执行
+        return await run_in_threadpool(KBServiceFactory._get_registered, kb_name, vs_type, embed_model)
 
     @staticmethod
     def get_default():
@@ -456,33 +820,40 @@ def get_kb_file_details(kb_name: str) -> List[Dict]:
 
 
 class EmbeddingsFunAdapter(Embeddings):
+    '''
+    批量向量化（embed_documents / embed_queries）返回 float32 二维数组，不再转换为 Python 列表，
+    向量库直接使用数组写入或检索；单条查询的 embed_query 仍返回列表
+    '''
+
     def __init__(self, embed_model: str = EMBEDDING_MODEL):
         self.embed_model = embed_model
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
         embeddings = embed_texts(texts=texts, embed_model=self.embed_model, to_query=False).data
-        return normalize(embeddings).tolist()
+        return normalize(embeddings)
 
     def embed_query(self, text: str) -> List[float]:
         response = embed_texts(texts=[text], embed_model=self.embed_model, to_query=True)
         if response.data is None:
             return []
-        embeddings = response.data
-        query_embed = embeddings[0]
-        query_embed_2d = np.reshape(query_embed, (1, -1))  # 将一维数组转换为二维数组
-        normalized_query_embed = normalize(query_embed_2d)
-        return normalized_query_embed[0].tolist()  # 将结果转换为一维数组并返回
+        return normalize(response.data[:1])[0].tolist()
+
+    def embed_queries(self, texts: List[str]) -> np.ndarray:
+        '''
+        一次调用向量化多条查询
+        '''
+        response = embed_texts(texts=texts, embed_model=self.embed_model, to_query=True)
+        if response.data is None:
+            return []
+        return normalize(response.data)
 
-    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+    async def aembed_documents(self, texts: List[str]) -> np.ndarray:
         embeddings = (await aembed_texts(texts=texts, embed_model=self.embed_model, to_query=False)).data
-        return normalize(embeddings).tolist()
+        return normalize(embeddings)
 
     async def aembed_query(self, text: str) -> List[float]:
         embeddings = (await aembed_texts(texts=[text], embed_model=self.embed_model, to_query=True)).data
-        query_embed = embeddings[0]
-        query_embed_2d = np.reshape(query_embed, (1, -1))  # 将一维数组转换为二维数组
-        normalized_query_embed = normalize(query_embed_2d)
-        return normalized_query_embed[0].tolist()  # 将结果转换为一维数组并返回
+        return normalize(embeddings[:1])[0].tolist()
 
 
 def score_threshold_process(score_threshold, k, docs):
@@ -1,5 +1,5 @@
 import uuid
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import chromadb
 from chromadb.api.types import (GetResult, QueryResult)
@@ -8,7 +8,7 @@ from langchain.docstore.document import Document
 from configs import SCORE_THRESHOLD
 from server.knowledge_base.kb_service.base import (EmbeddingsFunAdapter,
                                                    KBService, SupportedVSType)
-from server.knowledge_base.utils import KnowledgeFile, get_kb_path, get_vs_path
+from server.knowledge_base.utils import KnowledgeFile, get_kb_path, get_vs_path, metadata_filter_values
 
 
 def _get_result_to_documents(get_result: GetResult) -> List[Document]:
@@ -24,17 +24,17 @@ def _get_result_to_documents(get_result: GetResult) -> List[Document]:
     return document_list
 
 
-def _results_to_docs_and_scores(results: Any) -> List[Tuple[Document, float]]:
+def _results_to_docs_and_scores(results: Any, i: int = 0) -> List[Tuple[Document, float]]:
     """
     from langchain_community.vectorstores.chroma import Chroma
+    i 为批量查询时第几条查询的结果
     """
     return [
-        # TODO: Chroma can do batch querying,
         (Document(page_content=result[0], metadata=result[1] or {}), result[2])
         for result in zip(
-            results["documents"][0],
-            results["metadatas"][0],
-            results["distances"][0],
+            results["documents"][i],
+            results["metadatas"][i],
+            results["distances"][i],
         )
     ]
 
@@ -61,6 +61,10 @@ class ChromaKBService(KBService):
         self.client = chromadb.PersistentClient(path=self.vs_path)
         self.collection = self.client.get_or_create_collection(self.kb_name)
 
+    def health_check(self) -> bool:
+        self.client.heartbeat()
+        return True
+
     def do_create_kb(self) -> None:
         # In ChromaDB, creating a KB is equivalent to creating a collection
         self.collection = self.client.get_or_create_collection(self.kb_name)
@@ -77,18 +81,49 @@ class ChromaKBService(KBService):
         Tuple[Document, float]]:
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
-        query_result: QueryResult = self.collection.query(query_embeddings=embeddings, n_results=top_k)
+        return self.do_search_by_vector(embeddings, top_k, score_threshold)
+
+    def do_search_by_vector(self, embedding: List[float], top_k: int, score_threshold: float = SCORE_THRESHOLD,
+                            filter: Dict = None) -> List[Tuple[Document, float]]:
+        query_result: QueryResult = self.collection.query(query_embeddings=embedding, n_results=top_k,
+                                                          where=self._chroma_where(filter))
         return _results_to_docs_and_scores(query_result)
 
+    @staticmethod
+    def _chroma_where(filter: Dict = None) -> Optional[Dict]:
+        if not filter:
+            return None
+        clauses = []
+        for k, v in filter.items():
+            values = metadata_filter_values(v)
+            clauses.append({k: values[0]} if len(values) == 1 else {k: {"$in": values}})
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    def normalize_score(self, score: float) -> float:
+        # chroma 默认 l2 度量返回平方距离，向量已归一化，取值 [0, 4]
+        return min(max(float(score) / 4, 0.0), 1.0)
+
+    def do_search_batch(self, queries: List[str], top_k: int, score_threshold: float = SCORE_THRESHOLD) -> List[
+        List[Tuple[Document, float]]]:
+        embed_func = EmbeddingsFunAdapter(self.embed_model)
+        embeddings = embed_func.embed_queries(queries)
+        if len(embeddings) != len(queries):
+            return [[] for _ in queries]
+        query_result: QueryResult = self.collection.query(query_embeddings=embeddings.tolist(), n_results=top_k)
+        return [_results_to_docs_and_scores(query_result, i) for i in range(len(queries))]
+
     def do_add_doc(self, docs: List[Document], **kwargs) -> List[Dict]:
         doc_infos = []
+        if not docs:
+            return doc_infos
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         texts = [doc.page_content for doc in docs]
         metadatas = [doc.metadata for doc in docs]
         embeddings = embed_func.embed_documents(texts=texts)
         ids = [str(uuid.uuid1()) for _ in range(len(texts))]
-        for _id, text, embedding, metadata in zip(ids, texts, embeddings, metadatas):
-            self.collection.add(ids=_id, embeddings=embedding, metadatas=metadata, documents=text)
+        # chromadb 只接受列表形式的向量，一次写入全部文本块
+        self.collection.add(ids=ids, embeddings=embeddings.tolist(), metadatas=metadatas, documents=texts)
+        for _id, metadata in zip(ids, metadatas):
             doc_infos.append({"id": _id, "metadata": metadata})
         return doc_infos
 
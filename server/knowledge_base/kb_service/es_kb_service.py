@@ -1,12 +1,12 @@
-from typing import List
+from typing import Dict, List
 import os
 import shutil
 from langchain.embeddings.base import Embeddings
 from langchain.schema import Document
 from langchain.vectorstores.elasticsearch import ElasticsearchStore
 from configs import KB_ROOT_PATH, EMBEDDING_MODEL, EMBEDDING_DEVICE, CACHED_VS_NUM
-from server.knowledge_base.kb_service.base import KBService, SupportedVSType
-from server.knowledge_base.utils import KnowledgeFile
+from server.knowledge_base.kb_service.base import KBService, SupportedVSType, EmbeddingsFunAdapter
+from server.knowledge_base.utils import KnowledgeFile, metadata_filter_values
 from server.utils import load_local_embeddings
 from elasticsearch import Elasticsearch,BadRequestError
 from configs import logger
@@ -92,6 +92,13 @@ class ESKBService(KBService):
             logger.error(e)
             # raise e
 
+    def health_check(self) -> bool:
+        return bool(self.es_client_python.ping())
+
+    def close(self):
+        self.es_client_python.close()
+        self.db_init.client.close()
+
 
 
     @staticmethod
@@ -149,11 +156,42 @@ class ESKBService(KBService):
 
 
 
+    def _apply_threshold(self, docs, score_threshold: float):
+        # ES 返回相关度分数（越大越相关），换算为距离后与 score_threshold 比较，与其他向量库的阈值含义一致
+        if score_threshold is None:
+            return docs
+        return [(doc, score) for doc, score in docs if self.normalize_score(score) <= score_threshold]
+
     def do_search(self, query:str, top_k: int, score_threshold: float):
         # 文本相似性检索
         docs = self.db_init.similarity_search_with_score(query=query,
                                          k=top_k)
-        return docs
+        return self._apply_threshold(docs, score_threshold)
+
+    def do_search_filtered(self, query: str, top_k: int, score_threshold: float, filter: Dict):
+        # 过滤条件作为 knn 检索的 filter，由 Elasticsearch 在近邻检索时过滤
+        es_filter = []
+        for k, v in filter.items():
+            values = metadata_filter_values(v)
+            field = f"metadata.{k}.keyword" if all(isinstance(x, str) for x in values) else f"metadata.{k}"
+            es_filter.append({"terms": {field: values}})
+        docs = self.db_init.similarity_search_with_score(query=query, k=top_k, filter=es_filter)
+        return self._apply_threshold(docs, score_threshold)
+
+    def normalize_score(self, score: float) -> float:
+        # COSINE 相关度分数为 (1 + cos) / 2，越大越相关
+        return min(max(1 - float(score), 0.0), 1.0)
+
+    def do_search_batch(self, queries: List[str], top_k: int, score_threshold: float):
+        # 一次性向量化全部查询，与单条检索一样经过查询向量缓存与批处理
+        embeddings = EmbeddingsFunAdapter(self.embed_model).embed_queries(queries)
+        if len(embeddings) != len(queries):
+            return [[] for _ in queries]
+        return [self._apply_threshold(
+                    self.db_init.similarity_search_by_vector_with_relevance_scores(embedding=embedding.tolist(),
+                                                                                   k=top_k),
+                    score_threshold)
+                for embedding in embeddings]
 
     def get_doc_by_ids(self, ids: List[str]) -> List[Document]:
         results = []
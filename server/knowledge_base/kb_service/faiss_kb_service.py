@@ -1,19 +1,41 @@
+import heapq
+import itertools
 import os
 import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-from configs import SCORE_THRESHOLD
-from server.knowledge_base.kb_service.base import KBService, SupportedVSType, EmbeddingsFunAdapter
-from server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool, ThreadSafeFaiss
-from server.knowledge_base.utils import KnowledgeFile, get_kb_path, get_vs_path
+import faiss
+import numpy as np
+from configs import SCORE_THRESHOLD, FAISS_COPY_ON_WRITE, FAISS_SEARCH_THREADS, logger, log_verbose
+from server.knowledge_base.kb_service.base import KBService, KBServiceFactory, SupportedVSType, EmbeddingsFunAdapter
+from server.knowledge_base.kb_cache.faiss_cache import (kb_faiss_pool, ThreadSafeFaiss, add_embeddings, delete_docs,
+                                                        update_metadata)
+from server.knowledge_base.kb_cache.faiss_index import get_tombstones, is_flat, search_parameters, upgrade_target
+from server.knowledge_base.kb_cache.faiss_metadata_index import get_metadata_index
+from server.knowledge_base.kb_cache.faiss_shards import ShardLayout, load_shard_layout, save_shard_layout, shard_path
+from server.db.repository.knowledge_base_repository import update_kb_index_type
+from server.knowledge_base.model.kb_document_model import DocumentWithVSId
+from server.knowledge_base.utils import KnowledgeFile, get_kb_path, get_vs_path, match_metadata
 from server.utils import torch_gc
 from langchain.docstore.document import Document
-from typing import List, Dict, Optional, Tuple
+from typing import Callable, List, Dict, Optional, Set, Tuple
+
+
+# 分片向量库并行检索的线程池，faiss 检索时释放 GIL，多个分片可以同时计算
+_shard_executor = ThreadPoolExecutor(max_workers=FAISS_SEARCH_THREADS or None, thread_name_prefix="faiss_shard")
+# 正在后台加载的分片缓存键、正在转换索引类型的向量库 (kb_name, vector_name)，避免重复提交
+_loading_shards: Set[Tuple] = set()
+_upgrading: Set[Tuple] = set()
+_background_lock = threading.Lock()
 
 
 class FaissKBService(KBService):
     vs_path: str
     kb_path: str
     vector_name: str = None
+    layout: ShardLayout
  
     def vs_type(self) -> str:
         return SupportedVSType.FAISS
@@ -24,31 +46,104 @@ class FaissKBService(KBService):
     def get_kb_path(self):
         return get_kb_path(self.kb_name)
 
-    def load_vector_store(self) -> ThreadSafeFaiss:
+    def load_vector_store(self, shard: int = None) -> ThreadSafeFaiss:
+        '''
+        shard 为分片编号，未分片的向量库为 None
+        '''
         return kb_faiss_pool.load_vector_store(kb_name=self.kb_name,
                                                vector_name=self.vector_name,
-                                               embed_model=self.embed_model)
+                                               embed_model=self.embed_model,
+                                               shard=shard)
+
+    def _cached_shard(self, shard: Optional[int]) -> Optional[ThreadSafeFaiss]:
+        # 已加载完成的分片，不等待正在加载的分片
+        return kb_faiss_pool.get_loaded(kb_faiss_pool.cache_key(self.kb_name, self.vector_name, shard))
+
+    def _load_shard_async(self, shard: Optional[int]):
+        key = kb_faiss_pool.cache_key(self.kb_name, self.vector_name, shard)
+        with _background_lock:
+            if key in _loading_shards:
+                return
+            _loading_shards.add(key)
+
+        def load():
+            try:
+                self.load_vector_store(shard)
+            except Exception as e:
+                msg = f"后台加载向量库分片 {key} 出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+            finally:
+                with _background_lock:
+                    _loading_shards.discard(key)
+
+        _shard_executor.submit(load)
+
+    def _map_shards(self, func: Callable[[ThreadSafeFaiss], object]) -> List:
+        '''
+        在各分片上执行 func，返回各分片的结果。多个分片时在线程池中并行执行。
+        已有分片缓存时只在已缓存的分片上执行，未缓存的分片提交到后台加载，检索不被加载阻塞，
+        加载完成前的结果不包含这些分片；所有分片都未缓存时等待加载
+        '''
+        shards = self.layout.shards
+        if len(shards) == 1:
+            return [func(self.load_vector_store(shards[0]))]
+        cached = {s: self._cached_shard(s) for s in shards}
+        items = [x for x in cached.values() if x is not None]
+        if not items:
+            futures = [_shard_executor.submit(lambda s=s: func(self.load_vector_store(s))) for s in shards]
+            return [f.result() for f in futures]
+        missing = [s for s, x in cached.items() if x is None]
+        if missing:
+            logger.info(f"知识库 {self.kb_name} 的分片 {missing} 尚未加载，本次检索不包含这些分片")
+            for s in missing:
+                self._load_shard_async(s)
+        futures = [_shard_executor.submit(func, x) for x in items]
+        return [f.result() for f in futures]
+
+    @staticmethod
+    def _merge_results(results: List[List[Tuple[Document, float]]], top_k: int) -> List[Tuple[Document, float]]:
+        # 各分片的结果已按距离升序排列，用堆合并取整体的 top_k
+        if len(results) == 1:
+            return results[0]
+        return heapq.nsmallest(top_k, itertools.chain(*results), key=lambda x: x[1])
 
     def save_vector_store(self):
-        self.load_vector_store().save(self.vs_path)
+        for shard in self.layout.shards:
+            # 只保存已加载的分片，未加载的分片没有未保存的修改
+            vs_item = kb_faiss_pool.get(kb_faiss_pool.cache_key(self.kb_name, self.vector_name, shard))
+            if vs_item is not None:
+                vs_item.flush(shard_path(self.vs_path, shard))
+        super().save_vector_store()
 
     def get_doc_by_ids(self, ids: List[str]) -> List[Document]:
-        with self.load_vector_store().acquire() as vs:
-            return [vs.docstore._dict.get(id) for id in ids]
+        docs = {}
+        for shard in self.layout.shards_of_ids(ids):
+            with self.load_vector_store(shard).acquire(shared=True) as vs:
+                for id in ids:
+                    if (doc := vs.docstore._dict.get(id)) is not None:
+                        docs[id] = doc
+        return [docs.get(id) for id in ids]
 
     def del_doc_by_ids(self, ids: List[str]) -> bool:
-        with self.load_vector_store().acquire() as vs:
-            vs.delete(ids)
+        for shard in self.layout.shards_of_ids(ids):
+            vs_item = self.load_vector_store(shard)
+            with vs_item.acquire() as vs:
+                vs_item.ensure_writable()
+                vs_item.log_delete(delete_docs(vs, ids))
 
     def do_init(self):
         self.vector_name = self.vector_name or self.embed_model
         self.kb_path = self.get_kb_path()
         self.vs_path = self.get_vs_path()
+        self.layout = load_shard_layout(self.vs_path, self.kb_name)
 
     def do_create_kb(self):
         if not os.path.exists(self.vs_path):
             os.makedirs(self.vs_path)
-        self.load_vector_store()
+        save_shard_layout(self.vs_path, self.layout)
+        for shard in self.layout.shards:
+            self.load_vector_store(shard)
 
     def do_drop_kb(self):
         self.clear_vs()
@@ -64,45 +159,250 @@ class FaissKBService(KBService):
                   ) -> List[Tuple[Document, float]]:
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
-        with self.load_vector_store().acquire() as vs:
-            docs = vs.similarity_search_with_score_by_vector(embeddings, k=top_k, score_threshold=score_threshold)
+        return self.do_search_by_vector(embeddings, top_k, score_threshold)
+
+    def do_search_by_vector(self,
+                            embedding: List[float],
+                            top_k: int,
+                            score_threshold: float = SCORE_THRESHOLD,
+                            filter: Dict = None,
+                            ) -> List[Tuple[Document, float]]:
+        def search(vs_item: ThreadSafeFaiss) -> List[Tuple[Document, float]]:
+            with vs_item.acquire(shared=True) as vs:
+                if filter:
+                    return self._search_filtered(vs, embedding, top_k, score_threshold, filter)
+                scores, indices = self._search_index(vs, np.array([embedding], dtype=np.float32), top_k)
+                return self._collect_results(vs, scores[0], indices[0], score_threshold)
+
+        return self._merge_results(self._map_shards(search), top_k)
+
+    @staticmethod
+    def _search_index(vs, embeddings: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # 排除 HNSW/IVF 索引中标记删除的向量
+        params = search_parameters(vs.index, get_tombstones(vs).selector())
+        return vs.index.search(embeddings, top_k, params=params)
+
+    @staticmethod
+    def _filter_ids(vs, filter: Dict) -> List[str]:
+        """
+        返回 metadata 满足过滤条件的文档 id。已建立索引的键由倒排索引直接定位，
+        其余的键只在候选文档中逐个比对
+        """
+        index = get_metadata_index(vs)
+        ids = index.filter_ids(filter)
+        if index.indexed(filter):
+            return list(ids)
+        docs = vs.docstore._dict
+        if ids is None:
+            return [k for k, v in docs.items() if match_metadata(v.metadata, filter)]
+        return [k for k in ids if k in docs and match_metadata(docs[k].metadata, filter)]
+
+    def _filter_positions(self, vs, filter: Dict) -> List[int]:
+        """
+        返回 metadata 满足过滤条件的向量在索引中的位置
+        """
+        ids = self._filter_ids(vs, filter)
+        return get_metadata_index(vs).positions(vs.index_to_docstore_id, ids)
+
+    def _search_filtered(self, vs, embedding: List[float], top_k: int, score_threshold: float,
+                         filter: Dict) -> List[Tuple[Document, float]]:
+        # 通过 IDSelector 让 faiss 只计算满足条件的向量，先过滤再取 top_k，
+        # 避免过滤条件较严时先取 top_k 再过滤导致结果不足。已删除的文档不在 metadata 索引中，无需再排除
+        positions = self._filter_positions(vs, filter)
+        if not positions:
+            return []
+        selector = faiss.IDSelectorBatch(np.array(positions, dtype=np.int64))
+        params = search_parameters(vs.index, selector)
+        x = np.array([embedding], dtype=np.float32)
+        scores, indices = vs.index.search(x, min(top_k, len(positions)), params=params)
+        return self._collect_results(vs, scores[0], indices[0], score_threshold)
+
+    @staticmethod
+    def _collect_results(vs, scores, indices, score_threshold: float) -> List[Tuple[Document, float]]:
+        # 与 similarity_search_with_score_by_vector 的阈值规则一致（距离越小越相关）
+        docs = []
+        for score, i in zip(scores, indices):
+            if i == -1:
+                continue
+            if score_threshold is not None and score > score_threshold:
+                continue
+            doc = vs.docstore.search(vs.index_to_docstore_id[i])
+            if isinstance(doc, Document):
+                docs.append((doc, float(score)))
         return docs
 
+    def normalize_score(self, score: float) -> float:
+        # 向量已归一化，平方 L2 距离 = 2 - 2cos，取值 [0, 4]
+        return min(max(float(score) / 4, 0.0), 1.0)
+
+    def do_search_batch(self,
+                        queries: List[str],
+                        top_k: int,
+                        score_threshold: float = SCORE_THRESHOLD,
+                        ) -> List[List[Tuple[Document, float]]]:
+        embed_func = EmbeddingsFunAdapter(self.embed_model)
+        embeddings = np.array(embed_func.embed_queries(queries), dtype=np.float32)
+        if len(embeddings) != len(queries):
+            return [[] for _ in queries]
+
+        def search(vs_item: ThreadSafeFaiss) -> List[List[Tuple[Document, float]]]:
+            with vs_item.acquire(shared=True) as vs:
+                # 一次矩阵检索 (n, d)
+                scores, indices = self._search_index(vs, embeddings, top_k)
+                return [self._collect_results(vs, row_scores, row_indices, score_threshold)
+                        for row_scores, row_indices in zip(scores, indices)]
+
+        per_shard = self._map_shards(search)
+        return [self._merge_results([x[n] for x in per_shard], top_k) for n in range(len(queries))]
+
+    def accepts_embeddings(self) -> bool:
+        return True
+
     def do_add_doc(self,
                    docs: List[Document],
                    **kwargs,
                    ) -> List[Dict]:
-        data = self._docs_to_embeddings(docs) # 将向量化单独出来可以减少向量库的锁定时间
+        data = self._docs_to_embeddings(docs, kwargs.get("embeddings")) # 将向量化单独出来可以减少向量库的锁定时间
+        ids = kwargs.get("ids") or [str(uuid.uuid4()) for _ in docs]
 
-        with self.load_vector_store().acquire() as vs:
-            ids = vs.add_embeddings(text_embeddings=zip(data["texts"], data["embeddings"]),
-                                    metadatas=data["metadatas"],
-                                    ids=kwargs.get("ids"))
-            if not kwargs.get("not_refresh_vs_cache"):
-                vs.save_local(self.vs_path)
+        save_shard_layout(self.vs_path, self.layout)
+        groups: Dict[Optional[int], List[int]] = {}
+        for i, (id, metadata) in enumerate(zip(ids, data["metadatas"])):
+            groups.setdefault(self.layout.shard_of(id, metadata.get("source", "")), []).append(i)
+        for shard, rows in groups.items():
+            if len(groups) == 1:
+                texts, embeddings, metadatas, shard_ids = data["texts"], data["embeddings"], data["metadatas"], ids
+            else:
+                texts = [data["texts"][i] for i in rows]
+                embeddings = data["embeddings"][rows]
+                metadatas = [data["metadatas"][i] for i in rows]
+                shard_ids = [ids[i] for i in rows]
+            self._add_to_shard(shard, texts, embeddings, metadatas, shard_ids,
+                               save=not kwargs.get("not_refresh_vs_cache"))
+        self._maybe_upgrade_index()
         doc_infos = [{"id": id, "metadata": doc.metadata} for id, doc in zip(ids, docs)]
         torch_gc()
         return doc_infos
 
+    def _add_to_shard(self,
+                      shard: Optional[int],
+                      texts: List[str],
+                      embeddings: np.ndarray,
+                      metadatas: List[Dict],
+                      ids: List[str],
+                      save: bool = True):
+        vs_item = self.load_vector_store(shard)
+        vs_path = shard_path(self.vs_path, shard)
+        if FAISS_COPY_ON_WRITE:
+            # 在副本上写入，检索不会被长时间的写入阻塞
+            with vs_item.copy_on_write() as vs:
+                add_embeddings(vs, texts, embeddings, metadatas, ids=ids)
+                vs_item.log_add(ids, texts, embeddings, metadatas)
+        else:
+            with vs_item.acquire() as vs:
+                vs_item.ensure_writable()
+                add_embeddings(vs, texts, embeddings, metadatas, ids=ids)
+                vs_item.log_add(ids, texts, embeddings, metadatas)
+        if save:
+            vs_item.flush(vs_path)
+
+    def _maybe_upgrade_index(self):
+        '''
+        按整个知识库的向量数量判断是否转换索引类型（见 upgrade_target）。先只用已缓存的分片判断，
+        需要转换时再加载全部分片，所有分片转换为同一类型，全部完成后记录一次到数据库
+        '''
+        cached = [self._cached_shard(s) for s in self.layout.shards]
+        if upgrade_target([x.obj.index for x in cached if x is not None], self.kb_name) is None:
+            return
+        items = {s: self.load_vector_store(s) for s in self.layout.shards}
+        index_type = upgrade_target([x.obj.index for x in items.values()], self.kb_name)
+        if index_type is None:
+            return
+        key = (self.kb_name, self.vector_name)
+        with _background_lock:
+            if key in _upgrading:
+                return
+            _upgrading.add(key)
+
+        def upgrade():
+            # 转换索引类型耗时较长，在后台逐个分片进行，每个分片完成后完整保存，重新加载时由 index.faiss 恢复
+            try:
+                for shard, vs_item in items.items():
+                    if is_flat(vs_item.obj.index):
+                        vs_item.rebuild(index_type)
+                        vs_item.save(shard_path(self.vs_path, shard))
+                update_kb_index_type(self.kb_name, index_type)
+            except Exception as e:
+                msg = f"转换知识库 {self.kb_name} 的索引类型出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+            finally:
+                with _background_lock:
+                    _upgrading.discard(key)
+
+        threading.Thread(target=upgrade, daemon=True).start()
+
+    def do_update_metadata(self, metadatas: Dict[str, Dict]) -> bool:
+        for shard in self.layout.shards_of_ids(list(metadatas)):
+            vs_item = self.load_vector_store(shard)
+            with vs_item.acquire() as vs:
+                updated = {k: v for k, v in metadatas.items() if k in vs.docstore._dict}
+                if updated:
+                    vs_item.ensure_writable()
+                    update_metadata(vs, updated)
+                    vs_item.log_update(updated)
+        return True
+
     def do_delete_doc(self,
                       kb_file: KnowledgeFile,
                       **kwargs):
-        with self.load_vector_store().acquire() as vs:
-            ids = [k for k, v in vs.docstore._dict.items() if v.metadata.get("source").lower() == kb_file.filename.lower()]
-            if len(ids) > 0:
-                vs.delete(ids)
+        ids = []
+        for shard in self.layout.shards_of_source(kb_file.filename):
+            vs_item = self.load_vector_store(shard)
+            with vs_item.acquire() as vs:
+                shard_ids = list(get_metadata_index(vs).lookup("source", kb_file.filename, ignore_case=True))
+                if len(shard_ids) > 0:
+                    vs_item.ensure_writable()
+                    vs_item.log_delete(delete_docs(vs, shard_ids))
             if not kwargs.get("not_refresh_vs_cache"):
-                vs.save_local(self.vs_path)
+                vs_item.flush(shard_path(self.vs_path, shard))
+            ids.extend(shard_ids)
         return ids
 
+    def list_docs(self, file_name: str = None, metadata: Dict = {}) -> List[DocumentWithVSId]:
+        """
+        按文件名和已建立索引的 metadata 键列出文档时直接查询倒排索引，其他情况查询数据库
+        """
+        filter = dict(metadata or {})
+        if file_name:
+            filter["source"] = file_name
+        if filter:
+            result = []
+            shards = self.layout.shards_of_source(file_name) if file_name else self.layout.shards
+            for shard in shards:
+                with self.load_vector_store(shard).acquire(shared=True) as vs:
+                    if not get_metadata_index(vs).indexed(filter):
+                        break
+                    # 按向量序号排序，与入库顺序一致
+                    ids = [vs.index_to_docstore_id[i] for i in self._filter_positions(vs, filter)]
+                    docs = [(k, vs.docstore._dict.get(k)) for k in ids]
+                    result.extend(DocumentWithVSId(**doc.dict(), id=k) for k, doc in docs if doc is not None)
+            else:
+                return result
+        return super().list_docs(file_name=file_name, metadata=metadata)
+
     def do_clear_vs(self):
         with kb_faiss_pool.atomic:
-            kb_faiss_pool.pop((self.kb_name, self.vector_name))
+            for shard in self.layout.shards:
+                kb_faiss_pool.pop(kb_faiss_pool.cache_key(self.kb_name, self.vector_name, shard))
         try:
             shutil.rmtree(self.vs_path)
         except Exception:
             ...
         os.makedirs(self.vs_path, exist_ok=True)
+        update_kb_index_type(self.kb_name, "Flat")
+        # 分片方式在实例的生命周期内不变，清空后从实例池中移除，重新获取的实例按当前配置确定分片方式
+        KBServiceFactory.pool.discard(self.kb_name)
 
     def exist_doc(self, file_name: str):
         if super().exist_doc(file_name):
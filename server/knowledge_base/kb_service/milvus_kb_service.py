@@ -1,3 +1,4 @@
+import json
 import shutil
 from typing import List, Dict, Optional
 
@@ -10,7 +11,21 @@ from server.db.repository import list_file_num_docs_id_by_kb_name_and_file_name
 
 from server.knowledge_base.kb_service.base import KBService, SupportedVSType, EmbeddingsFunAdapter, \
     score_threshold_process
-from server.knowledge_base.utils import KnowledgeFile
+from server.knowledge_base.utils import KnowledgeFile, metadata_filter_values
+
+
+def milvus_filter_expr(filter: Dict) -> str:
+    '''
+    将 metadata 过滤条件转换为 milvus 的布尔表达式，如 source == "a.md" and page in [1, 2]
+    '''
+    exprs = []
+    for k, v in filter.items():
+        values = metadata_filter_values(v)
+        if len(values) == 1:
+            exprs.append(f"{k} == {json.dumps(values[0], ensure_ascii=False)}")
+        else:
+            exprs.append(f"{k} in {json.dumps(values, ensure_ascii=False)}")
+    return " and ".join(exprs)
 
 
 class MilvusKBService(KBService):
@@ -58,18 +73,63 @@ class MilvusKBService(KBService):
     def do_init(self):
         self._load_milvus()
 
+    def health_check(self) -> bool:
+        from pymilvus import utility
+        utility.get_server_version(using=self.milvus.alias)
+        return True
+
     def do_drop_kb(self):
         if self.milvus.col:
             self.milvus.col.release()
             self.milvus.col.drop()
 
     def do_search(self, query: str, top_k: int, score_threshold: float):
-        self._load_milvus()
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
-        docs = self.milvus.similarity_search_with_score_by_vector(embeddings, top_k)
+        return self.do_search_by_vector(embeddings, top_k, score_threshold)
+
+    def do_search_by_vector(self, embedding: List[float], top_k: int, score_threshold: float, filter: Dict = None):
+        self._load_milvus()
+        expr = None
+        if filter:
+            # metadata 的每个键是集合中的一个字段，不存在的字段无法匹配
+            if self.milvus.col is None or any(k not in self.milvus.fields for k in filter):
+                return []
+            expr = milvus_filter_expr(filter)
+        docs = self.milvus.similarity_search_with_score_by_vector(embedding, top_k, expr=expr)
         return score_threshold_process(score_threshold, top_k, docs)
 
+    def normalize_score(self, score: float) -> float:
+        metric_type = kbs_config.get("milvus_kwargs")["search_params"].get("metric_type", "L2")
+        if metric_type == "IP":
+            return min(max((1 - float(score)) / 2, 0.0), 1.0)
+        # milvus 的 L2 返回平方距离，向量已归一化，取值 [0, 4]
+        return min(max(float(score) / 4, 0.0), 1.0)
+
+    def do_search_batch(self, queries: List[str], top_k: int, score_threshold: float):
+        self._load_milvus()
+        if self.milvus.col is None:
+            return [[] for _ in queries]
+        embed_func = EmbeddingsFunAdapter(self.embed_model)
+        embeddings = embed_func.embed_queries(queries)
+        if len(embeddings) != len(queries):
+            return [[] for _ in queries]
+
+        output_fields = [x for x in self.milvus.fields if x != self.milvus._vector_field]
+        res = self.milvus.col.search(data=embeddings.tolist(),
+                                     anns_field=self.milvus._vector_field,
+                                     param=self.milvus.search_params,
+                                     limit=top_k,
+                                     output_fields=output_fields)
+        result = []
+        for hits in res:
+            docs = []
+            for hit in hits:
+                data = {x: hit.entity.get(x) for x in output_fields}
+                docs.append((Document(page_content=data.pop(self.milvus._text_field), metadata=data), hit.score))
+            result.append(score_threshold_process(score_threshold, top_k, docs))
+        return result
+
     def do_add_doc(self, docs: List[Document], **kwargs) -> List[Dict]:
         for doc in docs:
             for k, v in doc.metadata.items():
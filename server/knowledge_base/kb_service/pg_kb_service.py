@@ -1,15 +1,16 @@
 import json
-from typing import List, Dict, Optional
+from typing import List, Dict, Tuple
 
 from langchain.schema import Document
 from langchain.vectorstores.pgvector import PGVector, DistanceStrategy
-from sqlalchemy import text
+from sqlalchemy import text, cast, and_, or_
+from sqlalchemy.dialects.postgresql import JSONB
 
-from configs import kbs_config
+from configs import kbs_config, logger, log_verbose
 
 from server.knowledge_base.kb_service.base import SupportedVSType, KBService, EmbeddingsFunAdapter, \
-    score_threshold_process
-from server.knowledge_base.utils import KnowledgeFile
+    score_threshold_process, normalize
+from server.knowledge_base.utils import KnowledgeFile, metadata_filter_values
 import shutil
 import sqlalchemy
 from sqlalchemy.engine.base import Engine
@@ -18,6 +19,24 @@ from sqlalchemy.orm import Session
 
 class PGKBService(KBService):
     engine: Engine = sqlalchemy.create_engine(kbs_config.get("pg").get("connection_uri"), pool_size=10)
+    _metadata_index_created: bool = False
+
+    @classmethod
+    def _ensure_metadata_index(cls):
+        '''
+        cmetadata 是 json 列，按 cmetadata::jsonb 建立 GIN 索引，metadata 过滤与按文件删除用 @> 包含查询命中索引
+        '''
+        if cls._metadata_index_created:
+            return
+        try:
+            with cls.engine.begin() as conn:
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_langchain_pg_embedding_cmetadata "
+                                  "ON langchain_pg_embedding USING gin ((cmetadata::jsonb) jsonb_path_ops)"))
+            cls._metadata_index_created = True
+        except Exception as e:
+            msg = f"创建 langchain_pg_embedding 的 metadata 索引失败，按 metadata 过滤将扫描全表：{e}"
+            logger.error(f'{e.__class__.__name__}: {msg}',
+                         exc_info=e if log_verbose else None)
 
     def _load_pg_vector(self):
         self.pg_vector = PGVector(embedding_function=EmbeddingsFunAdapter(self.embed_model),
@@ -35,8 +54,24 @@ class PGKBService(KBService):
     def del_doc_by_ids(self, ids: List[str]) -> bool:
         return super().del_doc_by_ids(ids)
 
+    def do_update_metadata(self, metadatas: Dict[str, Dict]) -> bool:
+        with Session(PGKBService.engine) as session:
+            stmt = text("UPDATE langchain_pg_embedding "
+                        "SET cmetadata = (cmetadata::jsonb || CAST(:patch AS jsonb))::json "
+                        "WHERE custom_id = :id")
+            session.execute(stmt, [{"id": k, "patch": json.dumps(v, ensure_ascii=False)}
+                                   for k, v in metadatas.items()])
+            session.commit()
+        return True
+
     def do_init(self):
         self._load_pg_vector()
+        self._ensure_metadata_index()
+
+    def health_check(self) -> bool:
+        with PGKBService.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        return True
 
     def do_create_kb(self):
         pass
@@ -61,11 +96,75 @@ class PGKBService(KBService):
     def do_search(self, query: str, top_k: int, score_threshold: float):
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
-        docs = self.pg_vector.similarity_search_with_score_by_vector(embeddings, top_k)
+        return self.do_search_by_vector(embeddings, top_k, score_threshold)
+
+    def do_search_by_vector(self, embedding: List[float], top_k: int, score_threshold: float, filter: Dict = None):
+        if not filter:
+            docs = self.pg_vector.similarity_search_with_score_by_vector(embedding, top_k)
+        else:
+            docs = self._search_filtered(embedding, top_k, filter)
         return score_threshold_process(score_threshold, top_k, docs)
 
+    def _search_filtered(self, embedding: List[float], top_k: int, filter: Dict) -> List[Tuple[Document, float]]:
+        # PGVector 的过滤条件为 cmetadata->>key = value，无法使用索引；
+        # 这里改用 jsonb 包含查询，由 GIN 索引在数据库内先过滤再按距离排序取 top_k
+        pg_vector = self.pg_vector
+        store = pg_vector.EmbeddingStore
+        with Session(PGKBService.engine) as session:
+            collection = pg_vector.get_collection(session)
+            if not collection:
+                return []
+            distance = pg_vector.distance_strategy(embedding).label("distance")
+            results = (session.query(store, distance)
+                       .filter(store.collection_id == collection.uuid, self._pg_filter(filter))
+                       .order_by(sqlalchemy.asc(distance))
+                       .limit(top_k)
+                       .all())
+        return pg_vector._results_to_docs_and_scores(results)
+
+    @staticmethod
+    def _json_values(value) -> List:
+        # jsonb 包含查询区分类型，而 match_metadata 按字符串比较：数字同时匹配其字符串形式，反之亦然
+        values = [value]
+        if isinstance(value, str):
+            try:
+                parsed = json.loads(value)
+                if isinstance(parsed, (int, float)) and not isinstance(parsed, bool):
+                    values.append(parsed)
+            except ValueError:
+                ...
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values.append(str(value))
+        return values
+
+    def _pg_filter(self, filter: Dict):
+        metadata = cast(self.pg_vector.EmbeddingStore.cmetadata, JSONB)
+        return and_(*[or_(*[metadata.contains({k: x})
+                            for value in metadata_filter_values(v) for x in self._json_values(value)])
+                      for k, v in filter.items()])
+
+    def normalize_score(self, score: float) -> float:
+        # EUCLIDEAN 为欧氏距离，向量已归一化，取值 [0, 2]
+        return min(max(float(score) ** 2 / 4, 0.0), 1.0)
+
+    def do_search_batch(self, queries: List[str], top_k: int, score_threshold: float):
+        embed_func = EmbeddingsFunAdapter(self.embed_model)
+        embeddings = embed_func.embed_queries(queries)
+        if len(embeddings) != len(queries):
+            return [[] for _ in queries]
+        return [score_threshold_process(score_threshold, top_k,
+                                        self.pg_vector.similarity_search_with_score_by_vector(embedding, top_k))
+                for embedding in embeddings]
+
+    def accepts_embeddings(self) -> bool:
+        return True
+
     def do_add_doc(self, docs: List[Document], **kwargs) -> List[Dict]:
-        ids = self.pg_vector.add_documents(docs)
+        data = self._docs_to_embeddings(docs, kwargs.get("embeddings"))
+        # 与 EmbeddingsFunAdapter 一致写入归一化的向量，pgvector 直接接受 numpy 数组的各行
+        ids = self.pg_vector.add_embeddings(texts=data["texts"],
+                                            embeddings=normalize(data["embeddings"]),
+                                            metadatas=data["metadatas"])
         doc_infos = [{"id": id, "metadata": doc.metadata} for id, doc in zip(ids, docs)]
         return doc_infos
 
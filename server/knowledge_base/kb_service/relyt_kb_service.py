@@ -44,6 +44,14 @@ class RelytKBService(KBService):
         self._load_relyt_vector()
         self.do_create_kb()
 
+    def health_check(self) -> bool:
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        return True
+
+    def close(self):
+        self.engine.dispose()
+
     def do_create_kb(self):
         index_name = f"idx_{self.kb_name}_embedding"
         with self.engine.connect() as conn:
@@ -5,6 +5,7 @@ from langchain.vectorstores import Zilliz
 from configs import kbs_config
 from server.knowledge_base.kb_service.base import KBService, SupportedVSType, EmbeddingsFunAdapter, \
     score_threshold_process
+from server.knowledge_base.kb_service.milvus_kb_service import milvus_filter_expr
 from server.knowledge_base.utils import KnowledgeFile
 
 
@@ -52,18 +53,35 @@ class ZillizKBService(KBService):
     def do_init(self):
         self._load_zilliz()
 
+    def health_check(self) -> bool:
+        from pymilvus import utility
+        utility.get_server_version(using=self.zilliz.alias)
+        return True
+
     def do_drop_kb(self):
         if self.zilliz.col:
             self.zilliz.col.release()
             self.zilliz.col.drop()
 
     def do_search(self, query: str, top_k: int, score_threshold: float):
-        self._load_zilliz()
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
-        docs = self.zilliz.similarity_search_with_score_by_vector(embeddings, top_k)
+        return self.do_search_by_vector(embeddings, top_k, score_threshold)
+
+    def do_search_by_vector(self, embedding: List[float], top_k: int, score_threshold: float, filter: Dict = None):
+        self._load_zilliz()
+        expr = None
+        if filter:
+            if self.zilliz.col is None or any(k not in self.zilliz.fields for k in filter):
+                return []
+            expr = milvus_filter_expr(filter)
+        docs = self.zilliz.similarity_search_with_score_by_vector(embedding, top_k, expr=expr)
         return score_threshold_process(score_threshold, top_k, docs)
 
+    def normalize_score(self, score: float) -> float:
+        # 内积度量，分数为余弦相似度，越大越相关
+        return min(max((1 - float(score)) / 2, 0.0), 1.0)
+
     def do_add_doc(self, docs: List[Document], **kwargs) -> List[Dict]:
         for doc in docs:
             for k, v in doc.metadata.items():
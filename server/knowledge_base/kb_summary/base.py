@@ -5,7 +5,8 @@ from configs import (
     KB_ROOT_PATH)
 
 from abc import ABC, abstractmethod
-from server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool, ThreadSafeFaiss
+from server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool, ThreadSafeFaiss, add_embeddings
+from server.knowledge_base.kb_service.base import EmbeddingsFunAdapter
 import os
 import shutil
 from server.db.repository.knowledge_metadata_repository import add_summary_to_db, delete_summary_from_db
@@ -46,9 +47,16 @@ class KBSummaryService(ABC):
                                                create=True)
 
     def add_kb_summary(self, summary_combine_docs: List[Document]):
-        with self.load_vector_store().acquire() as vs:
-            ids = vs.add_documents(documents=summary_combine_docs)
-            vs.save_local(self.vs_path)
+        vs_item = self.load_vector_store()
+        # 向量化在加锁之前完成；add_embeddings 同时更新 metadata 索引，并保持紧凑的文档存储格式
+        texts = [doc.page_content for doc in summary_combine_docs]
+        metadatas = [doc.metadata for doc in summary_combine_docs]
+        embeddings = EmbeddingsFunAdapter(self.embed_model).embed_documents(texts)
+        with vs_item.acquire() as vs:
+            vs_item.ensure_writable()
+            ids = add_embeddings(vs, texts, embeddings, metadatas)
+            vs_item.log_add(ids, texts, embeddings, metadatas)
+        vs_item.save(self.vs_path)
 
         summary_infos = [{"summary_context": doc.page_content,
                           "summary_id": id,
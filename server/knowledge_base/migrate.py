@@ -28,6 +28,27 @@ def create_tables():
         AUTO_CREATE_TABLES = True
     if AUTO_CREATE_TABLES:
         Base.metadata.create_all(bind=engine)
+        add_missing_columns()
+
+
+def add_missing_columns():
+    '''
+    create_all 不会修改已存在的表，旧版本创建的表中缺少的（可为空的）字段在这里补上
+    '''
+    from sqlalchemy import inspect, text
+
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            col_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'))
+            logger.info(f"已为表 {table.name} 添加字段 {column.name}")
 
 
 def reset_tables():
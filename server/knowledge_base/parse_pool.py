@@ -0,0 +1,249 @@
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+import zlib
+from collections import deque
+from multiprocessing.connection import wait
+from typing import Callable, Dict, Generator, List, Optional, Tuple
+
+from langchain.docstore.document import Document
+
+from configs import (PARSE_PROCESS_WORKERS, PARSE_FILE_TIMEOUT, PARSE_WORKER_MAX_MEMORY, PARSE_WORKER_MAX_TASKS,
+                     logger, log_verbose)
+
+
+def pack_docs(docs: List[Document]) -> bytes:
+    '''
+    将文本块压缩序列化，减少进程间传输的数据量
+    '''
+    return zlib.compress(pickle.dumps([(d.page_content, d.metadata) for d in docs],
+                                      protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def unpack_docs(data: bytes) -> List[Document]:
+    return [Document(page_content=text, metadata=metadata) for text, metadata in pickle.loads(zlib.decompress(data))]
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _warmup():
+    # 预先导入加载器并初始化 OCR 模型，每个工作进程只需加载一次
+    try:
+        from document_loaders.ocr import get_ocr
+        get_ocr()
+    except Exception as e:
+        logger.warning(f"文档解析进程预热失败：{e}")
+
+
+def _parse(task: Dict) -> bytes:
+    from server.knowledge_base.utils import KnowledgeFile
+
+    task = dict(task)
+    file = KnowledgeFile(filename=task.pop("filename"),
+                         knowledge_base_name=task.pop("kb_name"),
+                         separators=task.pop("separators", None),
+                         loader_kwargs=task.pop("loader_kwargs", {}))
+    return pack_docs(file.file2text(**task))
+
+
+def _worker_main(conn, max_memory: int, max_tasks: int, parse: Callable[[Dict], bytes] = None):
+    parse = parse or _parse
+    _warmup()
+    done = 0
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            result = (True, parse(task))
+        except Exception as e:
+            msg = f"从文件 {task.get('kb_name')}/{task.get('filename')} 加载文档时出错：{e}"
+            logger.error(f'{e.__class__.__name__}: {msg}',
+                         exc_info=e if log_verbose else None)
+            result = (False, msg)
+        done += 1
+        # 处理任务数或内存占用超过上限时主动退出，由主进程重新拉起，避免解析器内存泄漏持续累积
+        exiting = (0 < max_tasks <= done) or (0 < max_memory < _rss_mb())
+        conn.send((*result, exiting))
+        if exiting:
+            break
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, ctx, max_memory: int, max_tasks: int, parse: Callable[[Dict], bytes] = None):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, max_memory, max_tasks, parse), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task: Optional[Dict] = None
+        self.deadline = 0.0
+
+    def submit(self, task: Dict, timeout: float):
+        self.task = task
+        self.deadline = time.time() + timeout if timeout > 0 else float("inf")
+        self.conn.send(task)
+
+    def kill(self):
+        try:
+            self.conn.close()
+        except Exception:
+            ...
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(timeout=5)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except Exception:
+            ...
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class ParseProcessPool:
+    '''
+    文档解析进程池，用于绕开 GIL 并行执行 OCR、unstructured 解析与文本切分。
+    - 工作进程启动时预热（导入加载器、初始化 OCR 模型），之后常驻复用；
+    - 单个文件超时后强制结束对应进程，其他文件不受影响；
+    - 进程崩溃只影响正在解析的文件，自动重新拉起；
+    - 进程处理任务数或内存占用超过上限后主动退出并被替换。
+    结果以压缩序列化的文本块返回。
+    parse_func 为工作进程中解析单个任务的函数（需可在子进程中导入），默认按 KnowledgeFile 加载并切分。
+    '''
+    parse_func: Callable[[Dict], bytes] = None
+
+    def __init__(self,
+                 workers: int = PARSE_PROCESS_WORKERS,
+                 timeout: float = PARSE_FILE_TIMEOUT,
+                 max_memory: int = PARSE_WORKER_MAX_MEMORY,
+                 max_tasks: int = PARSE_WORKER_MAX_TASKS):
+        self._ctx = multiprocessing.get_context("spawn")
+        self._size = max(workers, 1)
+        self._timeout = timeout
+        self._max_memory = max_memory
+        self._max_tasks = max_tasks
+        self._workers: List[_Worker] = []
+        # 只在分配任务、替换进程时持有；并发的 map 调用共享工作进程，各自接收自己任务的结果
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def _spawn(self) -> _Worker:
+        return _Worker(self._ctx, self._max_memory, self._max_tasks, self.parse_func)
+
+    def _replace(self, worker: _Worker, kill: bool = True):
+        # 调用方需持有 self._lock
+        if kill:
+            worker.kill()
+        else:
+            worker.process.join(timeout=5)
+        if worker in self._workers:
+            self._workers[self._workers.index(worker)] = self._spawn()
+
+    def _release(self, worker: _Worker, replace: bool = False, kill: bool = True):
+        with self._lock:
+            worker.task = None
+            if replace:
+                self._replace(worker, kill=kill)
+            self._idle.notify_all()
+
+    def _submit(self, pending: deque, busy: Dict):
+        '''
+        把待处理的任务分配给空闲的工作进程；没有空闲进程且本次调用没有进行中的任务时等待其他调用释放
+        '''
+        with self._lock:
+            while True:
+                while len(self._workers) < self._size:
+                    self._workers.append(self._spawn())
+                for worker in list(self._workers):
+                    if not pending:
+                        break
+                    if worker.task is None:
+                        if not worker.process.is_alive():
+                            self._replace(worker)
+                            continue
+                        worker.submit(pending.popleft(), self._timeout)
+                        busy[worker.conn] = worker
+                if busy or not pending:
+                    return
+                self._idle.wait(timeout=1.0)
+
+    def map(self, tasks: List[Dict]) -> Generator[Tuple[bool, Tuple[str, str, object]], None, None]:
+        '''
+        tasks 形如 {"filename", "kb_name", "separators", "loader_kwargs", 以及 file2text 的参数}
+        生成器返回值与 files2docs_in_thread 相同：status, (kb_name, file_name, docs | error)
+        '''
+        pending = deque(tasks)
+        busy: Dict[object, _Worker] = {}
+        try:
+            yield from self._run(pending, busy)
+        finally:
+            # 调用方提前结束时，正在解析的进程的结果已无人接收，直接替换掉
+            for worker in busy.values():
+                self._release(worker, replace=True)
+
+    def _run(self, pending: deque, busy: Dict) -> Generator:
+        while pending or busy:
+            self._submit(pending, busy)
+
+            now = time.time()
+            timeout = max(min(w.deadline for w in busy.values()) - now, 0) if busy else 0
+            for conn in wait(list(busy), timeout=min(timeout, 1.0)):
+                worker = busy.pop(conn)
+                task = worker.task
+                try:
+                    status, payload, exiting = conn.recv()
+                except (EOFError, OSError):
+                    msg = f"解析文件 {task['kb_name']}/{task['filename']} 时工作进程异常退出"
+                    logger.error(msg)
+                    self._release(worker, replace=True)
+                    yield False, (task["kb_name"], task["filename"], msg)
+                    continue
+                # 先取回结果再释放进程，释放后可能立即被其他调用占用
+                self._release(worker, replace=exiting, kill=False)
+                if status:
+                    yield True, (task["kb_name"], task["filename"], unpack_docs(payload))
+                else:
+                    yield False, (task["kb_name"], task["filename"], payload)
+
+            now = time.time()
+            for conn, worker in list(busy.items()):
+                if worker.deadline <= now:
+                    busy.pop(conn)
+                    task = worker.task
+                    msg = f"解析文件 {task['kb_name']}/{task['filename']} 超时（{self._timeout} 秒）"
+                    logger.error(msg)
+                    self._release(worker, replace=True)
+                    yield False, (task["kb_name"], task["filename"], msg)
+
+    def shutdown(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.stop()
+            self._workers = []
+
+
+_parse_pool: Optional[ParseProcessPool] = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool() -> ParseProcessPool:
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ParseProcessPool()
+        return _parse_pool
@@ -1,3 +1,4 @@
+import hashlib
 import importlib
 import json
 import os
@@ -21,6 +22,7 @@ from configs import (
     text_splitter_dict,
     LLM_MODELS,
     TEXT_SPLITTER_NAME,
+    PARSE_PROCESS_WORKERS,
 )
 from server.knowledge_base.oss import default_oss, OssType, oss_factory
 from server.utils import run_in_thread_pool, get_model_worker_config
@@ -56,6 +58,36 @@ def get_file_path(knowledge_base_name: str, doc_name: str):
         return str(file_path)
 
 
+# 文本块在文件中的位置，插入或删除文本块后会变化，不计入文本块哈希
+POSITIONAL_METADATA_KEYS = ("index",)
+
+
+def get_chunk_hash(doc: Document) -> str:
+    '''
+    文本块的内容哈希（文本 + 除位置外的 metadata），用于增量更新时比对文本块是否变化
+    '''
+    metadata = {k: v for k, v in doc.metadata.items() if k not in POSITIONAL_METADATA_KEYS}
+    content = json.dumps([doc.page_content, metadata], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def metadata_filter_values(value) -> List:
+    '''
+    metadata 过滤条件中单个键的取值，列表表示匹配其中任意一个值
+    '''
+    return list(value) if isinstance(value, (list, tuple, set)) else [value]
+
+
+def match_metadata(metadata: Dict, filter: Dict) -> bool:
+    '''
+    判断 metadata 是否满足过滤条件 {key: value 或 [value, ...]}，各键之间为“且”，按字符串比较
+    '''
+    for k, v in filter.items():
+        if k not in metadata or str(metadata[k]) not in {str(x) for x in metadata_filter_values(v)}:
+            return False
+    return True
+
+
 def list_kbs_from_folder():
     return [f for f in os.listdir(KB_ROOT_PATH)
             if os.path.isdir(os.path.join(KB_ROOT_PATH, f))]
@@ -371,6 +403,7 @@ def files2docs_in_thread(
 ) -> Generator:
     '''
     利用多线程批量将磁盘文件转化成langchain Document.
+    配置了 PARSE_PROCESS_WORKERS 时改用进程池解析。
     如果传入参数是Tuple，形式为(filename, kb_name)
     生成器返回值为 status, (kb_name, file_name, docs | error)
     '''
@@ -405,6 +438,19 @@ def files2docs_in_thread(
         except Exception as e:
             yield False, (file.kb_name, file.filename, str(e))
 
+    if PARSE_PROCESS_WORKERS > 0:
+        # 在进程池中解析，OCR/unstructured 等持有 GIL 的解析器可以真正并行
+        from server.knowledge_base.parse_pool import get_parse_pool
+
+        tasks = []
+        for kwargs in kwargs_list:
+            kwargs = dict(kwargs)
+            file = kwargs.pop("file")
+            tasks.append({"filename": file.filename, "kb_name": file.kb_name,
+                          "separators": file.separators, "loader_kwargs": file.loader_kwargs, **kwargs})
+        yield from get_parse_pool().map(tasks)
+        return
+
     for result in run_in_thread_pool(func=file2docs, params=kwargs_list):
         yield result
 
@@ -5,7 +5,7 @@ from langchain.schema import get_buffer_string, BaseMessage, HumanMessage, AIMes
 from langchain.schema.language_model import BaseLanguageModel
 
 from configs import MAX_TOKENS_INPUT
-from server.db.repository.message_repository import filter_message
+from server.db.repository.message_repository import filter_message, afilter_message
 
 
 class ConversationBufferDBMemory(BaseChatMemory):
@@ -23,6 +23,13 @@ class ConversationBufferDBMemory(BaseChatMemory):
         # fetch limited messages desc, and return reversed
 
         messages = filter_message(conversation_id=self.conversation_id, limit=self.message_limit)
+        return self._to_chat_messages(messages)
+
+    async def abuffer(self) -> List[BaseMessage]:
+        messages = await afilter_message(conversation_id=self.conversation_id, limit=self.message_limit)
+        return self._to_chat_messages(messages)
+
+    def _to_chat_messages(self, messages: List[Dict]) -> List[BaseMessage]:
         # 返回的记录按时间倒序，转为正序
         messages = list(reversed(messages))
         chat_messages: List[BaseMessage] = []
@@ -53,7 +60,13 @@ class ConversationBufferDBMemory(BaseChatMemory):
 
     def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
         """Return history buffer."""
-        buffer: Any = self.buffer
+        return self._format_buffer(self.buffer)
+
+    async def aload_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """异步链（acall）读取历史记录时不阻塞事件循环"""
+        return self._format_buffer(await self.abuffer())
+
+    def _format_buffer(self, buffer: Any) -> Dict[str, Any]:
         if self.return_messages:
             final_buffer: Any = buffer
         else:
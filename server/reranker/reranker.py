@@ -2,14 +2,238 @@ import os
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-from typing import Any, List, Optional
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 from sentence_transformers import CrossEncoder
-from typing import Optional, Sequence
 from langchain_core.documents import Document
 from langchain.callbacks.manager import Callbacks
 from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
 from llama_index.bridge.pydantic import Field, PrivateAttr
 
+from configs import (RERANKER_BATCH_WAIT, RERANKER_MAX_BATCH_PAIRS, RERANKER_CACHE_SIZE,
+                     logger, log_verbose)
+from server.knowledge_base.kb_cache.base import CachePool, ThreadSafeObject
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class _ScoreRequest:
+    def __init__(self, pairs: List[Tuple[str, str]]):
+        self.pairs = pairs
+        self.scores: List[float] = [0.0] * len(pairs)
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+
+
+class BatchedCrossEncoder:
+    '''
+    进程内共享的 CrossEncoder 推理服务：
+    - 并发请求的 (query, 文档) 对由后台线程合并，凑满 max_batch_pairs 或等待 batch_wait 秒后一起推理；
+    - 合并后的文本对按长度排序再分批，同一批长度相近，减少 padding；
+    - 按 (query 哈希, 文档内容哈希) 缓存相关度分数，同一问题重复检索到的文档不再计算。
+    '''
+
+    def __init__(self,
+                 model: CrossEncoder,
+                 batch_size: int = 32,
+                 batch_wait: float = RERANKER_BATCH_WAIT,
+                 max_batch_pairs: int = RERANKER_MAX_BATCH_PAIRS,
+                 cache_size: int = RERANKER_CACHE_SIZE):
+        self.model = model
+        self.batch_size = max(batch_size, 1)
+        self.batch_wait = batch_wait
+        self.max_batch_pairs = max(max_batch_pairs, 1)
+        self.cache_size = cache_size
+        self._cache: Dict[Tuple[str, str], float] = OrderedDict()
+        # 同时保护缓存与统计计数，调用线程与后台推理线程都会更新计数
+        self._cache_lock = threading.Lock()
+        self._queue: List[_ScoreRequest] = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._stats = {"requests": 0, "pairs": 0, "cache_hits": 0, "batches": 0, "forward_passes": 0,
+                       "predict_seconds": 0.0}
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _cache_get(self, keys: List[Tuple[str, str]]) -> List[Optional[float]]:
+        if self.cache_size == 0:
+            return [None] * len(keys)
+        with self._cache_lock:
+            result = []
+            for key in keys:
+                score = self._cache.get(key)
+                if score is not None:
+                    self._cache.move_to_end(key)
+                result.append(score)
+            return result
+
+    def _cache_put(self, items: List[Tuple[Tuple[str, str], float]]):
+        if self.cache_size == 0:
+            return
+        with self._cache_lock:
+            for key, score in items:
+                self._cache[key] = score
+                self._cache.move_to_end(key)
+            while self.cache_size > 0 and len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _add_stats(self, **kwargs):
+        with self._cache_lock:
+            for k, v in kwargs.items():
+                self._stats[k] += v
+
+    def score(self, query: str, passages: List[str]) -> List[float]:
+        '''
+        计算 query 与各文档的相关度分数，调用线程阻塞直到所在批次推理完成
+        '''
+        query_hash = _hash(query)
+        keys = [(query_hash, _hash(p)) for p in passages]
+        scores = self._cache_get(keys)
+        missing = [i for i, s in enumerate(scores) if s is None]
+        self._add_stats(requests=1, pairs=len(passages), cache_hits=len(passages) - len(missing))
+        if missing:
+            request = _ScoreRequest([(query, passages[i]) for i in missing])
+            with self._cond:
+                stopped = self._stopped
+                if not stopped:
+                    self._queue.append(request)
+                    self._cond.notify()
+            if stopped:
+                # 模型已被淘汰、后台线程已退出，仍持有该实例的调用方在当前线程推理
+                self._run_batch([request])
+            else:
+                request.done.wait()
+            if request.error is not None:
+                raise request.error
+            for i, s in zip(missing, request.scores):
+                scores[i] = s
+            self._cache_put([(keys[i], scores[i]) for i in missing])
+        return scores
+
+    def _take_batch(self) -> List[_ScoreRequest]:
+        with self._cond:
+            while not self._queue and not self._stopped:
+                self._cond.wait()
+            # 等待其他请求加入同一批次
+            deadline = time.time() + self.batch_wait
+            while not self._stopped and sum(len(r.pairs) for r in self._queue) < self.max_batch_pairs:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, size = [], 0
+            while self._queue and (not batch or size + len(self._queue[0].pairs) <= self.max_batch_pairs):
+                request = self._queue.pop(0)
+                batch.append(request)
+                size += len(request.pairs)
+            return batch
+
+    def stop(self):
+        '''
+        结束后台线程：已排队的请求推理完成后线程退出
+        '''
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _loop(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: List[_ScoreRequest]):
+        try:
+            self._predict(batch)
+        except Exception as e:
+            msg = f"reranker 推理出错：{e}"
+            logger.error(f'{e.__class__.__name__}: {msg}',
+                         exc_info=e if log_verbose else None)
+            for request in batch:
+                request.error = e
+        finally:
+            for request in batch:
+                request.done.set()
+
+    def _predict(self, batch: List[_ScoreRequest]):
+        pairs = [(request, i) for request in batch for i in range(len(request.pairs))]
+        # 按长度排序分桶，同一前向批次中的文本长度相近
+        pairs.sort(key=lambda x: len(x[0].pairs[x[1]][0]) + len(x[0].pairs[x[1]][1]))
+        start = time.time()
+        forward_passes = 0
+        for n in range(0, len(pairs), self.batch_size):
+            chunk = pairs[n: n + self.batch_size]
+            scores = self.model.predict(sentences=[list(request.pairs[i]) for request, i in chunk],
+                                        batch_size=self.batch_size,
+                                        show_progress_bar=False,
+                                        convert_to_numpy=True)
+            for (request, i), score in zip(chunk, scores):
+                request.scores[i] = float(score)
+            forward_passes += 1
+        self._add_stats(batches=1, forward_passes=forward_passes, predict_seconds=time.time() - start)
+
+    def stats(self) -> Dict:
+        with self._cache_lock:
+            cached = len(self._cache)
+            stats = dict(self._stats)
+        return {
+            **stats,
+            "predict_seconds": round(stats["predict_seconds"], 3),
+            "cache_hit_rate": round(stats["cache_hits"] / stats["pairs"], 4) if stats["pairs"] else 0.0,
+            "cached": cached,
+            "queued": len(self._queue),
+        }
+
+
+class RerankerPool(CachePool):
+    def _evict(self, key, reason: str):
+        item = self._cache.get(key)
+        super()._evict(key, reason)
+        # 淘汰的模型不再接收新请求，结束其后台推理线程
+        if isinstance(item, ThreadSafeObject) and isinstance(item.obj, BatchedCrossEncoder):
+            item.obj.stop()
+
+    def load_reranker(self,
+                      model_name_or_path: str,
+                      device: str,
+                      max_length: int,
+                      batch_size: int = 32) -> BatchedCrossEncoder:
+        '''
+        与 embeddings_pool 相同，模型在进程内只加载一次，各请求共用。
+        batch_size 决定后台推理的分批大小，也是缓存键的一部分：cache_num=1 时以不同 batch_size 加载会替换已加载的模型
+        '''
+        self.atomic.acquire()
+        key = (model_name_or_path, device, max_length, batch_size)
+        cache = self.get(key)
+        self._record_lookup(cache is not None)
+        if not cache:
+            item = ThreadSafeObject(key, pool=self)
+            self.set(key, item)
+            with item.acquire(msg="初始化"):
+                self.atomic.release()
+                model = CrossEncoder(model_name=model_name_or_path, max_length=max_length, device=device)
+                item.obj = BatchedCrossEncoder(model, batch_size=batch_size)
+                item.finish_loading()
+        else:
+            self.atomic.release()
+            item = cache
+        return item.obj
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        stats["models"] = {str(k): v.obj.stats() for k, v in list(self._cache.items())
+                           if isinstance(v, ThreadSafeObject) and v.obj is not None}
+        return stats
+
+
+reranker_pool = RerankerPool(cache_num=1)
+
 
 class LangchainReranker(BaseDocumentCompressor):
     """Document compressor that uses `Cohere Rerank API`."""
@@ -46,7 +270,8 @@ class LangchainReranker(BaseDocumentCompressor):
         # self.activation_fct=activation_fct
         # self.apply_softmax=apply_softmax
 
-        self._model = CrossEncoder(model_name=model_name_or_path, max_length=max_length, device=device)
+        self._model = reranker_pool.load_reranker(model_name_or_path, device=device, max_length=max_length,
+                                                  batch_size=batch_size)
         super().__init__(
             top_n=top_n,
             model_name_or_path=model_name_or_path,
@@ -79,23 +304,14 @@ class LangchainReranker(BaseDocumentCompressor):
         if len(documents) == 0:  # to avoid empty api call
             return []
         doc_list = list(documents)
-        _docs = [d.page_content for d in doc_list]
-        sentence_pairs = [[query, _doc] for _doc in _docs]
-        results = self._model.predict(sentences=sentence_pairs,
-                                      batch_size=self.batch_size,
-                                      #  show_progress_bar=self.show_progress_bar,
-                                      num_workers=self.num_workers,
-                                      #  activation_fct=self.activation_fct,
-                                      #  apply_softmax=self.apply_softmax,
-                                      convert_to_tensor=True
-                                      )
+        results = self._model.score(query, [d.page_content for d in doc_list])
         top_k = self.top_n if self.top_n < len(results) else len(results)
 
-        values, indices = results.topk(top_k)
+        indices = sorted(range(len(results)), key=lambda i: results[i], reverse=True)[:top_k]
         final_results = []
-        for value, index in zip(values, indices):
+        for index in indices:
             doc = doc_list[index]
-            doc.metadata["relevance_score"] = value
+            doc.metadata["relevance_score"] = results[index]
             final_results.append(doc)
         return final_results
 
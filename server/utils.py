@@ -690,6 +690,34 @@ def get_server_configs() -> Dict:
     return {**{k: v for k, v in locals().items() if k[0] != "_"}, **_custom}
 
 
+def get_cache_stats() -> BaseResponse:
+    '''
+    获取各进程内缓存池的统计信息（命中率、淘汰次数、加载耗时、内存占用等），用于调整缓存配置
+    '''
+    from server.knowledge_base.kb_cache.base import embeddings_pool
+    from server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool, memo_faiss_pool
+    from server.knowledge_base.kb_cache.embedding_cache import embedding_cache, chunk_embedding_store
+    from server.knowledge_base.kb_cache.embedding_batcher import batcher_stats
+    from server.db.kb_metadata_cache import kb_metadata_cache
+    from server.knowledge_base.kb_service.base import KBServiceFactory
+    from configs import USE_RERANKER
+
+    data = {
+        "embeddings_pool": embeddings_pool.stats(),
+        "embedding_batchers": batcher_stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "chunk_embedding_store": chunk_embedding_store.stats(),
+        "kb_faiss_pool": kb_faiss_pool.stats(),
+        "memo_faiss_pool": memo_faiss_pool.stats(),
+        "kb_metadata_cache": kb_metadata_cache.stats(),
+        "kb_service_pool": KBServiceFactory.pool.stats(),
+    }
+    if USE_RERANKER:
+        from server.reranker.reranker import reranker_pool
+        data["reranker_pool"] = reranker_pool.stats()
+    return BaseResponse(data=data)
+
+
 def list_online_embed_models() -> List[str]:
     from server import model_workers
 
@@ -0,0 +1,82 @@
+from pathlib import Path
+import asyncio
+import base64
+import json
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import pytest
+
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from server.db import session as db_session
+from server.db.base import Base, create_engine_wrapper, create_async_engine_wrapper
+from server.db.models.message_model import MessageModel
+from server.db.repository import message_repository
+from server.memory.token_info_memory import set_token
+
+
+@pytest.fixture
+def async_db(tmp_path, monkeypatch):
+    # 同步与异步引擎指向同一个临时 sqlite 文件
+    path = tmp_path / "info.db"
+    engine = create_engine_wrapper(uri=f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    async_engine = create_async_engine_wrapper(uri=f"sqlite+aiosqlite:///{path}")
+    assert async_engine is not None
+    monkeypatch.setattr(db_session, "SessionLocal", sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    monkeypatch.setattr(db_session, "AsyncSessionLocal", async_sessionmaker(autoflush=False, bind=async_engine))
+    monkeypatch.setattr(message_repository.message_writer, "enabled", False)
+    yield engine
+    asyncio.run(async_engine.dispose())
+    engine.dispose()
+
+
+def count_messages(engine) -> int:
+    with engine.connect() as conn:
+        return len(conn.execute(MessageModel.__table__.select()).fetchall())
+
+
+def test_async_session_scope_commits_and_rolls_back(async_db):
+    async def run():
+        async with db_session.async_session_scope() as session:
+            session.add(MessageModel(id="m1", conversation_id="c1", chat_type="llm_chat", query="q"))
+        with pytest.raises(RuntimeError):
+            async with db_session.async_session_scope() as session:
+                session.add(MessageModel(id="m2", conversation_id="c1", chat_type="llm_chat", query="q"))
+                await session.flush()
+                raise RuntimeError("boom")
+
+    asyncio.run(run())
+    assert count_messages(async_db) == 1
+
+
+def test_async_chat_history_roundtrip(async_db):
+    payload = base64.urlsafe_b64encode(json.dumps({"userId": "u1"}).encode()).decode().rstrip("=")
+
+    async def run():
+        # run_sync 在新的 greenlet 中执行，token 需随上下文传入
+        set_token(f"h.{payload}.s")
+        message_id = await message_repository.aadd_message_to_db("c1", "llm_chat", "你好")
+        await message_repository.aupdate_message(message_id, response="您好", metadata={"a": 1})
+        return message_id, await message_repository.aget_message_by_id(message_id), \
+            await message_repository.afilter_message("c1")
+
+    message_id, message, history = asyncio.run(run())
+    assert message["response"] == "您好" and message["meta_data"] == {"a": 1}
+    assert [x["id"] for x in history] == [message_id]
+    # 异步写入的记录对同步接口可见
+    assert message_repository.get_message_by_id(message_id)["query"] == "你好"
+    with async_db.connect() as conn:
+        assert conn.execute(MessageModel.__table__.select()).fetchone().create_by == "u1"
+
+
+def test_with_async_session_falls_back_to_threadpool(async_db, monkeypatch):
+    monkeypatch.setattr(db_session, "AsyncSessionLocal", None)
+    message_id = asyncio.run(message_repository.aadd_message_to_db("c2", "llm_chat", "q", response="r"))
+    assert asyncio.run(message_repository.afilter_message("c2"))[0]["id"] == message_id
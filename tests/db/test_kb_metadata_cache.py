@@ -0,0 +1,93 @@
+from pathlib import Path
+import asyncio
+import sys
+import time
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from server.db.kb_metadata_cache import KBMetadataCache
+
+
+def counting_loader(value: dict, calls: list):
+    def loader():
+        calls.append(1)
+        return dict(value)
+    return loader
+
+
+def test_hits_until_invalidated():
+    cache = KBMetadataCache(ttl=60)
+    calls = []
+    loader = counting_loader({"id": 1, "kb_name": "a"}, calls)
+    assert cache.get_kb("a", loader) == {"id": 1, "kb_name": "a"}
+    assert cache.get_kb("a", loader) == {"id": 1, "kb_name": "a"}
+    assert len(calls) == 1 and cache.hits == 1
+
+    cache.invalidate_kb("a")
+    cache.get_kb("a", loader)
+    assert len(calls) == 2
+    assert cache.kb_version("a") == 1
+
+
+def test_returned_values_are_copies():
+    cache = KBMetadataCache(ttl=60)
+    value = cache.get_kb("a", lambda: {"id": 1})
+    value["id"] = 2
+    assert cache.get_kb("a", lambda: {"id": 3}) == {"id": 1}
+
+
+def test_invalidate_files_keeps_version_and_other_kbs():
+    cache = KBMetadataCache(ttl=60)
+    cache.get_kb("a", lambda: {"id": 1})
+    cache.get_kb("b", lambda: {"id": 2})
+    cache.get_file(1, "x.txt", lambda: {"file_name": "x.txt"})
+    cache.get_file(2, "y.txt", lambda: {"file_name": "y.txt"})
+    cache.invalidate_files("a")
+    assert cache.kb_version("a") == 0
+    assert (1, "x.txt") not in cache._files and (2, "y.txt") in cache._files
+
+
+def test_load_racing_invalidation_not_stored():
+    cache = KBMetadataCache(ttl=60)
+
+    def loader():
+        # 加载期间数据被修改，旧结果不写入缓存
+        cache.invalidate_kb("a")
+        return {"id": 1, "stale": True}
+
+    cache.get_kb("a", loader)
+    assert cache.get_kb("a", lambda: {"id": 1}) == {"id": 1}
+
+
+def test_ttl_expiry_and_disabled_cache():
+    cache = KBMetadataCache(ttl=0.05)
+    calls = []
+    loader = counting_loader({"id": 1}, calls)
+    cache.get_kb("a", loader)
+    time.sleep(0.1)
+    cache.get_kb("a", loader)
+    assert len(calls) == 2
+
+    cache = KBMetadataCache(ttl=0)
+    calls = []
+    loader = counting_loader({"id": 1}, calls)
+    cache.get_kb("a", loader)
+    cache.get_kb("a", loader)
+    assert len(calls) == 2 and cache.stats()["kbs"] == 0
+
+
+def test_aget_kb():
+    cache = KBMetadataCache(ttl=60)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        return {"id": 1}
+
+    async def run():
+        await cache.aget_kb("a", loader)
+        return await cache.aget_kb("a", loader)
+
+    assert asyncio.run(run()) == {"id": 1}
+    assert len(calls) == 1
@@ -0,0 +1,64 @@
+from pathlib import Path
+import asyncio
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from server.db.message_writer import MessageWriter
+
+
+def new_writer(**kwargs) -> MessageWriter:
+    writer = MessageWriter(enabled=True, flush_size=100, flush_interval=3600, spool_path=None, **kwargs)
+    writer.written = []
+    writer._write = lambda records: writer.written.extend(records)
+    return writer
+
+
+def test_add_and_update_merge_into_one_insert():
+    writer = new_writer()
+    writer.add("m1", "c1", "llm_chat", "hi")
+    writer.update("m1", response="hello", metadata={"a": 1})
+    writer.feedback("m1", 100, "good")
+    assert writer.flush()
+    [record] = writer.written
+    assert record["new"]
+    assert record["fields"]["response"] == "hello"
+    assert record["fields"]["meta_data"] == {"a": 1}
+    assert record["fields"]["feedback_score"] == 100
+
+
+def test_flush_pending_only_writes_the_conversation():
+    writer = new_writer()
+    writer.add("m1", "c1", "llm_chat", "q1")
+    writer.add("m2", "c2", "llm_chat", "q2")
+    writer.flush_pending(conversation_id="c1")
+    assert [r["id"] for r in writer.written] == ["m1"]
+    assert writer.has_pending(conversation_id="c2")
+    assert not writer.has_pending(conversation_id="c1")
+
+    writer.flush_pending(message_id="m2")
+    assert [r["id"] for r in writer.written] == ["m1", "m2"]
+
+
+def test_aflush_pending():
+    writer = new_writer()
+    writer.add("m1", "c1", "llm_chat", "q1")
+    writer.add("m2", "c2", "llm_chat", "q2")
+    asyncio.run(writer.aflush_pending(conversation_id="c2"))
+    assert [r["id"] for r in writer.written] == ["m2"]
+
+
+def test_failed_records_are_requeued_before_new_ones():
+    writer = new_writer()
+
+    def fail(records):
+        raise RuntimeError("db down")
+
+    writer._write = fail
+    writer.add("m1", "c1", "llm_chat", "q1")
+    assert not writer.flush()
+    writer.update("m1", response="r1")
+    writer.add("m2", "c1", "llm_chat", "q2")
+    assert list(writer._pending) == ["m1", "m2"]
+    assert writer._pending["m1"]["new"] and writer._pending["m1"]["fields"]["response"] == "r1"
@@ -0,0 +1,51 @@
+from pathlib import Path
+import sys
+import threading
+import types
+
+import pytest
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+# 导入 document_loaders 包时会加载依赖 opencv 的 PDF/图片加载器
+pytest.importorskip("cv2")
+
+from document_loaders import ocr
+
+
+class FakeRapidOCR:
+    instances = 0
+
+    def __init__(self, **kwargs):
+        FakeRapidOCR.instances += 1
+        self.kwargs = kwargs
+
+    def __call__(self, img):
+        return [img], 0.0
+
+
+def test_get_ocr_shares_one_instance_per_process(monkeypatch):
+    monkeypatch.setitem(sys.modules, "rapidocr_paddle", None)
+    monkeypatch.setitem(sys.modules, "rapidocr_onnxruntime", types.SimpleNamespace(RapidOCR=FakeRapidOCR))
+    monkeypatch.setattr(ocr, "_ocr_cache", {})
+    FakeRapidOCR.instances = 0
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(ocr.get_ocr(use_cuda=i % 2 == 0))) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # onnxruntime 版本不区分 use_cuda，所有线程共用一个实例
+    assert FakeRapidOCR.instances == 1
+    assert all(x is results[0] for x in results)
+    assert results[0]("img") == (["img"], 0.0)
+
+
+def test_get_ocr_paddle_keyed_by_cuda(monkeypatch):
+    monkeypatch.setitem(sys.modules, "rapidocr_paddle", types.SimpleNamespace(RapidOCR=FakeRapidOCR))
+    monkeypatch.setattr(ocr, "_ocr_cache", {})
+    cpu = ocr.get_ocr(use_cuda=False)
+    assert cpu.ocr.kwargs == {"det_use_cuda": False, "cls_use_cuda": False, "rec_use_cuda": False}
+    assert ocr.get_ocr(use_cuda=False) is cpu and ocr.get_ocr() is not cpu
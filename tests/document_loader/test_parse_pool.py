@@ -0,0 +1,56 @@
+from pathlib import Path
+import os
+import sys
+import time
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from langchain.docstore.document import Document
+
+from server.knowledge_base.parse_pool import ParseProcessPool, pack_docs, unpack_docs
+
+
+def fake_parse(task):
+    # 在工作进程中执行，返回处理该任务的进程号
+    if task["filename"] == "slow.txt":
+        time.sleep(30)
+    if task["filename"] == "bad.txt":
+        raise ValueError("broken file")
+    return pack_docs([Document(page_content=str(os.getpid()), metadata={"source": task["filename"]})])
+
+
+class FakeParsePool(ParseProcessPool):
+    parse_func = staticmethod(fake_parse)
+
+
+def tasks(*names):
+    return [{"filename": x, "kb_name": "kb"} for x in names]
+
+
+def test_pack_roundtrip():
+    docs = [Document(page_content="你好", metadata={"source": "a.txt", "page": 1})]
+    assert unpack_docs(pack_docs(docs)) == docs
+
+
+def test_timeout_fails_only_the_stuck_file():
+    pool = FakeParsePool(workers=2, timeout=5, max_memory=0, max_tasks=0)
+    try:
+        results = {name: (status, payload) for status, (_, name, payload) in pool.map(tasks("slow.txt", "a.txt", "bad.txt"))}
+        assert results["a.txt"][0] and results["a.txt"][1][0].metadata["source"] == "a.txt"
+        assert not results["bad.txt"][0] and "broken file" in results["bad.txt"][1]
+        assert not results["slow.txt"][0] and "超时" in results["slow.txt"][1]
+        # 超时的进程被替换，进程池仍可使用
+        [(status, _)] = list(pool.map(tasks("b.txt")))
+        assert status and len(pool._workers) == 2
+    finally:
+        pool.shutdown()
+
+
+def test_workers_recycled_after_max_tasks():
+    pool = FakeParsePool(workers=1, timeout=0, max_memory=0, max_tasks=2)
+    try:
+        pids = [int(payload[0].page_content) for status, (_, _, payload) in pool.map(tasks("1", "2", "3", "4"))]
+        assert pids[0] == pids[1] and pids[2] == pids[3] and pids[1] != pids[2]
+    finally:
+        pool.shutdown()
@@ -0,0 +1,90 @@
+from pathlib import Path
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from langchain.docstore.document import Document
+
+from server.knowledge_base.bm25_index import BM25Index, chunk_key, fuse_rankings, rerank_docs, tokenize
+
+
+def doc(text: str, source: str = "a.txt") -> Document:
+    return Document(page_content=text, metadata={"source": source})
+
+
+def test_tokenize_keeps_codes_and_drops_punctuation():
+    tokens = tokenize("Error ERR-1024, 请检查 v1.2.3！")
+    assert "err-1024" in tokens and "v1.2.3" in tokens
+    assert "," not in tokens and "！" not in tokens
+
+
+def test_search_ranks_rare_terms_higher():
+    index = BM25Index()
+    index.add(["1", "2", "3"], [doc("apple banana"), doc("apple cherry"), doc("apple err-1024")])
+    result = index.search("err-1024 apple", top_k=2)
+    assert result[0][0] == "3"
+    assert len(result) == 2
+    assert index.search("durian", top_k=3) == []
+
+
+def test_remove_source_and_readd():
+    index = BM25Index()
+    index.add(["1", "2"], [doc("apple", "A.txt"), doc("apple", "b.txt")])
+    # 与 FAISS 一致，来源文件不区分大小写
+    assert index.remove_source("a.txt") == ["1"]
+    assert [x for x, _ in index.search("apple", 5)] == ["2"]
+    index.add(["2"], [doc("banana", "b.txt")])
+    assert index.search("apple", 5) == []
+    assert len(index) == 1 and index._total_len == 1
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "bm25" / "index.pkl")
+    index = BM25Index(path)
+    index.add(["1", "2"], [doc("apple banana"), doc("cherry", "b.txt")])
+    index.save()
+    loaded = BM25Index(path)
+    assert loaded.load()
+    assert loaded.search("cherry", 5) == index.search("cherry", 5)
+    assert loaded.key_of("1") == chunk_key(doc("apple banana"))
+    assert loaded.remove_source("b.txt") == ["2"]
+
+
+def test_ensure_complete_rebuilds_once():
+    index = BM25Index()
+    index.complete = False
+    calls = []
+
+    def load_docs():
+        calls.append(1)
+        return ["1"], [doc("apple")]
+
+    index.ensure_complete(load_docs)
+    index.ensure_complete(load_docs)
+    assert len(calls) == 1 and len(index) == 1
+
+
+def test_rrf_fusion():
+    dense = [(("a",), 0.9), (("b",), 0.8)]
+    sparse = [(("b",), 12.0), (("c",), 3.0)]
+    fused = fuse_rankings([dense, sparse], [1.0, 1.0], method="rrf", rrf_k=60)
+    # 两路都命中的结果排在最前，分数按排名计算，与原始分数的尺度无关
+    assert [k for k, _ in fused] == [("b",), ("a",), ("c",)]
+    assert all(0 <= d <= 1 for _, d in fused)
+    assert fused[1][1] < fused[2][1]
+
+
+def test_weighted_fusion():
+    fused = fuse_rankings([[(("a",), 1.0)], [(("a",), 1.0), (("b",), 0.5)]], [0.7, 0.3], method="weighted")
+    assert fused[0] == (("a",), 0.0)
+    assert abs(fused[1][1] - (1 - 0.15)) < 1e-9
+
+
+def test_rerank_docs_pads_with_unmatched_docs():
+    docs = [doc("apple"), doc("banana"), doc("err-1024 cherry"), doc("durian")]
+    result = rerank_docs("err-1024", docs, top_k=3)
+    # 只有一个文档命中，其余按原有顺序补足 top_k 个
+    assert [x.page_content for x in result] == ["err-1024 cherry", "apple", "banana"]
+    assert result[0].metadata["score"] > 0 and "score" not in result[1].metadata
+    assert [x.page_content for x in rerank_docs("fig", docs, top_k=2)] == ["apple", "banana"]
@@ -0,0 +1,147 @@
+from pathlib import Path
+import sys
+import threading
+import time
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import pytest
+
+from server.knowledge_base.kb_cache.base import CachePool, RWLock, ThreadSafeObject
+
+
+def test_rwlock_readers_share_writer_excludes():
+    lock = RWLock()
+    lock.acquire_read()
+    acquired = threading.Event()
+
+    def reader():
+        lock.acquire_read()
+        acquired.set()
+        lock.release_read()
+
+    t = threading.Thread(target=reader)
+    t.start()
+    assert acquired.wait(1)
+    t.join()
+
+    written = threading.Event()
+
+    def writer():
+        lock.acquire_write()
+        written.set()
+        lock.release_write()
+
+    t = threading.Thread(target=writer)
+    t.start()
+    assert not written.wait(0.1)
+    lock.release_read()
+    assert written.wait(1)
+    t.join()
+
+
+def test_rwlock_writer_preferred_over_new_readers():
+    lock = RWLock()
+    lock.acquire_read()
+    order = []
+
+    def writer():
+        lock.acquire_write()
+        order.append("w")
+        lock.release_write()
+
+    def reader():
+        lock.acquire_read()
+        order.append("r")
+        lock.release_read()
+
+    w = threading.Thread(target=writer)
+    w.start()
+    while not lock._writers_waiting:
+        time.sleep(0.01)
+    r = threading.Thread(target=reader)
+    r.start()
+    time.sleep(0.1)
+    # 有写者等待时新的读者需要等待
+    assert order == []
+    lock.release_read()
+    w.join(1)
+    r.join(1)
+    assert order == ["w", "r"]
+
+
+def test_rwlock_reentrant_and_no_upgrade():
+    lock = RWLock()
+    lock.acquire_write()
+    lock.acquire_write()
+    lock.acquire_read()
+    lock.release_read()
+    lock.release_write()
+    lock.release_write()
+    assert lock._writer is None
+
+    lock.acquire_read()
+    with pytest.raises(RuntimeError):
+        lock.acquire_write()
+    lock.release_read()
+
+
+class SizedObject(ThreadSafeObject):
+    def __init__(self, key, size: int, pool: CachePool):
+        super().__init__(key, pool=pool)
+        self.size = size
+
+    def nbytes(self) -> int:
+        return self.size
+
+
+def load(pool: CachePool, key: str, size: int, load_seconds: float) -> SizedObject:
+    item = SizedObject(key, size, pool)
+    pool.set(key, item)
+    item.finish_loading()
+    item.load_seconds = load_seconds
+    return item
+
+
+def test_gdsf_evicts_cheapest_per_byte_first():
+    pool = CachePool(memory_budget=300)
+    load(pool, "slow", 100, 10.0)
+    load(pool, "fast", 100, 0.01)
+    load(pool, "medium", 100, 1.0)
+    pool._touch("slow")
+    load(pool, "new", 100, 1.0)
+    # 加载快、未被命中的对象先淘汰；刚加入的对象不参与淘汰
+    assert set(pool.keys()) == {"slow", "medium", "new"}
+    assert pool.stats()["evictions"] == 1
+
+
+def test_gdsf_keeps_pinned_and_ages_entries():
+    pool = CachePool(memory_budget=200, pinned=["kb"])
+    load(pool, ("kb", "vs"), 100, 0.01)
+    load(pool, "a", 100, 5.0)
+    load(pool, "b", 100, 5.0)
+    # 常驻的对象即使代价最低也不淘汰
+    assert ("kb", "vs") in pool.keys() and "a" not in pool.keys()
+    # 淘汰后时钟推进，之后访问的对象优先级更高
+    assert pool._clock > 0
+    pool._touch("b")
+    assert pool._cache["b"].inflation == pool._clock
+
+
+def test_count_limit_evicts_least_recently_used():
+    pool = CachePool(cache_num=2)
+    load(pool, "a", 0, 0)
+    load(pool, "b", 0, 0)
+    pool._touch("a")
+    load(pool, "c", 0, 0)
+    assert pool.keys() == ["a", "c"]
+
+
+def test_get_loaded_does_not_wait():
+    pool = CachePool()
+    loading = SizedObject("a", 0, pool)
+    pool.set("a", loading)
+    assert pool.get_loaded("a") is None and pool.get_loaded("missing") is None
+    loading.finish_loading()
+    assert pool.get_loaded("a") is loading
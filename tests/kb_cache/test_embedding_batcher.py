@@ -0,0 +1,74 @@
+from pathlib import Path
+import sys
+import threading
+import time
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import numpy as np
+
+from server.knowledge_base.kb_cache import embedding_batcher as eb
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.calls = []
+        self.first = threading.Event()
+        self.release = threading.Event()
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        if len(self.calls) == 1:
+            # 第一批处理期间提交查询请求
+            self.first.set()
+            self.release.wait(5)
+        return [[float(len(t)), 1.0] for t in texts]
+
+
+def test_large_request_split_and_query_first(monkeypatch):
+    fake = FakeEmbeddings()
+    monkeypatch.setattr(eb.embeddings_pool, "load_embeddings", lambda model, device: fake)
+    batcher = eb.EmbeddingBatcher("m", "cpu", batch_wait=0, max_batch_size=4)
+
+    docs = [f"doc{i}" for i in range(10)]
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(docs=batcher.embed(docs)))
+    worker.start()
+    assert fake.first.wait(5)
+    query = threading.Thread(target=lambda: result.update(query=batcher.embed(["q"], priority=True)))
+    query.start()
+    while batcher.stats()["query_requests"] == 0:
+        time.sleep(0.01)
+    fake.release.set()
+    worker.join(5)
+    query.join(5)
+
+    # 入库请求拆成每批最多 4 条，查询请求在第二批处理，不等整个入库请求完成
+    assert max(len(x) for x in fake.calls) <= 4
+    assert "q" in fake.calls[1]
+    assert result["docs"].shape == (10, 2)
+    assert np.allclose(result["docs"][:, 0], [len(t) for t in docs])
+    assert np.allclose(result["query"], [[1.0, 1.0]])
+
+
+class FakeTokenizer:
+    # 按空格分词，token 数与字符数的顺序不同
+    def __call__(self, texts, **kwargs):
+        return {"input_ids": [t.split() for t in texts]}
+
+
+def test_batch_sorted_by_token_length(monkeypatch):
+    fake = FakeEmbeddings()
+    fake.first.set()
+    fake.release.set()
+    fake.tokenizer = FakeTokenizer()
+    monkeypatch.setattr(eb.embeddings_pool, "load_embeddings", lambda model, device: fake)
+    batcher = eb.EmbeddingBatcher("m", "cpu", batch_wait=0, max_batch_size=4)
+
+    texts = ["a b c", "abcdefgh", "x y"]
+    result = batcher.embed(texts)
+    assert fake.calls == [["abcdefgh", "x y", "a b c"]]
+    # 结果仍按原顺序返回
+    assert np.allclose(result[:, 0], [len(t) for t in texts])
+    assert eb.text_lengths(object(), texts) == [5, 8, 3]
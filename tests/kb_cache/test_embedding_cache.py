@@ -0,0 +1,157 @@
+from pathlib import Path
+import asyncio
+import sys
+import time
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import numpy as np
+
+from server.knowledge_base.kb_cache import embedding_cache as ec
+from server.knowledge_base.kb_cache.embedding_cache import EmbeddingCache
+
+
+def fake_embed(calls: list):
+    def embed_func(texts):
+        calls.append(list(texts))
+        return [[float(len(t)), 1.0] for t in texts]
+    return embed_func
+
+
+def test_embed_only_computes_deduplicated_misses():
+    cache = EmbeddingCache(max_size=10)
+    calls = []
+    result = cache.embed(["a", "bb", "a"], "m", True, fake_embed(calls))
+    assert calls == [["a", "bb"]]
+    assert [list(x) for x in result] == [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0]]
+
+    cache.embed(["a", "ccc"], "m", True, fake_embed(calls))
+    assert calls[-1] == ["ccc"]
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["size"] == 3
+
+
+def test_keys_separate_model_and_query_flag():
+    cache = EmbeddingCache(max_size=10)
+    calls = []
+    cache.embed(["a"], "m1", True, fake_embed(calls))
+    cache.embed(["a"], "m2", True, fake_embed(calls))
+    cache.embed(["a"], "m1", False, fake_embed(calls))
+    assert len(calls) == 3
+
+
+def test_lru_eviction_by_size_and_bytes():
+    cache = EmbeddingCache(max_size=2)
+    cache.put_many("m", True, ["a", "b", "c"], [[1.0], [2.0], [3.0]])
+    assert cache.get_many("m", True, ["a"]) == [None]
+    assert cache.stats()["evictions"] == 1
+
+    vector_bytes = np.zeros(4, dtype=np.float32).nbytes + ec._ENTRY_OVERHEAD_BYTES
+    cache = EmbeddingCache(max_size=-1, max_bytes=vector_bytes * 2)
+    cache.put_many("m", True, ["a", "b", "c"], [[0.0] * 4] * 3)
+    assert cache.stats()["size"] == 2
+
+
+def test_ttl_expires_entries():
+    cache = EmbeddingCache(max_size=10, ttl=0.05)
+    cache.put_many("m", True, ["a"], [[1.0]])
+    time.sleep(0.1)
+    assert cache.get_many("m", True, ["a"]) == [None]
+    assert cache.stats()["expired"] == 1
+
+
+def test_sqlite_tier_shared_between_instances(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    EmbeddingCache(max_size=10, db_path=db_path).put_many("m", True, ["a"], [[1.0, 2.0]])
+    other = EmbeddingCache(max_size=10, db_path=db_path)
+    [vector] = other.get_many("m", True, ["a"])
+    assert list(vector) == [1.0, 2.0]
+    assert other.stats()["db_hits"] == 1
+
+
+def test_sqlite_prunes_expired_rows_periodically(tmp_path):
+    cache = EmbeddingCache(max_size=10, ttl=1, db_path=str(tmp_path / "cache.db"))
+    old = time.time() - 10
+    cache._db_put_many([(cache.make_key("m", True, "old"), np.zeros(1, dtype=np.float32), old)])
+    count = cache._get_db().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    # 首次写入时清理一次
+    assert count == 0
+
+    cache._db_put_many([(cache.make_key("m", True, "old"), np.zeros(1, dtype=np.float32), old)])
+    count = cache._get_db().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    # 清理间隔内不再执行 DELETE，读取时按 created 判断过期
+    assert count == 1
+    assert cache.get_many("m", True, ["old"]) == [None]
+
+
+def test_aembed_with_sqlite_tier(tmp_path):
+    cache = EmbeddingCache(max_size=10, db_path=str(tmp_path / "cache.db"))
+    calls = []
+
+    async def embed_func(texts):
+        return fake_embed(calls)(texts)
+
+    async def run():
+        first = await cache.aembed(["a", "b"], "m", True, embed_func)
+        second = await cache.aembed(["a", "b"], "m", True, embed_func)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert len(calls) == 1
+    assert [list(x) for x in first] == [list(x) for x in second]
+
+
+def test_chunk_store_reuses_vectors_and_prunes(tmp_path):
+    store = ec.ChunkEmbeddingStore(str(tmp_path / "chunks.db"), max_rows=2)
+    calls = []
+    store.embed(["a", "b"], "m", False, fake_embed(calls))
+    store.embed(["a", "b", "c"], "m", False, fake_embed(calls))
+    assert calls == [["a", "b"], ["c"]]
+
+    # 超过 max_rows 时删除最久未使用的条目
+    db = store._get_db()
+    db.execute("UPDATE chunk_embeddings SET used = 0 WHERE hash = ?", (store.make_hash("a"),))
+    store._last_prune = 0
+    store.put_many("m", ["d"], [[1.0, 1.0]])
+    assert store.get_many("m", ["a"]) == [None]
+    assert db.execute("SELECT COUNT(*) FROM chunk_embeddings").fetchone()[0] == 2
+
+
+def test_chunk_store_aembed(tmp_path):
+    store = ec.ChunkEmbeddingStore(str(tmp_path / "chunks.db"))
+    calls = []
+
+    async def embed_func(texts):
+        return fake_embed(calls)(texts)
+
+    async def run():
+        await store.aembed(["a"], "m", False, embed_func)
+        return await store.aembed(["a", "bb"], "m", False, embed_func)
+
+    result = asyncio.run(run())
+    assert calls == [["a"], ["bb"]]
+    assert [list(x) for x in result] == [[1.0, 1.0], [2.0, 1.0]]
+
+
+def test_chunk_store_only_used_for_ingestion():
+    from server.embeddings_api import _get_embed_cache
+    if not ec.chunk_embedding_store.enabled:
+        return
+    assert _get_embed_cache("m", False, use_chunk_store=True) is ec.chunk_embedding_store
+    assert _get_embed_cache("m", False) is not ec.chunk_embedding_store
+
+
+def test_keys_separate_embedding_backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(ec, "EMBEDDING_BACKEND", {"m": "onnx-int8"})
+    assert ec.model_key("m") == "m@onnx-int8"
+    assert ec.model_key("other") == "other"
+
+    cache = EmbeddingCache(max_size=10)
+    store = ec.ChunkEmbeddingStore(str(tmp_path / "chunks.db"))
+    cache.put_many("m", True, ["a"], [[1.0]])
+    store.put_many("m", ["a"], [[1.0]])
+    # 改用默认后端后不复用 onnx-int8 计算的向量
+    monkeypatch.setattr(ec, "EMBEDDING_BACKEND", {})
+    assert cache.get_many("m", True, ["a"]) == [None]
+    assert store.get_many("m", ["a"]) == [None]
@@ -0,0 +1,280 @@
+from pathlib import Path
+import os
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import faiss
+import numpy as np
+import pytest
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema import Document
+from langchain.vectorstores.faiss import FAISS
+
+from server.knowledge_base.kb_cache import faiss_cache, faiss_delta_log as fdl, faiss_index
+from server.knowledge_base.kb_cache.faiss_cache import (ThreadSafeFaiss, add_embeddings, delete_docs, update_metadata,
+                                                        replay_delta_log)
+from server.knowledge_base.kb_cache.faiss_delta_log import FaissDeltaLog
+from server.knowledge_base.kb_cache.faiss_index import get_tombstones, search_parameters, upgrade_target
+from server.knowledge_base.kb_cache.faiss_metadata_index import get_metadata_index
+from server.knowledge_base.utils import get_chunk_hash
+
+
+def new_vector_store(dim: int = 2) -> FAISS:
+    return FAISS(lambda x: [0.0] * dim, faiss.IndexFlatL2(dim), InMemoryDocstore({}), {})
+
+
+def add(vs: FAISS, ids, sources=None):
+    sources = sources or ["a.txt"] * len(ids)
+    vectors = np.array([[float(i), 1.0] for i in range(len(ids))], dtype=np.float32)
+    return add_embeddings(vs, [f"text {x}" for x in ids], vectors,
+                          [{"source": s, "index": i} for i, s in enumerate(sources)], ids=ids)
+
+
+def test_chunk_hash_ignores_position():
+    doc = Document(page_content="hello", metadata={"source": "a.txt", "index": 0})
+    moved = Document(page_content="hello", metadata={"source": "a.txt", "index": 5})
+    other = Document(page_content="hello", metadata={"source": "b.txt", "index": 0})
+    assert get_chunk_hash(doc) == get_chunk_hash(moved)
+    assert get_chunk_hash(doc) != get_chunk_hash(other)
+
+
+def test_update_metadata_keeps_shared_documents():
+    vs = new_vector_store()
+    add(vs, ["x", "y"])
+    old_doc = vs.docstore._dict["x"]
+    assert update_metadata(vs, {"x": {"index": 7}, "missing": {"index": 1}}) == ["x"]
+    assert vs.docstore._dict["x"].metadata == {"source": "a.txt", "index": 7}
+    # 副本共享的文档对象不被修改
+    assert old_doc.metadata["index"] == 0
+    assert get_metadata_index(vs).lookup("source", "a.txt") == {"x", "y"}
+
+
+def test_delta_log_replays_updates(tmp_path):
+    log = FaissDeltaLog(str(tmp_path))
+    vs = new_vector_store()
+    add(vs, ["x", "y"])
+    log.append_add(["z"], ["text z"], np.array([[3.0, 1.0]], dtype=np.float32), [{"source": "b.txt", "index": 0}])
+    log.append_update({"x": {"index": 9}})
+    log.append_delete(["y"])
+
+    assert replay_delta_log(vs, FaissDeltaLog(str(tmp_path))) == 3
+    assert set(vs.docstore._dict) == {"x", "z"}
+    assert vs.docstore._dict["x"].metadata["index"] == 9
+    assert vs.index.ntotal == 2
+    assert delete_docs(vs, ["x", "missing"]) == ["x"]
+
+
+def new_hnsw_store(n: int) -> FAISS:
+    index = faiss.index_factory(2, "HNSW8,Flat")
+    vs = FAISS(lambda x: [0.0, 0.0], index, InMemoryDocstore({}), {})
+    ids = [str(i) for i in range(n)]
+    vectors = np.array([[float(i), 0.0] for i in range(n)], dtype=np.float32)
+    add_embeddings(vs, [f"text {i}" for i in ids], vectors, [{"source": f"{i}.txt"} for i in ids], ids=ids)
+    return vs
+
+
+def search_ids(vs: FAISS, x: float, k: int):
+    params = search_parameters(vs.index, get_tombstones(vs).selector())
+    _, indices = vs.index.search(np.array([[x, 0.0]], dtype=np.float32), k, params=params)
+    return [vs.index_to_docstore_id[i] for i in indices[0] if i != -1]
+
+
+def test_hnsw_delete_marks_tombstones():
+    vs = new_hnsw_store(10)
+    index = vs.index
+    assert delete_docs(vs, ["3", "4"]) == ["3", "4"]
+    # 不重建索引，只标记删除，检索时排除
+    assert vs.index is index and index.ntotal == 10
+    assert get_tombstones(vs).positions == {3, 4}
+    assert search_ids(vs, 3.2, 3) == ["2", "5", "1"]
+    assert get_metadata_index(vs).lookup("source", "3.txt") == set()
+
+    # 重新添加同一 id 使用新的序号
+    add_embeddings(vs, ["text 3"], np.array([[3.0, 0.0]], dtype=np.float32), [{"source": "3.txt"}], ids=["3"])
+    assert search_ids(vs, 3.0, 1) == ["3"]
+    assert get_metadata_index(vs).positions(vs.index_to_docstore_id, ["3"]) == [10]
+
+
+def test_rebuild_purges_tombstones_in_background(tmp_path):
+    item = ThreadSafeFaiss("kb")
+    item.obj = new_hnsw_store(10)
+    with item.acquire() as vs:
+        delete_docs(vs, [str(i) for i in range(5)])
+    assert item.needs_rebuild()
+    assert item.rebuild() == "HNSW8,Flat"
+    vs = item.obj
+    assert vs.index.ntotal == 5 and not get_tombstones(vs).positions
+    assert list(vs.index_to_docstore_id.values()) == ["5", "6", "7", "8", "9"]
+    assert search_ids(vs, 6.2, 2) == ["6", "7"]
+    assert item.rebuild() is None
+
+
+def test_rebuild_upgrades_flat_index():
+    item = ThreadSafeFaiss("kb")
+    vs = new_vector_store()
+    add(vs, ["x", "y", "z"])
+    item.obj = vs
+    assert item.rebuild("HNSW8,Flat") == "HNSW8,Flat"
+    assert item.obj.index.ntotal == 3
+    assert list(item.obj.index_to_docstore_id.values()) == ["x", "y", "z"]
+
+
+
+def flat_index(n: int) -> faiss.Index:
+    index = faiss.IndexFlatL2(2)
+    index.add(np.random.rand(n, 2).astype(np.float32))
+    return index
+
+
+def test_upgrade_target_uses_whole_kb(monkeypatch):
+    monkeypatch.setattr(faiss_index, "FAISS_INDEX_TYPES", {"kb": "auto"})
+    monkeypatch.setattr(faiss_index, "FAISS_AUTO_INDEX_THRESHOLD", 350)
+    monkeypatch.setattr(faiss_index, "FAISS_AUTO_INDEX_TYPE", "hnsw")
+    monkeypatch.setattr(faiss_index, "FAISS_HNSW_M", 8)
+    # 按所有分片的向量总数判断
+    assert upgrade_target([flat_index(300)], "kb") is None
+    assert upgrade_target([flat_index(300), flat_index(100)], "kb") == "HNSW8,Flat"
+
+    # IVF 的聚类数与训练要求按最小的分片确定，所有分片使用同一描述
+    monkeypatch.setattr(faiss_index, "FAISS_INDEX_TYPES", {"kb": "ivf"})
+    monkeypatch.setattr(faiss_index, "FAISS_IVF_NLIST", 2)
+    assert upgrade_target([flat_index(500), flat_index(50)], "kb") is None
+    assert upgrade_target([flat_index(500), flat_index(100)], "kb") == "IVF2,Flat"
+
+    # 部分分片已转换时，其余分片沿用相同的描述；全部转换后不再转换
+    hnsw = new_hnsw_store(4).index
+    assert upgrade_target([hnsw, flat_index(10)], "kb") == "HNSW8,Flat"
+    assert upgrade_target([hnsw], "kb") is None
+
+def saved_item(path: str, monkeypatch) -> ThreadSafeFaiss:
+    monkeypatch.setattr(faiss_cache, "FAISS_DELTA_LOG", True)
+    item = ThreadSafeFaiss("kb")
+    item.obj = new_vector_store()
+    add(item.obj, ["x", "y"])
+    item.delta_log = FaissDeltaLog(path)
+    item.save(path)
+    return item
+
+
+def log_writes(item: ThreadSafeFaiss):
+    with item.acquire() as vs:
+        vectors = np.array([[5.0, 1.0]], dtype=np.float32)
+        add_embeddings(vs, ["text z"], vectors, [{"source": "b.txt"}], ids=["z"])
+        item.log_add(["z"], ["text z"], vectors, [{"source": "b.txt"}])
+        item.log_delete(delete_docs(vs, ["y"]))
+        item.log_update({k: {"index": 9} for k in update_metadata(vs, {"x": {"index": 9}})})
+
+
+def load_item(path: str) -> ThreadSafeFaiss:
+    item = ThreadSafeFaiss("kb")
+    item.load(path, lambda x: [0.0, 0.0])
+    return item
+
+
+def test_load_replays_committed_writes(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    log_writes(saved_item(path, monkeypatch))
+    item = load_item(path)
+    assert item.delta_log.pending() == [1, 2, 3]
+    assert set(item.obj.docstore._dict) == {"x", "z"}
+    assert item.obj.docstore._dict["x"].metadata["index"] == 9
+    assert item.obj.index.ntotal == 2
+
+    # 合并后日志清空，重新加载得到相同的内容
+    item.save(path)
+    assert not FaissDeltaLog(path).pending()
+    reloaded = load_item(path)
+    assert set(reloaded.obj.docstore._dict) == {"x", "z"}
+    assert reloaded.obj.docstore._dict["x"].metadata["index"] == 9
+
+
+def test_load_recovers_interrupted_compaction(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    item = saved_item(path, monkeypatch)
+    log_writes(item)
+
+    # 合并时在提交点之后中断：新的基础索引与 base_seq 尚未替换，已合并的段文件仍在
+    apply_commit = fdl._apply_commit
+
+    def crash(*args):
+        raise OSError("crash")
+
+    monkeypatch.setattr(fdl, "_apply_commit", crash)
+    with pytest.raises(OSError):
+        item.save(path)
+    monkeypatch.setattr(fdl, "_apply_commit", apply_commit)
+    assert os.path.isfile(os.path.join(path, fdl.COMMIT_NAME))
+
+    # 加载时完成替换，已合并的日志不再重放
+    loaded = load_item(path)
+    assert not os.path.isfile(os.path.join(path, fdl.COMMIT_NAME))
+    assert not loaded.delta_log.pending()
+    assert set(loaded.obj.docstore._dict) == {"x", "z"}
+    assert loaded.obj.index.ntotal == 2
+
+
+def test_corrupted_delta_log_fails_load_without_compacting(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    log_writes(saved_item(path, monkeypatch))
+    log = FaissDeltaLog(path)
+    with open(log._segment_file(2), "wb") as f:
+        f.write(b"corrupted")
+    files = {x: os.path.getmtime(os.path.join(path, x)) for x in ("index.faiss", "index.pkl")}
+
+    pool = faiss_cache.KBFaissPool(cache_num=2)
+    monkeypatch.setattr(faiss_cache, "get_vs_path", lambda kb_name, vector_name: path)
+    monkeypatch.setattr(pool, "load_kb_embeddings", lambda **kwargs: lambda x: [0.0, 0.0])
+    with pytest.raises(RuntimeError):
+        pool.load_vector_store("kb", "m")
+    # 只重放了一部分的向量库不缓存、不保存，基础索引与日志保持不变，修复后可以重新加载
+    assert pool.get(pool.cache_key("kb", "m")) is None
+    assert FaissDeltaLog(path).pending() == [1, 2, 3]
+    assert {x: os.path.getmtime(os.path.join(path, x)) for x in files} == files
+
+    # 删除损坏的段（删除 y 的记录）后，其余记录照常重放
+    os.remove(log._segment_file(2))
+    item = pool.load_vector_store("kb", "m")
+    assert set(item.obj.docstore._dict) == {"x", "y", "z"}
+    assert item.obj.docstore._dict["x"].metadata["index"] == 9
+
+
+def test_mmap_load_only_copies_index_when_needed(tmp_path, monkeypatch):
+    monkeypatch.setattr(faiss_cache, "FAISS_LOAD_MODE", "mmap")
+    path = str(tmp_path)
+    item = saved_item(path, monkeypatch)
+    with item.acquire() as vs:
+        item.log_update({k: {"index": 9} for k in update_metadata(vs, {"x": {"index": 9}})})
+
+    # 只更新文档时保持内存映射
+    loaded = load_item(path)
+    assert loaded.mmapped and loaded.delta_log.pending() == [1]
+    assert loaded.obj.docstore._dict["x"].metadata["index"] == 9
+
+    # 需要写入索引时复制出可写的索引，重放后立即合并并重新以内存映射方式打开
+    log_writes(item)
+    loaded = load_item(path)
+    assert loaded.mmapped and not loaded.delta_log.pending()
+    assert set(loaded.obj.docstore._dict) == {"x", "z"}
+    assert loaded.obj.index.ntotal == 2
+    assert load_item(path).mmapped
+
+
+def test_mmap_roundtrip_and_copy_on_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(faiss_cache, "FAISS_LOAD_MODE", "mmap")
+    path = str(tmp_path)
+    saved_item(path, monkeypatch)
+    item = load_item(path)
+    assert item.mmapped and item.nbytes() == 0
+    assert set(item.obj.docstore._dict) == {"x", "y"}
+    assert item.obj.index_to_docstore_id == {0: "x", 1: "y"}
+    _, indices = item.obj.index.search(np.array([[1.0, 1.0]], dtype=np.float32), 1)
+    assert item.obj.index_to_docstore_id[indices[0][0]] == "y"
+
+    # 副本上写入后替换，释放旧副本对 docstore.db 连接的引用
+    old_dict = item.obj.docstore._dict
+    with item.copy_on_write() as vs:
+        delete_docs(vs, ["x"])
+    assert not item.mmapped and set(item.obj.docstore._dict) == {"y"}
+    assert old_dict._closed and old_dict._shared.refs == 1
@@ -0,0 +1,122 @@
+from pathlib import Path
+import json
+import os
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import numpy as np
+import pytest
+
+from server.knowledge_base.kb_cache import faiss_delta_log as fdl
+from server.knowledge_base.kb_cache.faiss_delta_log import FaissDeltaLog, commit_files, recover_commit
+
+
+def append_some(log: FaissDeltaLog):
+    log.append_add(["1", "2"], ["a", "b"], np.ones((2, 2)), [{"source": "a.txt"}, {}])
+    log.append_delete(["1"])
+    log.append_update({"2": {"page": 1}})
+    # 空操作不写入段文件
+    log.append_delete([])
+    log.append_update({})
+
+
+def test_records_in_order_and_reopen(tmp_path):
+    log = FaissDeltaLog(str(tmp_path))
+    append_some(log)
+    assert log.pending() == [1, 2, 3]
+    assert log.nbytes() > 0
+
+    reopened = FaissDeltaLog(str(tmp_path))
+    records = list(reopened.records())
+    assert [seq for seq, _ in records] == [1, 2, 3]
+    assert [r["op"] for _, r in records] == ["add", "delete", "update"]
+    assert records[0][1]["embeddings"].dtype == np.float32
+    assert records[2][1]["metadatas"] == {"2": {"page": 1}}
+
+
+def test_interrupted_segment_dropped(tmp_path):
+    log = FaissDeltaLog(str(tmp_path))
+    append_some(log)
+    # 写入中断的临时段文件，对应的写操作没有完成
+    with open(os.path.join(log.dir, f"{4:012d}.seg.tmp"), "wb") as f:
+        f.write(b"partial")
+    reopened = FaissDeltaLog(str(tmp_path))
+    assert not any(x.endswith(".tmp") for x in os.listdir(log.dir))
+    assert [seq for seq, _ in reopened.records()] == [1, 2, 3]
+    assert reopened.last_seq == 3
+
+
+def test_corrupted_segment_stops_replay(tmp_path):
+    log = FaissDeltaLog(str(tmp_path))
+    append_some(log)
+    with open(log._segment_file(2), "wb") as f:
+        f.write(b"corrupted")
+    reopened = FaissDeltaLog(str(tmp_path))
+    records = reopened.records()
+    assert next(records)[0] == 1
+    # 不跳过损坏的段继续重放之后的记录
+    with pytest.raises(RuntimeError, match="000000000002.seg"):
+        next(records)
+    assert reopened.pending() == [1, 2, 3]
+
+
+def test_prepare_base_commit_and_truncate(tmp_path):
+    path = str(tmp_path)
+    log = FaissDeltaLog(path)
+    append_some(log)
+    seq, base_file = log.prepare_base(".tmp")
+    with open(os.path.join(path, "index.faiss.tmp"), "w") as f:
+        f.write("new")
+    commit_files(path, [("index.faiss.tmp", "index.faiss"), base_file])
+    log.truncate(seq)
+    assert log.pending() == [] and log.nbytes() == 0
+    assert not os.path.exists(os.path.join(path, fdl.COMMIT_NAME))
+
+    # 合并后继续写入，序号接着增长
+    log.append_delete(["2"])
+    reopened = FaissDeltaLog(path)
+    assert reopened.base_seq == 3
+    assert [seq for seq, _ in reopened.records()] == [4]
+
+
+def test_needs_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(fdl, "FAISS_DELTA_MAX_SEGMENTS", 3)
+    log = FaissDeltaLog(str(tmp_path))
+    log.append_delete(["1"])
+    assert not log.needs_compaction()
+    append_some(log)
+    assert log.needs_compaction()
+
+
+def test_recover_interrupted_commit(tmp_path):
+    path = str(tmp_path)
+    for name, content in [("index.faiss", "old"), ("index.pkl", "old"),
+                          ("index.faiss.tmp", "new"), ("index.pkl.tmp", "new")]:
+        with open(os.path.join(path, name), "w") as f:
+            f.write(content)
+    # 提交点已写入，替换了一个文件后中断
+    files = [("index.faiss.tmp", "index.faiss"), ("index.pkl.tmp", "index.pkl")]
+    with open(os.path.join(path, fdl.COMMIT_NAME), "w") as f:
+        json.dump({"files": files}, f)
+    os.replace(os.path.join(path, "index.faiss.tmp"), os.path.join(path, "index.faiss"))
+
+    recover_commit(path)
+    for name in ["index.faiss", "index.pkl"]:
+        assert open(os.path.join(path, name)).read() == "new"
+    assert sorted(os.listdir(path)) == ["index.faiss", "index.pkl"]
+
+
+def test_recover_before_commit_point_keeps_old_files(tmp_path):
+    path = str(tmp_path)
+    with open(os.path.join(path, "index.faiss"), "w") as f:
+        f.write("old")
+    with open(os.path.join(path, "index.faiss.tmp"), "w") as f:
+        f.write("new")
+    # 提交点写了一半
+    with open(os.path.join(path, fdl.COMMIT_NAME + ".tmp"), "w") as f:
+        f.write("{")
+    recover_commit(path)
+    assert open(os.path.join(path, "index.faiss")).read() == "old"
+    assert not os.path.exists(os.path.join(path, fdl.COMMIT_NAME + ".tmp"))
@@ -0,0 +1,126 @@
+from pathlib import Path
+import pickle
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import faiss
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores.faiss import FAISS
+
+from server.knowledge_base.kb_cache import faiss_docstore
+from server.knowledge_base.kb_cache.faiss_cache import add_embeddings
+from server.knowledge_base.kb_cache.faiss_docstore import (CompactDocDict, DocIdArray, SqliteDocDict, make_compact,
+                                                           write_docstore_db)
+
+
+def sample_docs():
+    return {
+        "1": Document(page_content="你好", metadata={"source": "a.txt", "page": 1}),
+        "2": Document(page_content="world", metadata={"source": "a.txt", "tags": ["x", "y"]}),
+        "3": Document(page_content="", metadata={}),
+    }
+
+
+def test_roundtrip_and_shared_values():
+    docs = CompactDocDict.from_items(sample_docs().items())
+    assert len(docs) == 3 and list(docs) == ["1", "2", "3"]
+    for k, v in sample_docs().items():
+        assert docs[k] == v
+    # 重复取值只保存一份
+    assert len(docs._columns["source"].values) == 1
+    # 每次读取返回新对象，修改不影响存储
+    docs["2"].metadata["tags"].append("z")
+    assert docs["2"].metadata["tags"] == ["x", "y"]
+
+
+def test_metadata_types_not_merged():
+    docs = CompactDocDict()
+    docs["a"] = Document(page_content="", metadata={"v": 1})
+    docs["b"] = Document(page_content="", metadata={"v": True})
+    docs["c"] = Document(page_content="", metadata={"v": 1.0})
+    assert [type(docs[k].metadata["v"]) for k in "abc"] == [int, bool, float]
+
+
+def test_delete_overwrite_and_compact(monkeypatch):
+    monkeypatch.setattr(faiss_docstore, "_COMPACT_MIN_DELETED", 2)
+    docs = CompactDocDict.from_items(sample_docs().items())
+    docs["1"] = Document(page_content="new", metadata={"page": 2})
+    assert docs["1"].page_content == "new" and len(docs) == 3
+    del docs["2"]
+    assert "2" not in docs and len(docs) == 2
+    # 覆盖写入也留下一个已删除的行，删除数未超过一半时不整理
+    assert docs._deleted == 2 and len(docs._ids) == 4
+    del docs["3"]
+    # 删除数超过一半时整理，只保留仍在使用的列
+    assert docs._deleted == 0 and docs._ids == ["1"]
+    assert set(docs._columns) == {"page"}
+    assert dict(docs.items()) == {"1": Document(page_content="new", metadata={"page": 2})}
+
+
+def test_pickle_and_copy():
+    docs = CompactDocDict.from_items(sample_docs().items())
+    del docs["1"]
+    loaded = pickle.loads(pickle.dumps(docs))
+    assert dict(loaded.items()) == dict(docs.items())
+    assert len(loaded._ids) == 2
+
+    copied = docs.copy()
+    copied["4"] = Document(page_content="four", metadata={"source": "b.txt"})
+    assert "4" not in docs and docs["2"] == sample_docs()["2"]
+
+
+def test_make_compact_and_doc_id_array():
+    docs, ids = make_compact(sample_docs(), {1: "2", 0: "1", 2: "3"})
+    assert isinstance(docs, CompactDocDict) and isinstance(ids, DocIdArray)
+    assert list(ids.values()) == ["1", "2", "3"]
+    assert make_compact(docs, ids) == (docs, ids)
+    ids[3] = "4"
+    del ids[3]
+    assert len(ids) == 3
+
+
+def test_docstore_add_keeps_compact_dict():
+    doc_dict = CompactDocDict()
+    vs = FAISS(lambda x: [0.0, 0.0], faiss.IndexFlatL2(2), InMemoryDocstore(doc_dict), DocIdArray())
+    # FAISS.add_texts 经由 InMemoryDocstore.add 写入，不会替换为普通 dict
+    vs.add_embeddings([("a", [1.0, 0.0])], metadatas=[{"source": "a.txt"}], ids=["1"])
+    add_embeddings(vs, ["b"], [[0.0, 1.0]], [{"source": "b.txt"}], ids=["2"])
+    assert vs.docstore._dict is doc_dict
+    assert sorted(doc_dict) == ["1", "2"]
+    assert list(vs.index_to_docstore_id.values()) == ["1", "2"]
+
+
+def test_sqlite_doc_dict_roundtrip(tmp_path):
+    db_file = str(tmp_path / "docstore.db")
+    write_docstore_db(db_file, sample_docs(), {0: "1", 1: "2", 2: "3"})
+    docs = SqliteDocDict(db_file)
+    assert len(docs) == 3 and sorted(docs) == ["1", "2", "3"]
+    assert docs["2"] == sample_docs()["2"]
+    assert docs.load_index_to_docstore_id() == {0: "1", 1: "2", 2: "3"}
+
+    # 写入只记录在内存中，不修改文件
+    docs["4"] = Document(page_content="new")
+    del docs["1"]
+    assert len(docs) == 3 and "1" not in docs and docs["4"].page_content == "new"
+    assert len(SqliteDocDict(db_file)) == 3
+    # 保存时整体写回，与 index.pkl 一样退化为普通 dict
+    assert pickle.loads(pickle.dumps(docs)) == dict(docs.items())
+
+
+def test_sqlite_doc_dict_copies_share_connection(tmp_path):
+    db_file = str(tmp_path / "docstore.db")
+    write_docstore_db(db_file, sample_docs(), {})
+    docs = SqliteDocDict(db_file)
+    copied = docs.copy()
+    del copied["1"]
+    assert copied._conn is docs._conn and "1" in docs and len(copied) == 2
+
+    # 最后一个副本关闭后才关闭连接
+    docs.close()
+    docs.close()
+    assert copied["2"] == sample_docs()["2"]
+    copied.close()
+    assert docs._shared.refs == 0
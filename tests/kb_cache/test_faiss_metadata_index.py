@@ -0,0 +1,73 @@
+from pathlib import Path
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import faiss
+import numpy as np
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema import Document
+from langchain.vectorstores.faiss import FAISS
+
+from server.knowledge_base.kb_cache.faiss_cache import add_embeddings, delete_docs
+from server.knowledge_base.kb_cache.faiss_metadata_index import FaissMetadataIndex, get_metadata_index
+
+
+def new_vector_store() -> FAISS:
+    return FAISS(lambda x: [0.0, 0.0], faiss.IndexFlatL2(2), InMemoryDocstore({}), {})
+
+
+def add(vs: FAISS, ids, source: str = "a.txt"):
+    vectors = np.ones((len(ids), 2), dtype=np.float32)
+    add_embeddings(vs, [f"text {x}" for x in ids], vectors, [{"source": source} for _ in ids], ids=ids)
+
+
+def test_lookup_and_filter():
+    index = FaissMetadataIndex(["source", "page"])
+    index.add(["x", "y", "z"], [{"source": "A.txt", "page": 1}, {"source": "a.txt", "page": 2}, {"source": "b.txt"}])
+    assert index.lookup("source", "a.txt") == {"y"}
+    assert index.lookup("source", "a.txt", ignore_case=True) == {"x", "y"}
+    assert index.filter_ids({"page": ["1", 2]}) == {"x", "y"}
+    assert index.filter_ids({"source": "b.txt", "page": 1}) == set()
+    assert index.filter_ids({"other": 1}) is None
+    assert index.indexed({"source": "x"}) and not index.indexed({"other": 1})
+
+    index.remove(["x"], {"x": Document(page_content="", metadata={"source": "A.txt", "page": 1})})
+    assert index.lookup("source", "A.txt") == set()
+
+
+def test_positions_follow_deletes_with_same_size():
+    vs = new_vector_store()
+    add(vs, ["a", "b", "c"])
+    index = get_metadata_index(vs)
+    assert index.positions(vs.index_to_docstore_id, ["c"]) == [2]
+
+    # 删除一个再添加一个，映射的长度不变，仍需重建反向映射
+    delete_docs(vs, ["a"])
+    add(vs, ["d"])
+    assert index.positions(vs.index_to_docstore_id, ["c", "d"]) == [1, 2]
+    assert index.positions(vs.index_to_docstore_id, ["a"]) == []
+
+
+def test_copy_is_independent():
+    index = FaissMetadataIndex(["source"])
+    index.add(["x"], [{"source": "a.txt"}])
+    copied = index.copy()
+    copied.add(["y"], [{"source": "a.txt"}])
+    assert index.lookup("source", "a.txt") == {"x"}
+    assert copied.lookup("source", "a.txt") == {"x", "y"}
+
+
+def test_positions_rebuilt_when_mapping_changes_in_place():
+    index = FaissMetadataIndex(["source"])
+    mapping = {0: "a", 1: "b"}
+    index.add(["a", "b"], [{}, {}])
+    assert index.positions(mapping, ["a"]) == [0]
+
+    # 同一个对象、长度不变（或 id 被复用）时，按版本号判断映射已变化
+    docs = {"a": Document(page_content=""), "b": Document(page_content="")}
+    index.remove(["a", "b"], docs)
+    mapping[0], mapping[1] = "b", "a"
+    index.add(["b", "a"], [{}, {}])
+    assert index.positions(mapping, ["a"]) == [1]
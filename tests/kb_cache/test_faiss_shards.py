@@ -0,0 +1,55 @@
+from pathlib import Path
+import os
+import sys
+import zlib
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from server.knowledge_base.kb_cache import faiss_shards
+from server.knowledge_base.kb_cache.faiss_shards import (ShardLayout, load_shard_layout, save_shard_layout,
+                                                         shard_path)
+
+
+def test_single_shard_uses_unsharded_layout(tmp_path):
+    layout = ShardLayout(1)
+    assert layout.shards == [None]
+    assert layout.shard_of("id", "a.txt") is None
+    assert shard_path(str(tmp_path), None) == str(tmp_path)
+    assert shard_path(str(tmp_path), 3).endswith("shard_003")
+
+
+def test_shard_by_file_is_stable_and_case_insensitive():
+    layout = ShardLayout(4, by="file")
+    shard = layout.shard_of("x", "Docs/A.txt")
+    assert shard == layout.shard_of("y", "docs/a.txt")
+    # 使用 crc32 而不是 hash()，分配结果在不同进程间一致
+    assert shard == zlib.crc32(b"docs/a.txt") % 4
+    assert layout.shards_of_source("docs/a.txt") == [shard]
+    assert layout.shards_of_ids(["x"]) == [0, 1, 2, 3]
+
+
+def test_shard_by_id():
+    layout = ShardLayout(4, by="id")
+    ids = [str(i) for i in range(20)]
+    assert layout.shards_of_ids(ids) == sorted({layout.shard_of(x, "") for x in ids})
+    assert layout.shards_of_source("a.txt") == [0, 1, 2, 3]
+
+
+def test_load_and_save_layout(tmp_path, monkeypatch):
+    monkeypatch.setattr(faiss_shards, "FAISS_SHARDS", {"kb": 4})
+    vs_path = str(tmp_path / "vs")
+    # 新建的向量库按配置确定分片方式，创建时记录
+    layout = load_shard_layout(vs_path, "kb")
+    assert layout.num_shards == 4
+    save_shard_layout(vs_path, layout)
+    monkeypatch.setattr(faiss_shards, "FAISS_SHARDS", {"kb": 8})
+    assert load_shard_layout(vs_path, "kb").dict() == layout.dict()
+
+    # 已存在的未分片向量库不受配置影响
+    old_path = str(tmp_path / "old")
+    os.makedirs(old_path)
+    open(os.path.join(old_path, "index.faiss"), "w").close()
+    assert load_shard_layout(old_path, "kb").num_shards == 1
+    save_shard_layout(old_path, ShardLayout(1))
+    assert not os.path.exists(os.path.join(old_path, faiss_shards.SHARDS_FILE_NAME))
@@ -0,0 +1,73 @@
+from pathlib import Path
+import sys
+import threading
+import time
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from server.knowledge_base.kb_cache.kb_service_pool import KBServicePool
+
+
+class FakeService:
+    def __init__(self, healthy: bool = True):
+        self.closed = False
+        self.healthy = healthy
+
+    def close(self):
+        self.closed = True
+
+    def health_check(self) -> bool:
+        return self.healthy
+
+
+def test_reuses_and_rebuilds_on_version_change():
+    pool = KBServicePool(max_size=10, idle_timeout=0, health_check_interval=0, close_delay=0)
+    first = pool.get("a", 1, FakeService)
+    assert pool.get("a", 1, FakeService) is first
+    second = pool.get("a", 2, FakeService)
+    assert second is not first
+    # close_delay=0 时淘汰后在下一次取用时关闭
+    pool.get("a", 2, FakeService)
+    assert first.closed and not second.closed
+
+
+def test_evicted_service_closed_only_after_delay():
+    pool = KBServicePool(max_size=1, idle_timeout=0, health_check_interval=0, close_delay=0.2)
+    a = pool.get(("a",), 1, FakeService)
+    pool.get(("b",), 1, FakeService)
+    # 超出数量被淘汰，但可能仍在使用，不立即关闭
+    assert not a.closed
+    assert pool.stats()["retired"] == 1
+    time.sleep(0.3)
+    pool.get(("b",), 1, FakeService)
+    assert a.closed
+    assert pool.stats()["retired"] == 0
+
+
+def test_concurrent_get_constructs_once():
+    pool = KBServicePool(max_size=10, idle_timeout=0, health_check_interval=0)
+    built = []
+
+    def factory():
+        time.sleep(0.1)
+        built.append(1)
+        return FakeService()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(pool.get("a", 1, factory))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(built) == 1
+    assert len({id(x) for x in results}) == 1
+
+
+def test_unhealthy_service_is_replaced():
+    pool = KBServicePool(max_size=10, idle_timeout=0, health_check_interval=0.01, close_delay=0)
+    bad = pool.get("a", 1, lambda: FakeService(healthy=False))
+    time.sleep(0.05)
+    good = pool.get("a", 1, FakeService)
+    assert good is not bad
+    assert pool.stats()["reconnects"] == 1
@@ -0,0 +1,97 @@
+from pathlib import Path
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import numpy as np
+import pytest
+
+from server.knowledge_base.kb_cache.onnx_embeddings import OnnxEmbeddings, export_onnx
+
+
+class FakeTokenizer:
+    # 每个字母为一个 token（a=1, b=2 ...），按最长文本补 0
+    def __call__(self, texts, padding, truncation, max_length, return_tensors):
+        n = max(len(t) for t in texts)
+        ids = np.array([[ord(c) - 96 for c in t] + [0] * (n - len(t)) for t in texts], dtype=np.int32)
+        return {"input_ids": ids, "attention_mask": (ids > 0).astype(np.int32), "token_type_ids": ids * 0}
+
+
+class FakeSession:
+    def __init__(self):
+        self.feeds = []
+
+    def run(self, output_names, feed):
+        self.feeds.append(feed)
+        ids = feed["input_ids"].astype(np.float32)
+        return [np.stack([ids, ids * 2], axis=-1)]
+
+
+def fake_embeddings(pooling: str = "mean", normalize: bool = False, batch_size: int = 1) -> OnnxEmbeddings:
+    embeddings = object.__new__(OnnxEmbeddings)
+    embeddings.pooling = pooling
+    embeddings.normalize = normalize
+    embeddings.max_length = 512
+    embeddings.query_instruction = "b"
+    embeddings.batch_size = batch_size
+    embeddings.tokenizer = FakeTokenizer()
+    embeddings.session = FakeSession()
+    embeddings._input_names = {"input_ids", "attention_mask"}
+    return embeddings
+
+
+def test_embed_returns_float32_arrays():
+    embeddings = fake_embeddings()
+    docs = embeddings.embed_documents(["ab", "c"])
+    assert isinstance(docs, np.ndarray) and docs.dtype == np.float32
+    # 平均池化不计补齐的 token
+    assert np.allclose(docs, [[1.5, 3.0], [3.0, 6.0]])
+    assert all(x["input_ids"].dtype == np.int64 and "token_type_ids" not in x for x in embeddings.session.feeds)
+
+    query = embeddings.embed_query("a")
+    assert isinstance(query, np.ndarray) and query.shape == (2,)
+    # 查询拼接 query_instruction
+    assert np.allclose(query, [1.5, 3.0])
+
+
+def test_cls_pooling_and_normalize():
+    embeddings = fake_embeddings(pooling="cls", normalize=True, batch_size=2)
+    docs = embeddings.embed_documents(["cab", "b", "a"])
+    assert np.allclose(docs, [[1, 2] / np.sqrt(5)] * 3)
+    assert len(embeddings.session.feeds) == 2
+
+
+def tiny_sentence_transformer(path: Path) -> str:
+    # 随机初始化的小型 BERT，不需要下载模型
+    from sentence_transformers import SentenceTransformer, models
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+
+    path.mkdir()
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *"abcdefghijklmnopqrstuvwxyz"]
+    (path / "vocab.txt").write_text("\n".join(vocab), encoding="utf-8")
+    BertTokenizerFast(vocab_file=str(path / "vocab.txt")).save_pretrained(str(path))
+    BertModel(BertConfig(vocab_size=len(vocab), hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                         intermediate_size=64)).save_pretrained(str(path))
+    transformer = models.Transformer(str(path), max_seq_length=64)
+    st_model = SentenceTransformer(modules=[transformer,
+                                            models.Pooling(transformer.get_word_embedding_dimension(), "mean"),
+                                            models.Normalize()])
+    st_model.save(str(path / "st"))
+    return str(path / "st")
+
+
+def test_onnx_parity_with_sentence_transformers(tmp_path):
+    for name in ("torch", "transformers", "sentence_transformers", "onnxruntime"):
+        pytest.importorskip(name)
+    from sentence_transformers import SentenceTransformer
+
+    model_path = tiny_sentence_transformer(tmp_path / "model")
+    export_onnx(model_path, str(tmp_path / "onnx"))
+    embeddings = OnnxEmbeddings(str(tmp_path / "onnx"))
+    texts = ["hello world", "a", "the quick brown fox jumps over the lazy dog"]
+
+    actual = embeddings.embed_documents(texts)
+    expected = SentenceTransformer(model_path, device="cpu").encode(texts, normalize_embeddings=True)
+    assert isinstance(actual, np.ndarray) and actual.dtype == np.float32
+    assert np.allclose(actual, expected, atol=1e-4)
@@ -0,0 +1,71 @@
+from pathlib import Path
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import numpy as np
+import pytest
+from langchain.docstore.document import Document
+
+pytest.importorskip("elasticsearch")
+
+from server.knowledge_base.kb_service import es_kb_service
+from server.knowledge_base.kb_service.es_kb_service import ESKBService
+
+
+# ES 返回相关度分数，越大越相关
+HITS = [(Document(page_content="near", metadata={"source": "a.txt"}), 0.9),
+        (Document(page_content="far", metadata={"source": "b.txt"}), 0.2)]
+
+
+class FakeStore:
+    def __init__(self):
+        self.calls = []
+
+    def similarity_search_with_score(self, query, k, filter=None):
+        self.calls.append({"query": query, "k": k, "filter": filter})
+        return HITS[:k]
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k):
+        self.calls.append({"embedding": embedding, "k": k})
+        return HITS[:k]
+
+
+class FakeAdapter:
+    def __init__(self, embed_model: str):
+        self.embed_model = embed_model
+
+    def embed_queries(self, texts):
+        return np.ones((len(texts), 2), dtype=np.float32)
+
+
+def new_service() -> ESKBService:
+    # 不连接 ES，只测试检索结果的处理
+    kb = object.__new__(ESKBService)
+    kb.embed_model = "m"
+    kb.db_init = FakeStore()
+    return kb
+
+
+def test_search_batch_embeds_queries_through_adapter(monkeypatch):
+    monkeypatch.setattr(es_kb_service, "EmbeddingsFunAdapter", FakeAdapter)
+    kb = new_service()
+    results = kb.do_search_batch(["q1", "q2"], 2, 0.5)
+    # 相关度 0.2 换算为距离 0.8，超过阈值被过滤
+    assert [[doc.page_content for doc, _ in docs] for docs in results] == [["near"], ["near"]]
+    assert [x["embedding"] for x in kb.db_init.calls] == [[1.0, 1.0], [1.0, 1.0]]
+
+
+def test_search_applies_score_threshold():
+    kb = new_service()
+    assert [doc.page_content for doc, _ in kb.do_search("q", 2, 0.5)] == ["near"]
+    assert len(kb.do_search("q", 2, 1.0)) == 2
+
+
+def test_filtered_search_pushes_filter_and_applies_threshold():
+    kb = new_service()
+    docs = kb.do_search_filtered("q", 2, 0.5, {"source": ["a.txt", "b.txt"], "page": 1})
+    assert [doc.page_content for doc, _ in docs] == ["near"]
+    assert kb.db_init.calls[-1]["filter"] == [{"terms": {"metadata.source.keyword": ["a.txt", "b.txt"]}},
+                                              {"terms": {"metadata.page": [1]}}]
@@ -27,6 +27,12 @@ def test_search_db():
     assert len(result) > 0
 
 
+def test_search_db_batch():
+    result = kbService.search_docs_batch([search_content, "你好"])
+    assert len(result) == 2
+    assert len(result[0]) > 0
+
+
 def test_delete_doc():
     assert kbService.delete_doc(testKnowledgeFile)
 
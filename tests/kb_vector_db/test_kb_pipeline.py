@@ -0,0 +1,78 @@
+from pathlib import Path
+import sys
+import threading
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from server.knowledge_base import kb_pipeline
+from server.knowledge_base.kb_pipeline import IngestPipeline
+
+
+class FakeFile:
+    def __init__(self, filename: str, chunks: int, fail: bool = False):
+        self.filename = filename
+        self.kb_name = "kb"
+        self.chunks = chunks
+        self.fail = fail
+        self.splited_docs = None
+
+    def file2docs(self):
+        if self.fail:
+            raise ValueError("broken file")
+        return [Document(page_content=self.filename)]
+
+    def docs2texts(self, docs, **kwargs):
+        return [Document(page_content=f"{self.filename}-{i}") for i in range(self.chunks)]
+
+
+class FakeKB:
+    def __init__(self):
+        self.batches = []
+        self.added = {}
+        self.write_threads = set()
+
+    def accepts_embeddings(self) -> bool:
+        return True
+
+    def _docs_to_embeddings(self, docs):
+        self.batches.append(len(docs))
+        return {"embeddings": np.array([[float(len(x.page_content)), 1.0] for x in docs], dtype=np.float32)}
+
+    def add_doc(self, kb_file, embeddings=None, **kwargs):
+        self.write_threads.add(threading.get_ident())
+        self.added[kb_file.filename] = ([x.page_content for x in kb_file.splited_docs], embeddings)
+        return True
+
+
+def test_pipeline_batches_across_files_and_reports_errors(monkeypatch):
+    monkeypatch.setattr(kb_pipeline, "PARSE_PROCESS_WORKERS", 0)
+    kb = FakeKB()
+    files = [FakeFile("a.txt", 3), FakeFile("b.txt", 2), FakeFile("bad.txt", 1, fail=True)]
+    pipeline = IngestPipeline(kb, files, load_workers=2, split_workers=2, embed_batch_size=4, queue_size=2)
+    events = list(pipeline.run())
+
+    assert [x["finished"] for x in events] == [1, 2, 3]
+    assert {x["file_name"]: x["status"] for x in events} == {"a.txt": True, "b.txt": True, "bad.txt": False}
+    assert "broken file" in next(x["msg"] for x in events if not x["status"])
+    # 跨文件凑批向量化，每个文件的向量与文本块一一对应
+    assert sum(kb.batches) == 5 and max(kb.batches) <= 4
+    texts, embeddings = kb.added["a.txt"]
+    assert texts == ["a.txt-0", "a.txt-1", "a.txt-2"]
+    assert [x[0] for x in embeddings] == [7.0, 7.0, 7.0]
+    # 写入在调用方线程中进行
+    assert kb.write_threads == {threading.get_ident()}
+    assert events[-1]["stages"]["embed"]["processed"] == 5
+
+
+def test_pipeline_stops_when_consumer_closes(monkeypatch):
+    monkeypatch.setattr(kb_pipeline, "PARSE_PROCESS_WORKERS", 0)
+    kb = FakeKB()
+    files = [FakeFile(f"{i}.txt", 2) for i in range(20)]
+    events = IngestPipeline(kb, files, queue_size=1).run()
+    next(events)
+    events.close()
+    assert len(kb.added) == 1
@@ -0,0 +1,29 @@
+from pathlib import Path
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import numpy as np
+
+from server.knowledge_base.kb_service.base import normalize
+
+
+def test_normalize_float32_in_place():
+    x = np.array([[3.0, 4.0], [0.0, 0.0]], dtype=np.float32)
+    result = normalize(x)
+    # float32 连续数组原地相除，不复制
+    assert result is x
+    assert np.allclose(result, [[0.6, 0.8], [0.0, 0.0]])
+
+
+def test_normalize_converts_lists_and_keeps_unit_vectors():
+    result = normalize([[1, 1], [2, 0]])
+    assert result.dtype == np.float32 and result.flags.c_contiguous
+    assert np.allclose(np.linalg.norm(result, axis=1), 1.0)
+
+    unit = np.eye(2, dtype=np.float32)
+    unit.flags.writeable = False
+    assert normalize(unit) is unit
+    # 一维向量按一行处理
+    assert normalize(np.array([0.0, 2.0], dtype=np.float32)).shape == (1, 2)
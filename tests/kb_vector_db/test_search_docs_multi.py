@@ -0,0 +1,60 @@
+from pathlib import Path
+import asyncio
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import numpy as np
+import pytest
+from langchain.docstore.document import Document
+
+from server.knowledge_base import kb_doc_api
+from server.knowledge_base.kb_service.faiss_kb_service import FaissKBService
+
+
+class FakeKB:
+    # 与 FAISS 一样返回 float32 的平方 L2 距离
+    normalize_score = FaissKBService.normalize_score
+
+    def __init__(self, kb_name: str, embed_model: str, scores):
+        self.kb_name = kb_name
+        self.embed_model = embed_model
+        self.scores = scores
+        self.embeddings = []
+
+    def can_search_by_vector(self) -> bool:
+        return True
+
+    def search_docs_by_vector(self, query, embedding, top_k, score_threshold, filter=None, search_mode=None):
+        self.embeddings.append(embedding)
+        return [(Document(page_content=f"{self.kb_name}-{i}"), np.float32(s)) for i, s in enumerate(self.scores)]
+
+
+def test_search_docs_multi_embeds_once_and_merges(monkeypatch):
+    kbs = {"a": FakeKB("a", "m", [0.4, 2.0]), "b": FakeKB("b", "m", [1.2])}
+    calls = []
+
+    class FakeAdapter:
+        def __init__(self, embed_model):
+            self.embed_model = embed_model
+
+        def embed_query(self, text):
+            calls.append((self.embed_model, text))
+            return [1.0, 0.0]
+
+    async def get_service(name):
+        return kbs.get(name)
+
+    monkeypatch.setattr(kb_doc_api.KBServiceFactory, "aget_service_by_name", get_service)
+    monkeypatch.setattr(kb_doc_api, "EmbeddingsFunAdapter", FakeAdapter)
+    docs = asyncio.run(kb_doc_api.search_docs_multi("q", ["a", "b", "missing"], top_k=3))
+
+    # 同一嵌入模型只向量化一次，各知识库共用查询向量
+    assert calls == [("m", "q")]
+    assert kbs["a"].embeddings == kbs["b"].embeddings == [[1.0, 0.0]]
+    # 按换算后的距离合并排序，原始分数转换为 Python float 保存
+    assert [x.page_content for x in docs] == ["a-0", "b-0", "a-1"]
+    assert [x.score for x in docs] == pytest.approx([0.1, 0.3, 0.5])
+    assert all(type(x.metadata["raw_score"]) is float for x in docs)
+    assert [x.metadata["kb_name"] for x in docs] == ["a", "b", "a"]
@@ -0,0 +1,107 @@
+from pathlib import Path
+import sys
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import faiss
+import numpy as np
+import pytest
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema import Document
+from langchain.vectorstores.faiss import FAISS
+
+from server.knowledge_base.kb_cache.faiss_cache import add_embeddings
+from server.knowledge_base.kb_service.base import KBService
+from server.knowledge_base.kb_service.faiss_kb_service import FaissKBService
+
+
+def new_vector_store() -> FAISS:
+    # 离查询向量 [1, 0] 越近的文档编号越小，a.txt 的文档都比 b.txt 远
+    vs = FAISS(lambda x: [0.0, 0.0], faiss.IndexFlatL2(2), InMemoryDocstore({}), {})
+    ids = ["b0", "b1", "a0", "a1", "a2"]
+    vectors = np.array([[1.0, 0.0], [0.9, 0.1], [0.5, 0.5], [0.1, 0.9], [0.0, 1.0]], dtype=np.float32)
+    metadatas = [{"source": "b.txt", "page": 1}, {"source": "b.txt", "page": 2},
+                 {"source": "a.txt", "page": 1}, {"source": "a.txt", "page": 2}, {"source": "a.txt", "page": 3}]
+    add_embeddings(vs, ids, vectors, metadatas, ids=ids)
+    return vs
+
+
+def search_filtered(vs, filter, top_k=2, score_threshold=None):
+    kb = object.__new__(FaissKBService)
+    return [doc.page_content for doc, _ in kb._search_filtered(vs, [1.0, 0.0], top_k, score_threshold, filter)]
+
+
+def test_faiss_filter_before_top_k():
+    vs = new_vector_store()
+    # 先过滤再取 top_k：b.txt 的文档更近，但不会挤掉 a.txt 的结果
+    assert search_filtered(vs, {"source": "a.txt"}) == ["a0", "a1"]
+    assert search_filtered(vs, {"source": ["a.txt", "b.txt"]}) == ["b0", "b1"]
+    assert search_filtered(vs, {"source": "c.txt"}) == []
+    assert search_filtered(vs, {"source": "a.txt"}, score_threshold=1.0) == ["a0"]
+
+
+def test_faiss_filter_on_unindexed_key_scans_docstore():
+    vs = new_vector_store()
+    # page 不在 metadata 索引中：source 由索引定位，page 在候选文档中逐个比对（按字符串比较）
+    assert search_filtered(vs, {"page": "2"}) == ["b1", "a1"]
+    assert search_filtered(vs, {"source": "a.txt", "page": [2, 3]}) == ["a1", "a2"]
+
+
+class FakeKB:
+    # 不支持按向量检索的向量库，使用 KBService 默认的过滤实现
+    do_search_filtered = KBService.do_search_filtered
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.calls = []
+
+    def can_search_by_vector(self) -> bool:
+        return False
+
+    def do_search(self, query, top_k, score_threshold):
+        self.calls.append(top_k)
+        return self.docs[:top_k]
+
+
+def test_base_filter_falls_back_to_post_filtering():
+    docs = [(Document(page_content=str(i), metadata={"source": "a.txt" if i % 3 == 0 else "b.txt"}), i)
+            for i in range(30)]
+    kb = FakeKB(docs)
+    result = kb.do_search_filtered("q", 3, 1.0, {"source": "a.txt"})
+    # 扩大召回数量后在结果中过滤
+    assert kb.calls == [30]
+    assert [doc.page_content for doc, _ in result] == ["0", "3", "6"]
+
+
+def test_milvus_filter_expr():
+    pytest.importorskip("pymilvus")
+    from server.knowledge_base.kb_service.milvus_kb_service import milvus_filter_expr
+    assert milvus_filter_expr({"source": "a.md"}) == 'source == "a.md"'
+    assert milvus_filter_expr({"source": "文档.md", "page": [1, 2]}) == 'source == "文档.md" and page in [1, 2]'
+
+
+def test_chroma_where():
+    pytest.importorskip("chromadb")
+    from server.knowledge_base.kb_service.chromadb_kb_service import ChromaKBService
+    assert ChromaKBService._chroma_where(None) is None
+    assert ChromaKBService._chroma_where({"source": "a.md"}) == {"source": "a.md"}
+    assert ChromaKBService._chroma_where({"source": ["a.md", "b.md"], "page": 1}) == {
+        "$and": [{"source": {"$in": ["a.md", "b.md"]}}, {"page": 1}]}
+
+
+def test_pg_filter_uses_jsonb_containment():
+    pytest.importorskip("pgvector")
+    from types import SimpleNamespace
+    from sqlalchemy import Column, JSON, MetaData, String, Table
+    from sqlalchemy.dialects import postgresql
+    from server.knowledge_base.kb_service.pg_kb_service import PGKBService
+
+    store = Table("langchain_pg_embedding", MetaData(), Column("uuid", String), Column("cmetadata", JSON))
+    kb = object.__new__(PGKBService)
+    kb.pg_vector = SimpleNamespace(EmbeddingStore=store.c)
+    clause = kb._pg_filter({"source": "a.md", "page": 1})
+    compiled = clause.compile(dialect=postgresql.dialect())
+    assert str(compiled).count("@>") == 3
+    # 数字同时匹配其字符串形式
+    assert list(compiled.params.values()) == [{"source": "a.md"}, {"page": 1}, {"page": "1"}]
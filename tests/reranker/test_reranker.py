@@ -0,0 +1,64 @@
+from pathlib import Path
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+pytest.importorskip("sentence_transformers")
+pytest.importorskip("llama_index")
+
+from server.reranker import reranker
+from server.reranker.reranker import BatchedCrossEncoder, RerankerPool
+
+
+class FakeCrossEncoder:
+    def __init__(self, model_name=None, max_length=None, device=None):
+        self.calls = []
+
+    def predict(self, sentences, batch_size, show_progress_bar, convert_to_numpy):
+        # 记录每次前向的文本对长度，分数为文档长度
+        self.calls.append([len(q) + len(p) for q, p in sentences])
+        return np.array([float(len(p)) for _, p in sentences], dtype=np.float32)
+
+
+def test_concurrent_requests_share_sorted_batches_and_cache():
+    model = FakeCrossEncoder()
+    encoder = BatchedCrossEncoder(model, batch_size=2, batch_wait=0.5, max_batch_pairs=100, cache_size=100)
+    results = {}
+    passages = {"q1": ["aaaa", "a"], "q2": ["bbb", "bb"]}
+    try:
+        threads = [threading.Thread(target=lambda q=q: results.update({q: encoder.score(q, passages[q])}))
+                   for q in passages]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == {"q1": [4.0, 1.0], "q2": [3.0, 2.0]}
+        # 两个请求合并为一批，按长度排序后分两次前向
+        assert [x for call in model.calls for x in call] == [3, 4, 5, 6]
+        assert encoder.stats()["batches"] == 1 and encoder.stats()["forward_passes"] == 2
+
+        # 重复的 (query, 文档) 命中缓存，只计算新的文档
+        assert encoder.score("q1", ["a", "cc"]) == [1.0, 2.0]
+        assert model.calls[-1] == [4]
+        stats = encoder.stats()
+        assert stats["pairs"] == 6 and stats["cache_hits"] == 1 and stats["requests"] == 3
+    finally:
+        encoder.stop()
+
+
+def test_load_reranker_keyed_by_batch_size(monkeypatch):
+    monkeypatch.setattr(reranker, "CrossEncoder", FakeCrossEncoder)
+    pool = RerankerPool(cache_num=2)
+    a = pool.load_reranker("m", device="cpu", max_length=512, batch_size=8)
+    b = pool.load_reranker("m", device="cpu", max_length=512, batch_size=16)
+    try:
+        assert pool.load_reranker("m", device="cpu", max_length=512, batch_size=8) is a
+        assert a is not b and (a.batch_size, b.batch_size) == (8, 16)
+    finally:
+        a.stop()
+        b.stop()